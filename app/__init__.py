@@ -10,6 +10,86 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
     'DATABASE_URL', default_db_uri
 )
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# point at a stand-in server to test without the real API, see loadtest/fake_opendota.py
+app.config['OPEN_DOTA_BASE_URL'] = os.environ.get('OPEN_DOTA_BASE_URL', 'https://api.opendota.com').rstrip('/')
+app.config['API_MAX_WORKERS'] = int(os.environ.get('API_MAX_WORKERS', 50))
+app.config['PLAYER_MAX_WORKERS'] = int(os.environ.get('PLAYER_MAX_WORKERS', 10))
+app.config['API_CONNECT_TIMEOUT'] = float(os.environ.get('API_CONNECT_TIMEOUT', 5.0))
+app.config['API_READ_TIMEOUT'] = float(os.environ.get('API_READ_TIMEOUT', 30.0))
+# seconds an API payload is cached, first matching path pattern wins, 0 disables caching
+app.config['API_CACHE_TTLS'] = [
+    (r'^api/heroes$', 6 * 60 * 60),
+    (r'^api/players/\d+$', 30 * 60),
+    (r'^api/players/\d+/(rankings|heroes)$', 30 * 60),
+    (r'^api/players/\d+/wl$', 5 * 60)
+]
+app.config['API_CACHE_MAX_BYTES'] = int(os.environ.get('API_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+# a directory of this host only, expired payloads are pruned and it is kept under API_CACHE_DIR_MAX_BYTES
+app.config['API_CACHE_DIR'] = os.environ.get('API_CACHE_DIR')
+app.config['API_CACHE_DIR_MAX_BYTES'] = int(os.environ.get('API_CACHE_DIR_MAX_BYTES', 256 * 1024 * 1024))
+# OpenDota allows 60 calls a minute without an API key, set API_RATE_LIMIT_FILE to share the budget (and
+# the priority of interactive requests) between workers and the scheduler
+app.config['API_RATE_LIMIT'] = float(os.environ.get('API_RATE_LIMIT', 60))
+app.config['API_RATE_PERIOD'] = float(os.environ.get('API_RATE_PERIOD', 60))
+app.config['API_RATE_LIMIT_FILE'] = os.environ.get('API_RATE_LIMIT_FILE')
+app.config['API_RATE_WAIT_SECONDS'] = float(os.environ.get('API_RATE_WAIT_SECONDS', 10.0))
+# 429 and 5xx responses are retried with jittered exponential backoff or as long as Retry-After asks
+app.config['API_MAX_RETRIES'] = int(os.environ.get('API_MAX_RETRIES', 3))
+app.config['API_BACKOFF_BASE'] = float(os.environ.get('API_BACKOFF_BASE', 0.5))
+app.config['API_BACKOFF_CAP'] = float(os.environ.get('API_BACKOFF_CAP', 10.0))
+# calls fail fast after BREAKER_FAILURE_THRESHOLD failures in a row, probed again every BREAKER_RESET_SECONDS
+app.config['BREAKER_FAILURE_THRESHOLD'] = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+app.config['BREAKER_RESET_SECONDS'] = float(os.environ.get('BREAKER_RESET_SECONDS', 30.0))
+app.config['BREAKER_HALF_OPEN_CALLS'] = int(os.environ.get('BREAKER_HALF_OPEN_CALLS', 1))
+# API calls of a request share this budget, keep it below the gunicorn worker timeout
+app.config['REQUEST_DEADLINE_SECONDS'] = float(os.environ.get('REQUEST_DEADLINE_SECONDS', 20.0))
+app.config['HERO_CATALOG_TTL'] = int(os.environ.get('HERO_CATALOG_TTL', 24 * 60 * 60))
+app.config['FLIGHT_LEASE_SECONDS'] = float(os.environ.get('FLIGHT_LEASE_SECONDS', 120.0))
+app.config['FLIGHT_WAIT_SECONDS'] = float(os.environ.get('FLIGHT_WAIT_SECONDS', 60.0))
+app.config['FLIGHT_POLL_INTERVAL'] = float(os.environ.get('FLIGHT_POLL_INTERVAL', 0.2))
+# days a score is served as is, then served for a grace period while it is refreshed in the background
+app.config['LEADERBOARD_MAX_AGE_DAYS'] = int(os.environ.get('LEADERBOARD_MAX_AGE_DAYS', 0))
+app.config['LEADERBOARD_GRACE_DAYS'] = int(os.environ.get('LEADERBOARD_GRACE_DAYS', 1))
+app.config['COMPARE_MAX_AGE_DAYS'] = int(os.environ.get('COMPARE_MAX_AGE_DAYS', 0))
+app.config['COMPARE_GRACE_DAYS'] = int(os.environ.get('COMPARE_GRACE_DAYS', 7))
+app.config['REFRESH_MAX_WORKERS'] = int(os.environ.get('REFRESH_MAX_WORKERS', 2))
+# players a ?budget_ms= request left loading are completed in the background, at most this many at once
+app.config['COMPLETION_MAX_WORKERS'] = int(os.environ.get('COMPLETION_MAX_WORKERS', 2))
+app.config['COMPLETION_DEADLINE_SECONDS'] = float(os.environ.get('COMPLETION_DEADLINE_SECONDS', 60.0))
+# rows per page of /leaderboard/global, ?limit= may ask for up to GLOBAL_LEADERBOARD_MAX_PAGE_SIZE
+app.config['GLOBAL_LEADERBOARD_PAGE_SIZE'] = int(os.environ.get('GLOBAL_LEADERBOARD_PAGE_SIZE', 50))
+app.config['GLOBAL_LEADERBOARD_MAX_PAGE_SIZE'] = int(os.environ.get('GLOBAL_LEADERBOARD_MAX_PAGE_SIZE', 200))
+# seconds browsers and CDNs may reuse a fresh response without revalidating it
+app.config['HTTP_CACHE_MAX_AGE'] = int(os.environ.get('HTTP_CACHE_MAX_AGE', 5 * 60))
+# /metrics, gunicorn workers share their counts through files in METRICS_DIR, empty it on restart
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+app.config['METRICS_FLUSH_SECONDS'] = float(os.environ.get('METRICS_FLUSH_SECONDS', 5.0))
+# SQL statements slower than this are logged, 0 turns the log off
+app.config['SLOW_QUERY_SECONDS'] = float(os.environ.get('SLOW_QUERY_SECONDS', 0.5))
+# requests carrying a token of app.profiler.make_token are profiled, see app/profiler.py,
+# profiling is off until PROFILE_SECRET is set, at most PROFILE_MAX_FILES reports are saved
+app.config['PROFILE_SECRET'] = os.environ.get('PROFILE_SECRET')
+app.config['PROFILE_MAX_FILES'] = int(os.environ.get('PROFILE_MAX_FILES', 100))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(os.path.dirname(__file__), '../profiles'))
+app.config['PROFILE_TOKEN_MAX_AGE'] = int(os.environ.get('PROFILE_TOKEN_MAX_AGE', 24 * 60 * 60))
+app.config['PROFILE_TOP_FUNCTIONS'] = int(os.environ.get('PROFILE_TOP_FUNCTIONS', 40))
+# score compaction, see compact_db.py
+app.config['COMPACT_KEEP_DAYS'] = int(os.environ.get('COMPACT_KEEP_DAYS', 30))
+app.config['COMPACT_PERIOD'] = os.environ.get('COMPACT_PERIOD', 'week')
+app.config['COMPACT_BATCH_SIZE'] = int(os.environ.get('COMPACT_BATCH_SIZE', 100))
+# bulk player import, see import_players.py
+app.config['IMPORT_MAX_WORKERS'] = int(os.environ.get('IMPORT_MAX_WORKERS', 4))
+app.config['IMPORT_BATCH_SIZE'] = int(os.environ.get('IMPORT_BATCH_SIZE', 50))
+app.config['IMPORT_CHECKPOINT_FILE'] = os.environ.get(
+    'IMPORT_CHECKPOINT_FILE',
+    os.path.join(os.path.dirname(__file__), '../db/import.checkpoint')
+)
+# precompute scheduler, see scheduler.py
+app.config['SCHEDULER_LEAD_SECONDS'] = int(os.environ.get('SCHEDULER_LEAD_SECONDS', 60 * 60))
+app.config['SCHEDULER_TRACK_DAYS'] = int(os.environ.get('SCHEDULER_TRACK_DAYS', 7))
+app.config['SCHEDULER_MAX_WORKERS'] = int(os.environ.get('SCHEDULER_MAX_WORKERS', 2))
+app.config['SCHEDULER_PACE_SECONDS'] = float(os.environ.get('SCHEDULER_PACE_SECONDS', 1.0))
+app.config['SCHEDULER_INTERVAL'] = float(os.environ.get('SCHEDULER_INTERVAL', 5 * 60))
 app.gtag_tracking_id = os.environ.get(
     'GTAG_TRACKING_ID',
     'your-google-tracking-id'
@@ -1,22 +1,298 @@
-from app import app
+import gzip
+import os
 import ssl
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http import client as http_client
 from urllib import request, parse
-from urllib.error import URLError
+from urllib.error import URLError, HTTPError
+
+from app import app
+from app.cache import ResponseCache
+from app.limits import TokenBucket, CircuitBreaker, BACKGROUND, current_priority, remaining, bind, \
+    retry_after, backoff
+from app.metrics import registry, api_path_label, api_requests, api_request_seconds, api_failures
+from app.profiler import trace_event
+
+# shared by all requests of a worker, bounds the number of in-flight API calls
+api_executor = ThreadPoolExecutor(
+    max_workers=app.config['API_MAX_WORKERS'],
+    thread_name_prefix='open-dota-api'
+)
+
+
+class PooledResponse(object):
+    """A fully read response, mimics the parts of urllib response used by the API layer"""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getcode(self):
+        return self.status
+
+    def read(self):
+        return self.body
+
+
+class _TimeoutsMixin(object):
+    """Use the connect timeout for TCP / TLS setup and the read timeout afterwards"""
+
+    def __init__(self, host, port=None, connect_timeout=None, read_timeout=None, **kwargs):
+        super().__init__(host, port=port, timeout=connect_timeout, **kwargs)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(self.read_timeout)
+
+
+class _HTTPConnection(_TimeoutsMixin, http_client.HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_TimeoutsMixin, http_client.HTTPSConnection):
+    pass
+
+
+# raised when sending on a keep-alive connection the server already closed
+STALE_CONNECTION_ERRORS = (http_client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+class ConnectionPool(object):
+    """Keep-alive connections per host, shared by the threads of a worker process.
+
+    Exposes ``Request`` and ``urlopen`` so it can be injected in place of
+    ``urllib.request`` into :func:`get_dota_open_api`.
+    """
+
+    Request = request.Request
 
-# disable ssl check
-ssl._create_default_https_context = ssl._create_unverified_context
+    def __init__(self, connect_timeout=5.0, read_timeout=30.0, max_idle=10, ssl_context=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
 
+    def _new_connection(self, scheme, host, port):
+        if scheme == 'https':
+            return _HTTPSConnection(host, port, connect_timeout=self.connect_timeout,
+                                    read_timeout=self.read_timeout, context=self.ssl_context)
+        return _HTTPConnection(host, port, connect_timeout=self.connect_timeout,
+                               read_timeout=self.read_timeout)
 
-def get_dota_open_api(path, base_url='https://api.opendota.com', params=None, r=request):
+    def _acquire(self, key):
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked worker, never share sockets with the parent
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(*key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def urlopen(self, req, timeout=None):
+        url = parse.urlsplit(req.full_url)
+        key = (url.scheme, url.hostname, url.port)
+        headers = dict(req.header_items())
+        headers.setdefault('User-Agent', 'dota-flask')
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        headers.setdefault('Connection', 'keep-alive')
+        conn, reused = self._acquire(key)
+        while True:
+            resp = None
+            try:
+                if timeout is not None:
+                    conn.read_timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                conn.request(req.get_method(), req.selector, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except STALE_CONNECTION_ERRORS as e:
+                conn.close()
+                if reused and resp is None:
+                    # server closed an idle keep-alive connection, retry once on a fresh one
+                    conn, reused = self._new_connection(*key), False
+                    continue
+                raise URLError(e)
+            except (http_client.HTTPException, OSError) as e:
+                # a timeout is never retried, the caller's deadline bounds a single attempt
+                conn.close()
+                raise URLError(e)
+            break
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        try:
+            body = _decode(body, resp.getheader('Content-Encoding'))
+        except (OSError, EOFError, zlib.error) as e:
+            raise URLError(e)
+        return PooledResponse(resp.status, resp.headers, body)
+
+
+def _decode(body, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # some servers send raw deflate without the zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+api_client = ConnectionPool(
+    connect_timeout=app.config['API_CONNECT_TIMEOUT'],
+    read_timeout=app.config['API_READ_TIMEOUT'],
+    max_idle=app.config['API_MAX_WORKERS']
+)
+
+api_cache = ResponseCache(
+    app.config['API_CACHE_TTLS'],
+    max_bytes=app.config['API_CACHE_MAX_BYTES'],
+    cache_dir=app.config['API_CACHE_DIR'],
+    max_disk_bytes=app.config['API_CACHE_DIR_MAX_BYTES']
+)
+
+registry.counter_func(
+    'opendota_cache_requests_total', 'Lookups of the API payload cache by result', ['result'],
+    lambda: {('hit',): api_cache.hits, ('miss',): api_cache.misses}
+)
+
+api_limiter = TokenBucket(
+    rate=app.config['API_RATE_LIMIT'] / app.config['API_RATE_PERIOD'],
+    capacity=app.config['API_RATE_LIMIT'],
+    state_path=app.config['API_RATE_LIMIT_FILE']
+)
+
+api_breaker = CircuitBreaker(
+    failure_threshold=app.config['BREAKER_FAILURE_THRESHOLD'],
+    reset_seconds=app.config['BREAKER_RESET_SECONDS'],
+    half_open_calls=app.config['BREAKER_HALF_OPEN_CALLS']
+)
+
+
+def _observe(label, status, started_at):
+    api_requests.inc(label, status)
+    api_request_seconds.observe(time.perf_counter() - started_at, label)
+    trace_event('api', started_at, path=label, status=status)
+
+
+# worth another try, anything else but 200 is final
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+def get_dota_open_api(path, base_url=None, params=None, r=api_client):
+    if base_url is None:
+        base_url = app.config['OPEN_DOTA_BASE_URL']
+    key = api_cache.key(base_url, path, params)
+    payload = api_cache.get(key)
+    if payload is not None:
+        return payload
     url = base_url + '/' + path
     if params is not None:
         url += '?' + parse.urlencode(params)
     app.logger.info('API URL: {}'.format(url))
-    try:
-        req = r.urlopen(r.Request(url), timeout=30.0)
-        if req.getcode() != 200:
+    label = api_path_label(path)
+    max_retries = app.config['API_MAX_RETRIES']
+    for attempt in range(max_retries + 1):
+        # background fetches wait as long as it takes, they never hold up a page
+        wait = None if current_priority() == BACKGROUND else app.config['API_RATE_WAIT_SECONDS']
+        budget = remaining()
+        if budget is not None:
+            if budget <= 0:
+                app.logger.warning('request deadline passed, skip {}'.format(url))
+                api_failures.inc(label, 'deadline')
+                return None
+            wait = budget if wait is None else min(wait, budget)
+        # an open circuit fails fast, it neither spends nor waits for a token
+        if not api_breaker.allow():
+            app.logger.warning('API circuit open, skip {}'.format(url))
+            api_failures.inc(label, 'circuit_open')
+            return None
+        if not api_limiter.acquire(current_priority(), timeout=wait):
+            app.logger.warning('API rate limit, gave up waiting for {}'.format(url))
+            api_failures.inc(label, 'rate_limit')
             return None
-        return req.read()
-    except URLError as e:
-        app.logger.warning(e)
-        return None
+        budget = remaining()
+        timeout = app.config['API_READ_TIMEOUT'] if budget is None \
+            else max(min(app.config['API_READ_TIMEOUT'], budget), 0.001)
+        started_at = time.perf_counter()
+        try:
+            req = r.urlopen(r.Request(url), timeout=timeout)
+            status, headers = req.getcode(), req.headers
+            if status == 200:
+                payload = req.read()
+                api_breaker.record_success()
+                _observe(label, '200', started_at)
+                break
+        except HTTPError as e:
+            # urllib raises on any status but 2xx
+            status, headers = e.code, e.headers
+        except URLError as e:
+            app.logger.warning(e)
+            _observe(label, 'error', started_at)
+            if timeout < app.config['API_READ_TIMEOUT'] and remaining() <= 0:
+                # the caller's deadline cut the attempt short, that says nothing about the API
+                api_failures.inc(label, 'deadline')
+                return None
+            api_breaker.record_failure()
+            api_failures.inc(label, 'error')
+            return None
+        _observe(label, str(status), started_at)
+        # only a failing server opens the circuit, a 4xx proves it is up
+        if status >= 500:
+            api_breaker.record_failure()
+        else:
+            api_breaker.record_success()
+        if status not in RETRY_STATUSES or attempt == max_retries:
+            app.logger.warning('API status {} for {}'.format(status, url))
+            api_failures.inc(label, 'status')
+            return None
+        delay = retry_after(headers)
+        if delay is None:
+            delay = backoff(attempt, app.config['API_BACKOFF_BASE'], app.config['API_BACKOFF_CAP'])
+        budget = remaining()
+        if budget is not None and delay >= budget:
+            app.logger.warning('request deadline too close to retry {}'.format(url))
+            api_failures.inc(label, 'deadline')
+            return None
+        if status == 429:
+            # over the quota, hold back every caller sharing the limiter
+            api_limiter.pause(delay)
+        else:
+            time.sleep(delay)
+    api_cache.set(key, payload)
+    return payload
+
+
+def get_dota_open_api_all(calls, func=get_dota_open_api):
+    """Issue (path, params) calls concurrently, results are returned in call order"""
+    call = bind(func)
+    futures = [api_executor.submit(call, path, params=params) for path, params in calls]
+    return [f.result() for f in futures]
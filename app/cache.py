@@ -0,0 +1,195 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# files of the disk backend, .cache holds pickles written by earlier versions and is only ever deleted
+DISK_SUFFIXES = ('.entry', '.cache', '.tmp')
+
+
+class ResponseCache(object):
+    """TTL + LRU cache for API payloads, optionally backed by a directory on disk.
+
+    ``ttls`` is a list of ``(pattern, seconds)``, the first pattern matching a
+    path decides how long its payload is kept, paths matching nothing are not
+    cached. Memory use is bounded by ``max_bytes``, least recently used entries
+    are evicted first. When ``cache_dir`` is set every entry is also written
+    there, so a restarted worker starts warm. A file holds the expiry time on
+    its first line and the raw payload after it, nothing in it is executed on
+    load. Every ``prune_seconds`` expired files are deleted, and the oldest
+    ones while the directory holds more than ``max_disk_bytes``.
+    """
+
+    def __init__(self, ttls, max_bytes=16 * 1024 * 1024, cache_dir=None, max_disk_bytes=256 * 1024 * 1024,
+                 prune_seconds=60.0, clock=time.time):
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.prune_seconds = prune_seconds
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+        self._prune_lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.prune()
+
+    def ttl(self, path):
+        for pattern, ttl in self.ttls:
+            if pattern.match(path):
+                return ttl
+        return 0
+
+    @staticmethod
+    def key(base_url, path, params=None):
+        if params is None:
+            return base_url, path, ()
+        return base_url, path, tuple(sorted((str(k), str(v)) for k, v in params.items()))
+
+    def get(self, key):
+        if self.ttl(key[1]) <= 0:
+            # never cached, neither a disk read nor a miss
+            return None
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, payload = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                self._remove(key)
+        entry = self._read_disk(key)
+        if entry is not None and entry[0] > now:
+            with self._lock:
+                self._store(key, entry)
+                self.hits += 1
+            return entry[1]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, payload):
+        ttl = self.ttl(key[1])
+        if ttl <= 0 or payload is None:
+            return
+        entry = (self.clock() + ttl, payload)
+        with self._lock:
+            self._store(key, entry)
+        self._write_disk(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+        if self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(DISK_SUFFIXES):
+                    _unlink(os.path.join(self.cache_dir, name))
+
+    def prune(self):
+        """Delete expired files of ``cache_dir``, then the oldest ones until it fits ``max_disk_bytes``.
+
+        One thread prunes at a time, the others skip it instead of waiting.
+        """
+        if self.cache_dir is None or not self._prune_lock.acquire(blocking=False):
+            return
+        try:
+            self._prune()
+        finally:
+            self._prune_lock.release()
+
+    def _prune(self):
+        now = self.clock()
+        self._pruned_at = now
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith('.entry'):
+                    with open(path, 'rb') as f:
+                        expires_at = float(f.readline())
+                    if expires_at > now:
+                        files.append((stat.st_mtime, stat.st_size, path))
+                        continue
+                elif name.endswith('.tmp') and stat.st_mtime > time.time() - self.prune_seconds:
+                    # being written by another worker
+                    continue
+                elif not name.endswith(DISK_SUFFIXES):
+                    continue
+            except (OSError, ValueError):
+                pass
+            # expired, unreadable, left by a crashed writer or a pickle of an older version
+            _unlink(path)
+        files.sort()
+        size = sum(f[1] for f in files)
+        while size > self.max_disk_bytes and len(files) > 0:
+            _, file_size, path = files.pop(0)
+            _unlink(path)
+            size -= file_size
+
+    def _store(self, key, entry):
+        size = len(entry[1])
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._size += size
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, payload = self._entries.pop(key)
+        self._size -= len(payload)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.entry')
+
+    def _read_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires_at = float(f.readline())
+                payload = f.read()
+        except (OSError, ValueError):
+            return None
+        if expires_at <= self.clock():
+            _unlink(path)
+            return None
+        return expires_at, payload
+
+    def _write_disk(self, key, entry):
+        # only raw payloads go to disk
+        if self.cache_dir is None or not isinstance(entry[1], bytes):
+            return
+        if self.clock() - self._pruned_at >= self.prune_seconds:
+            self.prune()
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(repr(entry[0]).encode('ascii') + b'\n')
+            f.write(entry[1])
+        # atomic, other workers never read a half written entry
+        os.replace(tmp_path, self._disk_path(key))
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        # already removed by another worker
+        pass
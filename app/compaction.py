@@ -0,0 +1,172 @@
+from collections import namedtuple
+from datetime import date, timedelta
+
+from sqlalchemy.orm import aliased
+
+from app import app, db
+from app.models import MatchScore, HeroScore, MatchScoreRollup, HeroScoreRollup
+
+Rollup = namedtuple('Rollup', ['detail', 'rollup', 'keys', 'averages', 'maxima'])
+
+ROLLUPS = [
+    Rollup(MatchScore, MatchScoreRollup, ['player_id'],
+           ['week_score', 'month_score', 'year_score', 'overall_score'], ['overall_count']),
+    Rollup(HeroScore, HeroScoreRollup, ['player_id', 'hero_id'],
+           ['rank_score', 'win_score', 'last_played_score', 'overall_score'], [])
+]
+
+# ids per DELETE statement, stays below the SQLite bound parameter limit
+DELETE_CHUNK = 500
+
+
+def period_start(day, period):
+    if period == MatchScoreRollup.WEEK:
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def period_end(start, period):
+    if period == MatchScoreRollup.WEEK:
+        return start + timedelta(days=7)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def row_bytes(table):
+    """Bytes a row of ``table`` takes with its indexes, measured on Postgres, estimated elsewhere"""
+    if db.engine.dialect.name == 'postgresql':
+        size = db.session.execute(
+            db.text('SELECT pg_total_relation_size(CAST(:name AS regclass))'), {'name': table.name}
+        ).scalar()
+        rows = db.session.query(db.func.count()).select_from(table).scalar()
+        return size // max(rows, 1)
+    # row header plus 8 bytes per column and an entry per index
+    return 24 + 8 * len(table.columns) + 16 * (len(table.indexes) + 1)
+
+
+def _merge_average(old, old_days, new, new_days):
+    if old is None:
+        return new
+    if new is None:
+        return old
+    return (old * old_days + new * new_days) / float(old_days + new_days)
+
+
+def _merge_max(old, new):
+    if old is None or new is None:
+        return new if old is None else old
+    return max(old, new)
+
+
+class Compactor(object):
+    """Rolls daily scores older than ``keep_days`` into one row per week or month and deletes them.
+
+    Only whole periods before the cutoff are compacted, and the latest day of
+    every player is always kept since that is what the pages serve. Every
+    batch of ``batch_size`` players is rolled up and deleted in a transaction
+    of its own, locks are short and an interrupted run loses nothing.
+    """
+
+    def __init__(self, keep_days, period=MatchScoreRollup.WEEK, batch_size=100, today=None):
+        self.keep_days = keep_days
+        self.period = period
+        self.batch_size = batch_size
+        self.today = today or date.today()
+
+    @property
+    def cutoff(self):
+        return self.today - timedelta(days=self.keep_days)
+
+    def compact(self, dry_run=False):
+        """A report per table, what was (or with ``dry_run`` would be) rolled up and deleted"""
+        return [self.compact_table(rollup, dry_run) for rollup in ROLLUPS]
+
+    def periods(self, detail):
+        days = db.session.query(detail.score_date).filter(detail.score_date < self.cutoff).distinct()
+        starts = sorted(set(period_start(day, self.period) for day, in days))
+        return [start for start in starts if period_end(start, self.period) <= self.cutoff]
+
+    def compact_table(self, rollup, dry_run=False):
+        detail = rollup.detail
+        report = {'table': detail.__tablename__, 'periods': 0, 'rows': 0, 'rollups': 0}
+        for start in self.periods(detail):
+            criteria = self._criteria(detail, start)
+            player_ids = [
+                player_id for player_id, in
+                db.session.query(detail.player_id).filter(*criteria).distinct().order_by(detail.player_id)
+            ]
+            if len(player_ids) > 0:
+                report['periods'] += 1
+            for i in range(0, len(player_ids), self.batch_size):
+                rows, rollups = self._compact_batch(
+                    rollup, start, criteria, player_ids[i:i + self.batch_size], dry_run
+                )
+                report['rows'] += rows
+                report['rollups'] += rollups
+        report['bytes'] = report['rows'] * row_bytes(detail.__table__)
+        return report
+
+    def _criteria(self, detail, start):
+        latest = aliased(detail)
+        latest_date = db.session.query(db.func.max(latest.score_date)) \
+            .filter(latest.player_id == detail.player_id) \
+            .as_scalar()
+        return [
+            detail.score_date >= start,
+            detail.score_date < period_end(start, self.period),
+            detail.score_date < latest_date
+        ]
+
+    def _compact_batch(self, rollup, start, criteria, player_ids, dry_run):
+        """Roll up and delete the rows of a few players, returns (deleted rows, new rollup rows)"""
+        detail = rollup.detail
+        criteria = criteria + [detail.player_id.in_(player_ids)]
+        keys = [getattr(detail, k) for k in rollup.keys]
+        aggregates = db.session.query(
+            *keys + [db.func.count()]
+            + [db.func.avg(getattr(detail, c)) for c in rollup.averages]
+            + [db.func.max(getattr(detail, c)) for c in rollup.maxima]
+        ).filter(*criteria).group_by(*keys).all()
+        existing = dict(
+            (tuple(getattr(r, k) for k in rollup.keys), r)
+            for r in rollup.rollup.query
+            .filter(rollup.rollup.period == self.period)
+            .filter(rollup.rollup.period_start == start)
+            .filter(rollup.rollup.player_id.in_(player_ids))
+        )
+        ids = [
+            row_id for row_id, in
+            db.session.query(detail.__mapper__.primary_key[0]).filter(*criteria)
+        ]
+        new_rollups = 0
+        for row in aggregates:
+            key = tuple(row[:len(keys)])
+            days = row[len(keys)]
+            averages = row[len(keys) + 1:len(keys) + 1 + len(rollup.averages)]
+            maxima = row[len(keys) + 1 + len(rollup.averages):]
+            target = existing.get(key)
+            if target is None:
+                new_rollups += 1
+                if dry_run:
+                    continue
+                values = dict(zip(rollup.keys, key))
+                values.update(zip(rollup.averages, averages))
+                values.update(zip(rollup.maxima, maxima))
+                db.session.add(rollup.rollup(period=self.period, period_start=start, days=days, **values))
+            elif not dry_run:
+                # the latest day of a player was kept back in an earlier run
+                for c, value in zip(rollup.averages, averages):
+                    setattr(target, c, _merge_average(getattr(target, c), target.days, value, days))
+                for c, value in zip(rollup.maxima, maxima):
+                    setattr(target, c, _merge_max(getattr(target, c), value))
+                target.days += days
+        if dry_run:
+            db.session.rollback()
+            return len(ids), new_rollups
+        pk = detail.__mapper__.primary_key[0]
+        for i in range(0, len(ids), DELETE_CHUNK):
+            detail.query.filter(pk.in_(ids[i:i + DELETE_CHUNK])).delete(synchronize_session=False)
+        db.session.commit()
+        app.logger.info("compacted {} {} rows of {} players for {}".format(
+            len(ids), detail.__tablename__, len(player_ids), start
+        ))
+        return len(ids), new_rollups
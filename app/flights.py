@@ -0,0 +1,120 @@
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from app.models import FetchLease
+from app.limits import remaining
+
+
+class SingleFlight(object):
+    """Let a single caller per key run a cold fetch while the other callers wait for it.
+
+    Threads of a worker are coordinated with an event per key, workers (and
+    hosts) with a row in ``fetch_lease`` written on its own connection. A lease
+    older than ``lease_seconds`` is taken over, so a crashed leader never
+    blocks a key for good.
+    """
+
+    def __init__(self, lease_seconds=120.0, wait_seconds=60.0, poll_interval=0.2):
+        self.lease_seconds = lease_seconds
+        self.wait_seconds = wait_seconds
+        self.poll_interval = poll_interval
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @property
+    def owner(self):
+        # evaluated on use, forked workers must not share an owner
+        return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def try_acquire(self, key):
+        """True when the caller leads the flight of ``key`` and must :meth:`release` it"""
+        with self._lock:
+            if key in self._flights:
+                return False
+            self._flights[key] = threading.Event()
+        try:
+            acquired = self._acquire_lease(key)
+        except Exception:
+            # never leave the key in flight, its waiters would time out for good
+            self._land(key)
+            raise
+        if acquired:
+            return True
+        self._land(key)
+        return False
+
+    def release(self, key):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    FetchLease.__table__.delete()
+                    .where(FetchLease.key == key)
+                    .where(FetchLease.owner == self.owner)
+                )
+        finally:
+            self._land(key)
+
+    def wait(self, key):
+        """Block until no caller leads the flight of ``key``, or the wait times out"""
+        wait_seconds = self.wait_seconds
+        budget = remaining()
+        if budget is not None:
+            # never wait past the deadline of the request
+            wait_seconds = max(min(wait_seconds, budget), 0)
+        deadline = time.time() + wait_seconds
+        event = self._flights.get(key)
+        if event is not None:
+            event.wait(wait_seconds)
+        table = FetchLease.__table__
+        while time.time() < deadline:
+            with db.engine.connect() as connection:
+                expires_at = connection.execute(
+                    db.select([table.c.expires_at]).where(table.c.key == key)
+                ).scalar()
+            if expires_at is None or expires_at < time.time():
+                return
+            time.sleep(self.poll_interval)
+        app.logger.warning("gave up waiting for fetch {}".format(key))
+
+    def do(self, key, fetch, lookup):
+        """Return ``fetch()`` when leading the flight, else ``lookup()`` once the leader is done"""
+        if self.try_acquire(key):
+            try:
+                return fetch()
+            finally:
+                self.release(key)
+        self.wait(key)
+        return lookup()
+
+    def _acquire_lease(self, key):
+        now = time.time()
+        table = FetchLease.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.delete().where(table.c.key == key).where(table.c.expires_at < now))
+                connection.execute(table.insert().values(
+                    key=key,
+                    owner=self.owner,
+                    expires_at=now + self.lease_seconds
+                ))
+        except IntegrityError:
+            return False
+        return True
+
+    def _land(self, key):
+        with self._lock:
+            event = self._flights.pop(key, None)
+        if event is not None:
+            event.set()
+
+
+single_flight = SingleFlight(
+    lease_seconds=app.config['FLIGHT_LEASE_SECONDS'],
+    wait_seconds=app.config['FLIGHT_WAIT_SECONDS'],
+    poll_interval=app.config['FLIGHT_POLL_INTERVAL']
+)
@@ -0,0 +1,172 @@
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from app.models import MatchScore, HeroScore, hero_catalog
+from app.apis import get_dota_open_api
+from app.limits import priority, bind, BACKGROUND
+from app.services import fetch_player_match_json, fetch_player_hero_json, get_match_score_from_json, \
+    get_player_from_json, get_hero_score_mappings
+
+
+def read_player_ids(lines):
+    """Account ids of ``lines``, one per line, blank lines and ``#`` comments are skipped"""
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        if not line.isdigit():
+            app.logger.warning("skip invalid player id {!r}".format(line))
+            continue
+        yield int(line)
+
+
+class Importer(object):
+    """Stores the match and hero scores of a stream of players.
+
+    Up to ``max_workers`` players are fetched at once while the results are
+    written in order, ``batch_size`` players per transaction. After every
+    batch the number of players done is saved to ``checkpoint_path``, a rerun
+    on the same input skips them and stores the scores for the same day.
+    Players already scored that day are never written twice.
+    """
+
+    def __init__(self, max_workers, batch_size, checkpoint_path=None, source=None,
+                 func=get_dota_open_api, clock=time.time):
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.source = source
+        self.func = func
+        self.clock = clock
+
+    def load_checkpoint(self):
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return {'source': self.source, 'done': 0, 'score_date': date.today().isoformat()}
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('source') != self.source:
+            app.logger.warning("checkpoint {} is of {}, start over".format(
+                self.checkpoint_path, checkpoint.get('source')
+            ))
+            return {'source': self.source, 'done': 0, 'score_date': date.today().isoformat()}
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        if self.checkpoint_path is None:
+            return
+        # written aside and renamed, a crash never leaves half a checkpoint
+        path = self.checkpoint_path + '.tmp'
+        with open(path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(path, self.checkpoint_path)
+
+    def clear_checkpoint(self):
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.unlink(self.checkpoint_path)
+
+    def fetch(self, player_id):
+        with app.app_context():
+            try:
+                return player_id, fetch_player_match_json(player_id, self.func), \
+                    fetch_player_hero_json(player_id, self.func)
+            except Exception as e:
+                # one broken player never stops the import
+                app.logger.warning("import of {} failed: {}".format(player_id, e))
+                return player_id, None, None
+            finally:
+                db.session.remove()
+
+    def write(self, results, score_date):
+        """Store a batch of fetched players in one transaction, returns the players stored"""
+        player_ids = [player_id for player_id, _, _ in results]
+        # retried once when a concurrent request inserted one of the players
+        for retry in [True, False]:
+            match_scored = set(
+                player_id for player_id, in db.session.query(MatchScore.player_id)
+                .filter(MatchScore.score_date == score_date)
+                .filter(MatchScore.player_id.in_(player_ids))
+            )
+            hero_scored = set(
+                player_id for player_id, in db.session.query(HeroScore.player_id)
+                .filter(HeroScore.score_date == score_date)
+                .filter(HeroScore.player_id.in_(player_ids))
+                .distinct()
+            )
+            hero_ids = list(hero_catalog.heroes().keys())
+            hero_mappings = []
+            stored = 0
+            for player_id, match_json, hero_json in results:
+                if match_json is None and hero_json is None:
+                    continue
+                stored += 1
+                if match_json is not None and player_id not in match_scored:
+                    db.session.add(get_match_score_from_json(*match_json, player_id, score_date))
+                    match_scored.add(player_id)
+                if hero_json is not None and player_id not in hero_scored:
+                    hero_ranking_json, hero_match_json, player_json = hero_json
+                    get_player_from_json(player_json, player_id)
+                    hero_mappings.extend(get_hero_score_mappings(
+                        player_id, hero_ids, json.loads(hero_match_json), json.loads(hero_ranking_json), score_date
+                    ))
+                    hero_scored.add(player_id)
+            try:
+                # bulk inserts bypass the unit of work, the player rows must exist first
+                db.session.flush()
+                db.session.bulk_insert_mappings(HeroScore, hero_mappings)
+                db.session.commit()
+                return stored
+            except IntegrityError:
+                db.session.rollback()
+                if not retry:
+                    raise
+
+    def run(self, lines, progress=None):
+        """Import the player ids of ``lines``, ``progress`` is called with the stats after every batch"""
+        checkpoint = self.load_checkpoint()
+        score_date = date(*map(int, checkpoint['score_date'].split('-')))
+        player_ids = read_player_ids(lines)
+        resumed = checkpoint['done']
+        for _ in range(resumed):
+            next(player_ids, None)
+        stats = {'done': checkpoint['done'], 'stored': 0, 'failed': 0, 'rate': 0.0}
+        started_at = self.clock()
+        pending = deque()
+        batch = []
+
+        def flush():
+            stored = self.write(batch, score_date)
+            stats['done'] += len(batch)
+            stats['stored'] += stored
+            stats['failed'] += len(batch) - stored
+            stats['rate'] = (stats['done'] - resumed) / max(self.clock() - started_at, 1e-9)
+            checkpoint['done'] = stats['done']
+            self.save_checkpoint(checkpoint)
+            del batch[:]
+            if progress is not None:
+                progress(stats)
+
+        # imports yield the API to interactive requests, of every worker when API_RATE_LIMIT_FILE is set
+        with priority(BACKGROUND), \
+                ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='importer') as executor:
+            for player_id in player_ids:
+                pending.append(executor.submit(bind(self.fetch), player_id))
+                # a bounded window of players in flight, the input is never read ahead further
+                if len(pending) >= 2 * self.max_workers:
+                    batch.append(pending.popleft().result())
+                    if len(batch) >= self.batch_size:
+                        flush()
+            while len(pending) > 0:
+                batch.append(pending.popleft().result())
+                if len(batch) >= self.batch_size:
+                    flush()
+            if len(batch) > 0:
+                flush()
+        self.clear_checkpoint()
+        return stats
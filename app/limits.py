@@ -0,0 +1,248 @@
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# an interactive caller counts as waiting this long past its expected wait, covers the time to wake up
+WAITER_GRACE_SECONDS = 1.0
+
+_local = threading.local()
+
+
+def current_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+def current_deadline():
+    return getattr(_local, 'deadline', None)
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def set_trace(trace):
+    """Calls made by this thread and the executor threads it binds are recorded on ``trace``"""
+    _local.trace = trace
+
+
+def set_deadline(seconds):
+    """API calls made by this thread must finish within ``seconds``, None lifts the deadline"""
+    _local.deadline = None if seconds is None else time.time() + seconds
+
+
+def remaining():
+    """Seconds left until the deadline of this thread, None without a deadline"""
+    deadline = current_deadline()
+    return None if deadline is None else deadline - time.time()
+
+
+@contextmanager
+def call_context(priority_value, deadline, trace=None):
+    previous = current_priority(), current_deadline(), current_trace()
+    _local.priority, _local.deadline, _local.trace = priority_value, deadline, trace
+    try:
+        yield
+    finally:
+        _local.priority, _local.deadline, _local.trace = previous
+
+
+@contextmanager
+def priority(value):
+    """API calls made by this thread inside the block use ``value`` as priority"""
+    with call_context(value, current_deadline(), current_trace()):
+        yield
+
+
+def bind(func):
+    """Run ``func`` with the priority, deadline and trace of the calling thread, e.g. on an executor"""
+    context = current_priority(), current_deadline(), current_trace()
+
+    def bound(*args, **kwargs):
+        with call_context(*context):
+            return func(*args, **kwargs)
+    return bound
+
+
+class TokenBucket(object):
+    """Limits API calls to ``rate`` per second with bursts of up to ``capacity``.
+
+    Interactive callers always go first, a background caller only takes a
+    token while no interactive caller is waiting. :meth:`pause` stops every
+    caller, e.g. after a 429 from the API. When ``state_path`` is set the
+    bucket and its waiting interactive callers live in that file, so all
+    workers of a host, the scheduler included, share one budget and a
+    background process yields to the web workers.
+    """
+
+    def __init__(self, rate, capacity, state_path=None, clock=time.time):
+        self.rate = rate
+        self.capacity = capacity
+        self.state_path = state_path
+        self.clock = clock
+        self._state = self._initial_state()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+
+    def _initial_state(self):
+        # waiters maps the interactive callers waiting for a token to when their wait ends
+        return {'tokens': self.capacity, 'updated_at': self.clock(), 'paused_until': 0.0, 'waiters': {}}
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        """Take a token, False when none became available within ``timeout`` seconds"""
+        if self.rate <= 0:
+            return True
+        deadline = None if timeout is None else self.clock() + timeout
+        waiter = '{}:{}'.format(os.getpid(), threading.get_ident())
+        acquired = False
+        try:
+            while True:
+                wait = self._take(priority, waiter)
+                if wait <= 0:
+                    acquired = True
+                    return True
+                if deadline is not None:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                with self._cond:
+                    self._cond.wait(wait)
+        finally:
+            if priority == INTERACTIVE:
+                if not acquired:
+                    with self._shared_state() as state:
+                        state.setdefault('waiters', {}).pop(waiter, None)
+                with self._cond:
+                    self._cond.notify_all()
+
+    def pause(self, seconds):
+        with self._shared_state() as state:
+            state['paused_until'] = max(state['paused_until'], self.clock() + seconds)
+
+    def _take(self, priority=INTERACTIVE, waiter=None):
+        """Take a token, returns 0 or the seconds to wait for the next one"""
+        with self._shared_state() as state:
+            now = self.clock()
+            waiters = state.setdefault('waiters', {})
+            for key in [k for k, until in waiters.items() if until <= now]:
+                # left behind by a worker that died while waiting
+                del waiters[key]
+            if priority != INTERACTIVE and len(waiters) > 0:
+                return 1.0 / self.rate
+            if state['paused_until'] > now:
+                wait = state['paused_until'] - now
+            else:
+                state['tokens'] = min(self.capacity, state['tokens'] + (now - state['updated_at']) * self.rate)
+                state['updated_at'] = now
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    waiters.pop(waiter, None)
+                    return 0
+                wait = (1 - state['tokens']) / self.rate
+            if priority == INTERACTIVE:
+                waiters[waiter] = now + wait + WAITER_GRACE_SECONDS
+            return wait
+
+    @contextmanager
+    def _shared_state(self):
+        with self._lock:
+            if self.state_path is None:
+                yield self._state
+                return
+            with open(self.state_path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    state = json.loads(content) if content else self._initial_state()
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class CircuitBreaker(object):
+    """Fails calls fast once ``failure_threshold`` calls in a row failed.
+
+    After ``reset_seconds`` the circuit is half open, up to ``half_open_calls``
+    probes per ``reset_seconds`` are let through, the first success closes
+    the circuit again and a failure keeps it open.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0, half_open_calls=1, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = self.clock()
+            if now - self._opened_at >= self.reset_seconds:
+                # a new probe period, probes lost in the previous one do not block it
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                self._probes = 0
+            if self.state == self.HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state == self.CLOSED:
+                    self._opened_at = self.clock()
+                self.state = self.OPEN
+
+
+def retry_after(headers):
+    """Seconds asked for by a Retry-After header, None when missing or malformed"""
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def backoff(attempt, base, cap):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
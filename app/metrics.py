@@ -0,0 +1,268 @@
+import glob
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+# seconds, from a cached API payload to a request running into its deadline
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def api_path_label(path):
+    """``api/players/123/wl`` becomes ``api/players/{id}/wl``, one series per endpoint instead of per player"""
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, _escape(v)) for n, v in pairs) + '}'
+
+
+def _number(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter(object):
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), v] for k, v in self._values.items()]
+
+    @staticmethod
+    def merge(snapshots):
+        total = {}
+        for snapshot in snapshots:
+            for k, v in snapshot:
+                total[tuple(k)] = total.get(tuple(k), 0) + v
+        return total
+
+    def expose(self, values):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        for k, v in sorted(values.items()):
+            lines.append('{}{} {}'.format(self.name, _labels(self.labels, k), _number(v)))
+        return lines
+
+
+class CounterFunc(Counter):
+    """A counter kept elsewhere, e.g. by a cache, read through ``func`` returning {label values: count}"""
+
+    def __init__(self, name, documentation, labels, func):
+        super().__init__(name, documentation, labels)
+        self.func = func
+
+    def inc(self, *label_values, amount=1):
+        raise TypeError('{} is read from its source'.format(self.name))
+
+    def snapshot(self):
+        return [[list(k), v] for k, v in self.func().items()]
+
+
+class Histogram(object):
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # one count per bucket, then the sum and the count of all observations
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), list(v)] for k, v in self._values.items()]
+
+    @staticmethod
+    def merge(snapshots):
+        total = {}
+        for snapshot in snapshots:
+            for k, v in snapshot:
+                counts = total.setdefault(tuple(k), [0] * len(v))
+                for i, n in enumerate(v):
+                    counts[i] += n
+        return total
+
+    def expose(self, values):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        for k, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(self.labels, k, [('le', _number(bound))]), _number(cumulative)
+                ))
+            lines.append('{}_bucket{} {}'.format(
+                self.name, _labels(self.labels, k, [('le', '+Inf')]), _number(counts[-1])
+            ))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.labels, k), _number(counts[-2])))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.labels, k), _number(counts[-1])))
+        return lines
+
+
+class Registry(object):
+    """In-process metrics, exposed in the Prometheus text format.
+
+    Every worker counts on its own. With ``state_dir`` set a worker dumps its
+    counts to ``<state_dir>/<pid>-<random id>.json`` at most every
+    ``flush_seconds`` and on every scrape, and a scrape sums the files of all
+    workers. Files of workers that exited are kept, and a new worker reusing
+    the pid of an old one writes a file of its own, so counters never go
+    backwards when gunicorn replaces a worker. Use a directory that is emptied
+    when the app restarts.
+    """
+
+    def __init__(self, state_dir=None, flush_seconds=5.0, clock=time.time):
+        self.state_dir = state_dir
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        self._metrics = []
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._path = None
+
+    @property
+    def path(self):
+        """The file of this worker, named on first use, forked workers must not share one"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._path = os.path.join(self.state_dir, '{}-{}.json'.format(self._pid, uuid.uuid4().hex))
+        return self._path
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def counter_func(self, name, documentation, labels, func):
+        return self._register(CounterFunc(name, documentation, labels, func))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        return dict((m.name, m.snapshot()) for m in self._metrics)
+
+    def flush(self, force=False):
+        """Dump the counts of this worker, skipped when done less than ``flush_seconds`` ago"""
+        if self.state_dir is None:
+            return
+        now = self.clock()
+        if not force and now - self._flushed_at < self.flush_seconds:
+            return
+        with self._lock:
+            self._flushed_at = now
+            os.makedirs(self.state_dir, exist_ok=True)
+            path = self.path
+            # written aside and renamed, a scrape never reads half a file
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+
+    def snapshots(self):
+        """Counts of every worker, this one included"""
+        if self.state_dir is None:
+            return [self.snapshot()]
+        self.flush(force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(self.state_dir, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # the file of a worker that was just replaced
+                continue
+        return snapshots
+
+    def expose(self):
+        snapshots = self.snapshots()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose(metric.merge([s.get(metric.name, []) for s in snapshots])))
+        return '\n'.join(lines) + '\n'
+
+
+def statement_kind(statement):
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return kind if kind in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') else 'OTHER'
+
+
+def instrument_engines(query_count, query_seconds):
+    """Count and time every SQL statement of every engine, cheap enough to stay on"""
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started_at = conn.info['query_started_at'].pop()
+        kind = statement_kind(statement)
+        query_count.inc(kind)
+        query_seconds.observe(time.perf_counter() - started_at, kind)
+
+    @event.listens_for(Engine, 'handle_error')
+    def handle_error(context):
+        # after_cursor_execute is skipped when the statement fails
+        started = context.connection.info.get('query_started_at') if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+registry = Registry(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_SECONDS'])
+
+http_request_seconds = registry.histogram(
+    'http_request_duration_seconds', 'Time to answer a request', ['route', 'method', 'status']
+)
+api_requests = registry.counter(
+    'opendota_requests_total', 'Calls to the OpenDota API by path and status', ['path', 'status']
+)
+api_request_seconds = registry.histogram(
+    'opendota_request_duration_seconds', 'Time of a call to the OpenDota API', ['path']
+)
+api_failures = registry.counter(
+    'opendota_failures_total', 'OpenDota payloads given up on by path and reason', ['path', 'reason']
+)
+db_queries = registry.counter('db_queries_total', 'SQL statements run by kind', ['kind'])
+db_query_seconds = registry.histogram('db_query_duration_seconds', 'Time of a SQL statement', ['kind'])
+
+instrument_engines(db_queries, db_query_seconds)
@@ -1,5 +1,11 @@
+import json
+import threading
+import time
+from collections import namedtuple
 from datetime import date
-from app import db
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from app import app, db
 
 
 class Player(db.Model):
@@ -67,15 +73,121 @@ class Hero(db.Model):
         )
 
 
+class HeroInfo(namedtuple('HeroInfo', [
+    'hero_id', 'name', 'localized_name', 'primary_attr', 'attack_type', 'roles', 'legs'
+])):
+    """A compact, immutable copy of a hero row"""
+    __slots__ = ()
+
+    def to_dict(self):
+        return dict(self._asdict())
+
+
+class HeroCatalog(object):
+    """A process wide, read mostly view of the hero table keyed by hero id.
+
+    Built lazily from the database on first use. :meth:`heroes` refreshes it
+    from the ``api/heroes`` payload when it is empty, older than ``ttl``
+    seconds or misses a hero id a caller needs.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._heroes = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def get(self, hero_id):
+        if self._loaded_at is None:
+            self._load()
+        return self._heroes.get(hero_id)
+
+    def heroes(self, fetch=None, hero_ids=()):
+        if self._loaded_at is None:
+            self._load()
+        heroes = self._heroes
+        if fetch is not None and (
+                len(heroes) == 0
+                or time.time() - self._loaded_at > self.ttl
+                or any(hero_id not in heroes for hero_id in hero_ids)
+        ):
+            heroes_json = fetch()
+            if heroes_json is None:
+                app.logger.warning("keep hero catalog of {} heroes, missing heroes json".format(len(heroes)))
+            else:
+                self.update(heroes_json)
+        return self._heroes
+
+    def update(self, heroes_json):
+        """Merge an ``api/heroes`` payload, unknown heroes are inserted in bulk"""
+        heroes = dict(self._heroes)
+        for h in json.loads(heroes_json):
+            heroes[h['id']] = HeroInfo(
+                hero_id=h['id'],
+                name=h['name'],
+                localized_name=h['localized_name'],
+                primary_attr=h['primary_attr'],
+                attack_type=h['attack_type'],
+                roles=",".join(h['roles']),
+                legs=h['legs']
+            )
+        with self._lock:
+            known_hero_ids = set(
+                h.hero_id for h in db.session.query(Hero.hero_id).filter(Hero.hero_id.in_(heroes.keys()))
+            )
+            try:
+                db.session.bulk_insert_mappings(Hero, [
+                    h.to_dict() for h in heroes.values() if h.hero_id not in known_hero_ids
+                ])
+                db.session.commit()
+            except IntegrityError:
+                # another worker inserted the same heroes first
+                db.session.rollback()
+            self._heroes = heroes
+            self._loaded_at = time.time()
+
+    def clear(self):
+        with self._lock:
+            self._heroes = {}
+            self._loaded_at = None
+
+    def _load(self):
+        with self._lock:
+            if self._loaded_at is not None:
+                return
+            self._heroes = dict(
+                (h.hero_id, HeroInfo(
+                    hero_id=h.hero_id,
+                    name=h.name,
+                    localized_name=h.localized_name,
+                    primary_attr=h.primary_attr,
+                    attack_type=h.attack_type,
+                    roles=h.roles,
+                    legs=h.legs
+                ))
+                for h in Hero.query.all()
+            )
+            self._loaded_at = time.time()
+
+
+hero_catalog = HeroCatalog(app.config['HERO_CATALOG_TTL'])
+
+
 class HeroScore(db.Model):
     """A Hero Score class"""
     __tablename__ = 'hero_score'
+    __table_args__ = (
+        # best heroes of a player's latest day, see services.get_top_hero_scores
+        db.Index('ix_hero_score_player_date_rank', 'player_id', 'score_date', 'hero_rank'),
+    )
 
     hero_score_id = db.Column(db.Integer, primary_key=True)
     rank_score = db.Column(db.Float(10))
     last_played_score = db.Column(db.Float(10))
     win_score = db.Column(db.Float(10))
     overall_score = db.Column(db.Float(10), nullable=False)
+    # 1 for the best hero of the player that day, set when the scores are written
+    hero_rank = db.Column(db.Integer)
     score_date = db.Column(db.Date, nullable=False,
                            default=date.today)
     player_id = db.Column(db.Integer, db.ForeignKey('player.account_id'),
@@ -94,11 +206,22 @@ class HeroScore(db.Model):
             'last_played_score': self.last_played_score,
             'win_score': self.win_score,
             'overall_score': self.overall_score,
+            'hero_rank': self.hero_rank,
             'score_date': str(self.score_date),
             'player': self.player.to_dict(),
-            'hero': self.hero.to_dict()
+            'hero': self.hero_info.to_dict()
         }
 
+    @property
+    def hero_info(self):
+        # prefer an already loaded relationship, then the catalog, never an extra query per row
+        hero = self.__dict__.get('hero')
+        if hero is None:
+            hero = hero_catalog.get(self.hero_id)
+        if hero is None:
+            hero = self.hero
+        return hero
+
     def get_overall_score(self):
         return self.rank_score * 0.5 + self.win_score * 0.45 + self.last_played_score * 0.05
 
@@ -117,6 +240,18 @@ class HeroScore(db.Model):
 class MatchScore(db.Model):
     """A Match Score class"""
     __tablename__ = 'match_score'
+    __table_args__ = (
+        # latest score of a player, see services.get_player_match_score_by_id,
+        # also serves today's scores of a list of players, see services.get_player_match_scores
+        db.Index('ix_match_score_player_date', 'player_id', 'score_date'),
+        # the global leaderboard of a day by each sort key, read backwards from a keyset cursor,
+        # see services.get_global_match_scores
+        db.Index('ix_match_score_date_week', 'score_date', 'week_score', 'match_score_id'),
+        db.Index('ix_match_score_date_month', 'score_date', 'month_score', 'match_score_id'),
+        db.Index('ix_match_score_date_year', 'score_date', 'year_score', 'match_score_id'),
+        db.Index('ix_match_score_date_count', 'score_date', 'overall_count', 'match_score_id'),
+        db.Index('ix_match_score_date_overall', 'score_date', 'overall_score', 'match_score_id'),
+    )
 
     match_score_id = db.Column(db.Integer, primary_key=True)
     week_score = db.Column(db.Float(10))
@@ -140,9 +275,14 @@ class MatchScore(db.Model):
             'overall_score': self.overall_score,
             'overall_count': self.overall_count,
             'score_date': str(self.score_date),
+            'age_days': self.age_days,
             'player': self.player.to_dict()
         }
 
+    @property
+    def age_days(self):
+        return (date.today() - self.score_date).days
+
     def get_compare_score(self, max_count):
         return (float(self.overall_count) / max_count) * 0.8 \
             + self.week_score * 0.1 + self.month_score * 0.05 \
@@ -160,3 +300,145 @@ class MatchScore(db.Model):
             self.year_score,
             self.overall_score
         )
+
+
+class ScoreStat(db.Model):
+    """A named statistic over the score tables, maintained as rows are inserted"""
+    __tablename__ = 'score_stat'
+
+    MAX_OVERALL_COUNT = 'max_overall_count'
+
+    name = db.Column(db.String, primary_key=True)
+    value = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<Score Stat %r>' % self.name
+
+    def __str__(self):
+        return 'Score Stat - name: {} value: {}'.format(
+            self.name,
+            self.value
+        )
+
+
+@event.listens_for(MatchScore, 'after_insert')
+def update_max_overall_count(mapper, connection, target):
+    # only raises an existing stat, it is seeded on first read, see services.get_max_overall_count
+    if target.overall_count is None:
+        return
+    connection.execute(
+        ScoreStat.__table__.update()
+        .where(ScoreStat.name == ScoreStat.MAX_OVERALL_COUNT)
+        .where(ScoreStat.value < target.overall_count)
+        .values(value=target.overall_count)
+    )
+
+
+class FetchLease(db.Model):
+    """A lease on a cold fetch, lets one worker load a player while others wait"""
+    __tablename__ = 'fetch_lease'
+
+    key = db.Column(db.String, primary_key=True)
+    owner = db.Column(db.String, nullable=False)
+    expires_at = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return '<Fetch Lease %r>' % self.key
+
+    def __str__(self):
+        return 'Fetch Lease - key: {} owner: {} expires at: {}'.format(
+            self.key,
+            self.owner,
+            self.expires_at
+        )
+
+
+class TrackedPlayer(db.Model):
+    """A recently viewed player, kept warm by the precompute scheduler"""
+    __tablename__ = 'tracked_player'
+
+    MATCH = 'match'
+    HERO = 'hero'
+
+    player_id = db.Column(db.Integer, primary_key=True)
+    match_accessed_at = db.Column(db.DateTime, index=True)
+    hero_accessed_at = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        return '<Tracked Player %r>' % self.player_id
+
+    def __str__(self):
+        return 'Tracked Player - player id: {} match accessed at: {} hero accessed at: {}'.format(
+            self.player_id,
+            self.match_accessed_at,
+            self.hero_accessed_at
+        )
+
+
+class MatchScoreRollup(db.Model):
+    """Match scores of a player over a week or month, averaged when the daily rows were compacted"""
+    __tablename__ = 'match_score_rollup'
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'period', 'period_start'),
+    )
+
+    WEEK = 'week'
+    MONTH = 'month'
+
+    match_score_rollup_id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.account_id'),
+                          nullable=False)
+    period = db.Column(db.String, nullable=False)
+    period_start = db.Column(db.Date, nullable=False)
+    days = db.Column(db.Integer, nullable=False)
+    week_score = db.Column(db.Float(10))
+    month_score = db.Column(db.Float(10))
+    year_score = db.Column(db.Float(10))
+    overall_score = db.Column(db.Float(10))
+    overall_count = db.Column(db.Integer)
+
+    def __repr__(self):
+        return '<Match Score Rollup %r>' % self.overall_score
+
+    def __str__(self):
+        return 'Match Score Rollup - player id: {} {} of {} days: {} overall: {}'.format(
+            self.player_id,
+            self.period,
+            self.period_start,
+            self.days,
+            self.overall_score
+        )
+
+
+class HeroScoreRollup(db.Model):
+    """Hero scores of a player over a week or month, averaged when the daily rows were compacted"""
+    __tablename__ = 'hero_score_rollup'
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'period', 'period_start', 'hero_id'),
+    )
+
+    hero_score_rollup_id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.account_id'),
+                          nullable=False)
+    hero_id = db.Column(db.Integer, db.ForeignKey('hero.hero_id'),
+                        nullable=False)
+    period = db.Column(db.String, nullable=False)
+    period_start = db.Column(db.Date, nullable=False)
+    days = db.Column(db.Integer, nullable=False)
+    rank_score = db.Column(db.Float(10))
+    last_played_score = db.Column(db.Float(10))
+    win_score = db.Column(db.Float(10))
+    overall_score = db.Column(db.Float(10))
+
+    def __repr__(self):
+        return '<Hero Score Rollup %r>' % self.overall_score
+
+    def __str__(self):
+        return 'Hero Score Rollup - hero id: {} player id: {} {} of {} days: {} overall: {}'.format(
+            self.hero_id,
+            self.player_id,
+            self.period,
+            self.period_start,
+            self.days,
+            self.overall_score
+        )
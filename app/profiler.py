@@ -0,0 +1,223 @@
+import cProfile
+import glob
+import json
+import os
+import pstats
+import re
+import threading
+import time
+
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+from app.limits import current_trace, set_trace
+
+PROFILE_SALT = 'profile'
+
+
+def _serializer():
+    secret = app.config['PROFILE_SECRET']
+    if not secret:
+        return None
+    return URLSafeTimedSerializer(secret, salt=PROFILE_SALT)
+
+
+def make_token():
+    """A token switching the profiler on for requests carrying it, valid for PROFILE_TOKEN_MAX_AGE seconds"""
+    serializer = _serializer()
+    if serializer is None:
+        raise RuntimeError('set PROFILE_SECRET to profile requests')
+    return serializer.dumps('profile')
+
+
+def valid_token(token):
+    # without a secret of its own nobody may profile, the session key may be the public default
+    serializer = _serializer()
+    if serializer is None:
+        return False
+    try:
+        return serializer.loads(token, max_age=app.config['PROFILE_TOKEN_MAX_AGE']) == 'profile'
+    except BadSignature:
+        return False
+
+
+class Trace(object):
+    """Timeline of the SQL statements and API calls of a request, from every thread it binds"""
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started_at = clock()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, kind, started_at, **details):
+        now = self.clock()
+        details.update(
+            kind=kind,
+            thread=threading.current_thread().name,
+            start_ms=round((started_at - self.started_at) * 1000.0, 3),
+            duration_ms=round((now - started_at) * 1000.0, 3)
+        )
+        with self._lock:
+            self.events.append(details)
+
+    def timeline(self):
+        with self._lock:
+            return sorted(self.events, key=lambda e: e['start_ms'])
+
+
+def trace_event(kind, started_at, **details):
+    """Record an event on the trace of this thread, if any"""
+    trace = current_trace()
+    if trace is not None:
+        trace.add(kind, started_at, **details)
+
+
+class RequestProfiler(object):
+    """Profiles the requests asking for it with a signed token.
+
+    The token goes in the ``X-Profile`` header or the ``profile`` query
+    parameter, see :func:`make_token`. ``X-Profile-Output`` or
+    ``profile_output`` picks ``json``, the report replaces the response, or
+    ``file``, the report and the cProfile stats are saved to ``profile_dir``
+    and the response names them in ``X-Profile-File``. Once ``profile_dir``
+    holds ``max_files`` reports the report is returned as JSON instead.
+    Executor threads are not profiled, their SQL statements and API calls
+    are on the timeline.
+    """
+
+    def __init__(self, profile_dir, top_functions=40, max_files=100):
+        self.profile_dir = profile_dir
+        self.top_functions = top_functions
+        self.max_files = max_files
+        self._local = threading.local()
+
+    def start(self, request):
+        token = request.headers.get('X-Profile') or request.args.get('profile')
+        if token is None:
+            return False
+        if not valid_token(token):
+            app.logger.warning('invalid profile token for {}'.format(request.path))
+            return False
+        self._local.output = request.headers.get('X-Profile-Output') or request.args.get('profile_output', 'json')
+        self._local.trace = Trace()
+        self._local.profile = cProfile.Profile()
+        set_trace(self._local.trace)
+        self._local.profile.enable()
+        return True
+
+    def stop(self):
+        """Stop profiling this thread, returns the profile and the trace, None when it was not profiled"""
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            return None
+        profile.disable()
+        set_trace(None)
+        trace = self._local.trace
+        self._local.profile = self._local.trace = None
+        return profile, trace
+
+    def finish(self, request, response):
+        output = getattr(self._local, 'output', 'json')
+        stopped = self.stop()
+        if stopped is None:
+            return response
+        profile, trace = stopped
+        report = self.report(request, response, profile, trace)
+        if output == 'file':
+            name = self.save(request, report, profile)
+            if name is not None:
+                response.headers['X-Profile-File'] = name
+                return response
+        return app.response_class(
+            json.dumps(report, indent=2), mimetype='application/json', headers={'Cache-Control': 'no-store'}
+        )
+
+    def report(self, request, response, profile, trace):
+        stats = pstats.Stats(profile)
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        timeline = trace.timeline()
+        return {
+            'method': request.method,
+            'path': request.full_path,
+            'status': response.status_code,
+            'total_ms': round((trace.clock() - trace.started_at) * 1000.0, 3),
+            'sql': self.summary(timeline, 'sql'),
+            'commits': self.summary(timeline, 'commit')['count'],
+            'api': self.summary(timeline, 'api'),
+            'functions': [
+                {
+                    'function': '{}:{}({})'.format(*key),
+                    'calls': calls,
+                    'primitive_calls': primitive_calls,
+                    'total_ms': round(total * 1000.0, 3),
+                    'cumulative_ms': round(cumulative * 1000.0, 3)
+                }
+                for key, (primitive_calls, calls, total, cumulative, _) in functions[:self.top_functions]
+            ],
+            'timeline': timeline
+        }
+
+    @staticmethod
+    def summary(timeline, kind):
+        events = [e for e in timeline if e['kind'] == kind]
+        return {'count': len(events), 'total_ms': round(sum(e['duration_ms'] for e in events), 3)}
+
+    def save(self, request, report, profile):
+        """Write ``<name>.json`` and ``<name>.prof`` (for pstats or snakeviz), returns the name,
+        None when ``profile_dir`` is full"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if len(glob.glob(os.path.join(self.profile_dir, '*.json'))) >= self.max_files:
+            app.logger.warning('{} holds {} profiles, not saving more'.format(self.profile_dir, self.max_files))
+            return None
+        name = '{}-{}{}'.format(
+            time.strftime('%Y%m%d-%H%M%S'),
+            re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-') or 'index',
+            '-{}'.format(os.getpid())
+        )
+        with open(os.path.join(self.profile_dir, name + '.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        profile.dump_stats(os.path.join(self.profile_dir, name + '.prof'))
+        return name
+
+
+def _statement(statement, limit=500):
+    statement = ' '.join(statement.split())
+    return statement if len(statement) <= limit else statement[:limit] + '...'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profile_started_at', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started_at = conn.info['profile_started_at'].pop()
+    seconds = time.perf_counter() - started_at
+    # the slow query log is always on, it only costs a comparison per statement
+    threshold = app.config['SLOW_QUERY_SECONDS']
+    if 0 < threshold <= seconds:
+        app.logger.warning('slow query {:.1f} ms: {} {}'.format(
+            seconds * 1000.0, _statement(statement), _statement(repr(parameters), 200)
+        ))
+    trace_event('sql', started_at, statement=_statement(statement), rows=cursor.rowcount)
+
+
+@event.listens_for(Engine, 'commit')
+def commit(conn):
+    trace_event('commit', time.perf_counter())
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    started = context.connection.info.get('profile_started_at') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+request_profiler = RequestProfiler(
+    app.config['PROFILE_DIR'], app.config['PROFILE_TOP_FUNCTIONS'], app.config['PROFILE_MAX_FILES']
+)
@@ -0,0 +1,103 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+
+from app import app, db
+from app.models import MatchScore, HeroScore, TrackedPlayer
+from app.apis import get_dota_open_api
+from app.limits import priority, BACKGROUND
+from app.services import refresh_player_scores
+
+
+class Scheduler(object):
+    """Keeps the scores of recently viewed players warm across the date rollover.
+
+    A player viewed in the last ``track_days`` days is tracked, see
+    :class:`app.services.AccessTracker`. Within ``lead_seconds`` of midnight
+    the scores of tomorrow are stored ahead of time, otherwise missing scores
+    of today are filled in. At most ``max_workers`` players are loaded at once
+    and a new one is started every ``pace_seconds``, so the scheduler never
+    competes with interactive requests for the API.
+    """
+
+    def __init__(self, lead_seconds, track_days, max_workers, pace_seconds, interval,
+                 clock=datetime.now, func=get_dota_open_api):
+        self.lead_seconds = lead_seconds
+        self.track_days = track_days
+        self.max_workers = max_workers
+        self.pace_seconds = pace_seconds
+        self.interval = interval
+        self.clock = clock
+        self.func = func
+
+    def target_date(self):
+        now = self.clock()
+        tomorrow = now.date() + timedelta(days=1)
+        if datetime.combine(tomorrow, datetime.min.time()) - now <= timedelta(seconds=self.lead_seconds):
+            return tomorrow
+        return now.date()
+
+    def due_players(self, score_date):
+        """Tracked players missing a score of ``score_date``, as a list of (player id, kinds)"""
+        since = self.clock() - timedelta(days=self.track_days)
+        match_due = and_(
+            TrackedPlayer.match_accessed_at >= since,
+            ~MatchScore.query
+            .filter(MatchScore.player_id == TrackedPlayer.player_id)
+            .filter(MatchScore.score_date == score_date)
+            .exists()
+        )
+        hero_due = and_(
+            TrackedPlayer.hero_accessed_at >= since,
+            ~HeroScore.query
+            .filter(HeroScore.player_id == TrackedPlayer.player_id)
+            .filter(HeroScore.score_date == score_date)
+            .exists()
+        )
+        rows = db.session.query(TrackedPlayer.player_id, match_due, hero_due) \
+            .filter(or_(match_due, hero_due)) \
+            .order_by(TrackedPlayer.player_id) \
+            .all()
+        db.session.remove()
+        return [
+            (player_id, [kind for kind, due in [(TrackedPlayer.MATCH, m), (TrackedPlayer.HERO, h)] if due])
+            for player_id, m, h in rows
+        ]
+
+    def refresh(self, player_id, score_date, kinds):
+        with app.app_context(), priority(BACKGROUND):
+            try:
+                refresh_player_scores(player_id, score_date, kinds, self.func)
+            except Exception as e:
+                # one broken player never stops the run
+                app.logger.warning("precompute of {} failed: {}".format(player_id, e))
+
+    def run_once(self):
+        score_date = self.target_date()
+        due = self.due_players(score_date)
+        app.logger.info("precompute {} players for {}".format(len(due), score_date))
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='precompute') as executor:
+            for i, (player_id, kinds) in enumerate(due):
+                if i > 0:
+                    time.sleep(self.pace_seconds)
+                executor.submit(self.refresh, player_id, score_date, kinds)
+        return len(due)
+
+    def run_forever(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                app.logger.warning("precompute run failed: {}".format(e))
+            time.sleep(self.interval)
+
+
+scheduler = Scheduler(
+    lead_seconds=app.config['SCHEDULER_LEAD_SECONDS'],
+    track_days=app.config['SCHEDULER_TRACK_DAYS'],
+    max_workers=app.config['SCHEDULER_MAX_WORKERS'],
+    pace_seconds=app.config['SCHEDULER_PACE_SECONDS'],
+    interval=app.config['SCHEDULER_INTERVAL']
+)
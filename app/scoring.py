@@ -0,0 +1,85 @@
+from collections import namedtuple
+from itertools import chain
+from operator import itemgetter
+
+import numpy as np
+
+# keep in line with HeroScore.get_overall_score
+RANK_WEIGHT = 0.5
+WIN_WEIGHT = 0.45
+LAST_PLAYED_WEIGHT = 0.05
+
+HeroScores = namedtuple('HeroScores', ['hero_ids', 'rank', 'win', 'last_played', 'overall'])
+
+
+def score_players(hero_ids, players):
+    """Score many players against the same hero index in a few array operations.
+
+    ``hero_ids`` is the list of heroes to score, ``players`` a list of
+    ``(hero_match_list, hero_ranking_list)`` holding the parsed
+    ``api/players/{id}/heroes`` and ``api/players/{id}/rankings`` payloads.
+    Returns :class:`HeroScores` with one row per player and one column per hero.
+    A player without any win or any last played time scores 0 for that part.
+    """
+    hero_ids = np.asarray(hero_ids, dtype=np.int64)
+    order = np.argsort(hero_ids, kind='mergesort')
+    sorted_ids = hero_ids[order]
+    n_players, n_heroes = len(players), len(hero_ids)
+
+    # flatten the payloads of all players, NOTE: hero_id is a string in the player hero API
+    matches = list(chain.from_iterable(m for m, _ in players))
+    match_player = np.repeat(np.arange(n_players), [len(m) for m, _ in players])
+    match_hero = np.fromiter(map(int, map(itemgetter('hero_id'), matches)), np.int64, len(matches))
+    match_win = np.fromiter(map(itemgetter('win'), matches), np.float64, len(matches))
+    match_last_played = np.fromiter(map(itemgetter('last_played'), matches), np.float64, len(matches))
+    rankings = list(chain.from_iterable(r for _, r in players))
+    rank_player = np.repeat(np.arange(n_players), [len(r) for _, r in players])
+    rank_hero = np.fromiter(map(int, map(itemgetter('hero_id'), rankings)), np.int64, len(rankings))
+    rank_percent = np.fromiter(map(itemgetter('percent_rank'), rankings), np.float64, len(rankings))
+
+    # normalizers cover every played hero, scored or not
+    max_win = np.zeros(n_players)
+    np.maximum.at(max_win, match_player, match_win)
+    max_last_played = np.zeros(n_players)
+    np.maximum.at(max_last_played, match_player, match_last_played)
+
+    win = np.zeros((n_players, n_heroes))
+    last_played = np.zeros((n_players, n_heroes))
+    column, known = _align(sorted_ids, order, match_hero)
+    cell = (match_player[known], column[known])
+    win[cell] = _normalize(match_win, max_win, match_player)[known]
+    last_played[cell] = _normalize(match_last_played, max_last_played, match_player)[known]
+    rank = np.zeros((n_players, n_heroes))
+    column, known = _align(sorted_ids, order, rank_hero)
+    rank[rank_player[known], column[known]] = rank_percent[known]
+
+    overall = rank * RANK_WEIGHT + win * WIN_WEIGHT + last_played * LAST_PLAYED_WEIGHT
+    return HeroScores(hero_ids, rank, win, last_played, overall)
+
+
+def score_player(hero_ids, hero_match_list, hero_ranking_list):
+    """Score a single player, every array of the result has one value per hero"""
+    scores = score_players(hero_ids, [(hero_match_list, hero_ranking_list)])
+    return HeroScores(scores.hero_ids, scores.rank[0], scores.win[0],
+                      scores.last_played[0], scores.overall[0])
+
+
+def _align(sorted_ids, order, hero):
+    """Column of every hero id in the index, and a mask of the ids the index knows"""
+    if len(sorted_ids) == 0:
+        return np.zeros(len(hero), dtype=np.int64), np.zeros(len(hero), dtype=bool)
+    position = np.minimum(np.searchsorted(sorted_ids, hero), len(sorted_ids) - 1)
+    return order[position], sorted_ids[position] == hero
+
+
+def _normalize(values, maxima, player):
+    maxima = maxima[player]
+    return np.divide(values, maxima, out=np.zeros_like(values), where=maxima > 0)
+
+
+def rank_heroes(overall, hero_ids):
+    """Rank of every hero, 1 for the best overall score, ties go to the lower hero id"""
+    order = np.lexsort((np.asarray(hero_ids), -np.asarray(overall)))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(1, len(order) + 1)
+    return rank
@@ -1,9 +1,32 @@
+import base64
 import json
-from datetime import date
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, contains_eager
 
 from app import app, db
-from app.models import Player, MatchScore, HeroScore, Hero
-from app.apis import get_dota_open_api
+from app.models import Player, Hero, MatchScore, HeroScore, ScoreStat, TrackedPlayer, hero_catalog
+from app.apis import get_dota_open_api, get_dota_open_api_all
+from app.flights import single_flight
+from app.limits import priority, bind, call_context, BACKGROUND
+from app.scoring import score_player, rank_heroes
+
+# loads several players at once, each player fans out to the api executor
+player_executor = ThreadPoolExecutor(
+    max_workers=app.config['PLAYER_MAX_WORKERS'],
+    thread_name_prefix='player-loader'
+)
+# completes the players a request with a budget stopped waiting for, never takes a slot of player_executor
+completion_executor = ThreadPoolExecutor(
+    max_workers=app.config['COMPLETION_MAX_WORKERS'],
+    thread_name_prefix='player-completion'
+)
 
 
 def accept_json(request):
@@ -27,19 +50,62 @@ def sort_score_list(score_list, sort_by):
         return sorted(score_list, key=lambda s: s.overall_score, reverse=True)
 
 
-def get_match_score_from_json(
-        player_json,
-        week_json,
-        month_json,
-        year_json,
-        overall_json,
-        player_id
-):
-    w_dict = json.loads(week_json)
-    m_dict = json.loads(month_json)
-    y_dict = json.loads(year_json)
-    o_dict = json.loads(overall_json)
-    # TODO: player might not present when another client is accessing, need a lock here
+SORT_COLUMNS = {
+    'W': MatchScore.week_score,
+    'M': MatchScore.month_score,
+    'Y': MatchScore.year_score,
+    'C': MatchScore.overall_count,
+    'O': MatchScore.overall_score
+}
+
+
+def encode_cursor(sort_by, score_date, score, rank):
+    """An opaque cursor to the scores ranked after ``score``"""
+    position = [sort_by, score_date.isoformat(), getattr(score, SORT_COLUMNS[sort_by].key), score.match_score_id, rank]
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort_by, score_date):
+    """The (value, match score id, rank) of a cursor, raises ValueError when malformed or of another ranking"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+        cursor_sort_by, cursor_date, value, match_score_id, rank = position
+    except (TypeError, ValueError, UnicodeDecodeError, base64.binascii.Error) as e:
+        raise ValueError('invalid cursor: {}'.format(e))
+    if [cursor_sort_by, cursor_date] != [sort_by, score_date.isoformat()]:
+        raise ValueError('cursor of another ranking')
+    if not isinstance(value, (int, float)) or not isinstance(match_score_id, int) or not isinstance(rank, int):
+        raise ValueError('invalid cursor position')
+    return value, match_score_id, rank
+
+
+def get_global_match_scores(score_date, sort_by='O', after=None, limit=50):
+    """A page of the scores of every player on ``score_date`` ranked by ``sort_by``, as (rank, score) pairs,
+    and the cursor of the next page or None.
+
+    The page is read off the (score_date, sort column, match_score_id) index
+    right after the ``after`` cursor, a deep page costs as much as the first.
+    """
+    column = SORT_COLUMNS[sort_by]
+    query = MatchScore.query \
+        .join(MatchScore.player) \
+        .options(contains_eager(MatchScore.player)) \
+        .filter(MatchScore.score_date == score_date) \
+        .filter(column.isnot(None))
+    rank = 0
+    if after is not None:
+        value, match_score_id, rank = decode_cursor(after, sort_by, score_date)
+        query = query.filter(tuple_(column, MatchScore.match_score_id) < tuple_(value, match_score_id))
+    # one row more tells whether there is a next page
+    scores = query.order_by(column.desc(), MatchScore.match_score_id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(scores) > limit:
+        scores = scores[:limit]
+        next_cursor = encode_cursor(sort_by, score_date, scores[-1], rank + limit)
+    return [(rank + i + 1, score) for i, score in enumerate(scores)], next_cursor
+
+
+def get_player_from_json(player_json, player_id):
     player = Player.query.filter(Player.account_id == player_id).first()
     if player is None:
         p_dict = json.loads(player_json)
@@ -51,9 +117,26 @@ def get_match_score_from_json(
             avatar=p_dict['profile']['avatar']
         )
         db.session.add(player)
-        db.session.commit()
+    return player
+
+
+def get_match_score_from_json(
+        player_json,
+        week_json,
+        month_json,
+        year_json,
+        overall_json,
+        player_id,
+        score_date=None
+):
+    w_dict = json.loads(week_json)
+    m_dict = json.loads(month_json)
+    y_dict = json.loads(year_json)
+    o_dict = json.loads(overall_json)
+    player = get_player_from_json(player_json, player_id)
     score = MatchScore(
-        player=player
+        player=player,
+        score_date=score_date or date.today()
     )
     w_total = w_dict['win'] + w_dict['lose']
     if w_total == 0:
@@ -79,76 +162,202 @@ def get_match_score_from_json(
     return score
 
 
-def fetch_player_match_score(player_id, func=get_dota_open_api):
-    player_json = func('api/players/{}'.format(player_id))
+def fetch_player_match_json(player_id, func=get_dota_open_api):
+    player_json, week_json, month_json, year_json, overall_json = get_dota_open_api_all([
+        ('api/players/{}'.format(player_id), None),
+        ('api/players/{}/wl'.format(player_id), {'date': 7}),
+        ('api/players/{}/wl'.format(player_id), {'date': 30}),
+        ('api/players/{}/wl'.format(player_id), {'date': 365}),
+        ('api/players/{}/wl'.format(player_id), None)
+    ], func=func)
     if player_json is None:
         app.logger.warning("Missing player json for {}".format(player_id))
         return None
-    week_json = func('api/players/{}/wl'.format(player_id), params={'date': 7})
     if week_json is None:
         app.logger.warning("Missing week json for {}".format(player_id))
         return None
-    month_json = func('api/players/{}/wl'.format(player_id), params={'date': 30})
     if month_json is None:
         app.logger.warning("Missing month json for {}".format(player_id))
         return None
-    year_json = func('api/players/{}/wl'.format(player_id), params={'date': 365})
     if year_json is None:
         app.logger.warning("Missing year json for {}".format(player_id))
         return None
-    overall_json = func('api/players/{}/wl'.format(player_id))
     if overall_json is None:
         app.logger.warning("missing overall json for {}".format(player_id))
         return None
-    return get_match_score_from_json(
-        player_json,
-        week_json,
-        month_json,
-        year_json,
-        overall_json,
-        player_id
-    )
+    return player_json, week_json, month_json, year_json, overall_json
+
+
+def fetch_player_match_score(player_id, func=get_dota_open_api):
+    match_json = fetch_player_match_json(player_id, func)
+    if match_json is None:
+        return None
+    return get_match_score_from_json(*match_json, player_id)
+
 
+def fetch_player_match_jsons(player_id_list, func=get_dota_open_api):
+    # API payloads of all players are loaded in parallel
+    futures = [
+        (player_id, player_executor.submit(bind(fetch_player_match_json), player_id, func))
+        for player_id in player_id_list
+    ]
+    match_json_list = []
+    for player_id, future in futures:
+        match_json = future.result()
+        if match_json is None:
+            app.logger.warning("missing score data for {}".format(player_id))
+            continue
+        match_json_list.append((player_id, match_json))
+    return match_json_list
+
+
+def save_player_match_scores(match_json_list, score_date=None):
+    # one transaction, retried once when a concurrent fetch of another kind inserted a player
+    for retry in [True, False]:
+        score_list = [
+            get_match_score_from_json(*match_json, player_id, score_date)
+            for player_id, match_json in match_json_list
+        ]
+        db.session.add_all(score_list)
+        try:
+            db.session.commit()
+            return score_list
+        except IntegrityError:
+            db.session.rollback()
+            if not retry:
+                raise
 
-def get_player_match_scores(player_id_list):
-    player_score_list = MatchScore.query \
+
+def get_todays_match_scores(player_id_list):
+    return MatchScore.query \
+        .options(joinedload(MatchScore.player)) \
         .filter(MatchScore.score_date == date.today()) \
         .filter(MatchScore.player_id.in_(player_id_list)) \
         .order_by(MatchScore.overall_score.desc()) \
         .all()
+
+
+def get_recent_match_scores(player_id_list, oldest):
+    """The latest score of every player, scores older than ``oldest`` are ignored.
+
+    Scores the scheduler stored ahead of time are not served before their day.
+    """
+    latest = {}
+    for score in MatchScore.query \
+            .options(joinedload(MatchScore.player)) \
+            .filter(MatchScore.player_id.in_(player_id_list)) \
+            .filter(MatchScore.score_date >= oldest) \
+            .filter(MatchScore.score_date <= date.today()) \
+            .order_by(MatchScore.score_date.desc()):
+        latest.setdefault(score.player_id, score)
+    return list(latest.values())
+
+
+def get_player_match_scores(player_id_list, func=get_dota_open_api, max_age=0, grace=0):
+    """Scores up to ``max_age`` days old are served as is, scores up to ``grace`` days older
+    are served while refreshed in the background, the others are loaded before returning"""
+    oldest = date.today() - timedelta(days=max_age + grace)
+    player_score_list = get_recent_match_scores(player_id_list, oldest)
+    background_refresher.submit(
+        [s.player_id for s in player_score_list if s.age_days > max_age], TrackedPlayer.MATCH, func
+    )
     if len(player_score_list) == len(player_id_list):
         return player_score_list
     # only fetch from API if id is not in database
-    player_id_list = set(player_id_list) - set([p.player_id for p in player_score_list])
-    app.logger.info("load match score from API for " + str(player_id_list))
-    for player_id in player_id_list:
-        score = fetch_player_match_score(player_id)
-        if score is None:
-            app.logger.warning("missing score data for {}".format(player_id))
-            continue
-        # save to db
-        db.session.add(score)
-        db.session.commit()
-        # add to list
-        player_score_list.append(score)
-    return player_score_list
+    missing = set(player_id_list) - set([p.player_id for p in player_score_list])
+    app.logger.info("load match score from API for " + str(missing))
+    # load the players nobody else is loading, wait for the others
+    leading = set(p for p in missing if single_flight.try_acquire('match:{}'.format(p)))
+    try:
+        if len(leading) > 0:
+            # a flight might have landed since the first query
+            landed = set(p.player_id for p in get_todays_match_scores(leading))
+            save_player_match_scores(fetch_player_match_jsons(leading - landed, func))
+    finally:
+        for player_id in leading:
+            single_flight.release('match:{}'.format(player_id))
+    for player_id in missing - leading:
+        single_flight.wait('match:{}'.format(player_id))
+    # the commit expired the rows loaded so far, one query beats a refresh per row
+    return get_recent_match_scores(player_id_list, oldest)
 
 
-def get_player_match_score_by_id(player_id):
-    score = MatchScore.query\
+def load_match_score_in_background(player_id, oldest, func=get_dota_open_api):
+    try:
+        # outlives the request, yields the API to interactive callers and gives up in time
+        deadline = time.time() + app.config['COMPLETION_DEADLINE_SECONDS']
+        with app.app_context(), call_context(BACKGROUND, deadline):
+            single_flight.do(
+                'match:{}'.format(player_id),
+                lambda: load_player_match_score(player_id, func, oldest),
+                lambda: None
+            )
+    except Exception as e:
+        app.logger.warning("background load of {} failed: {}".format(player_id, e))
+
+
+def get_partial_player_match_scores(player_id_list, budget, func=get_dota_open_api, max_age=0, grace=0):
+    """Like :func:`get_player_match_scores`, but returns within ``budget`` seconds.
+
+    Returns the scores loaded in time and the ids of the players still
+    loading, their scores are stored in the background for a later request.
+    """
+    start = time.time()
+    oldest = date.today() - timedelta(days=max_age + grace)
+    player_score_list = get_recent_match_scores(player_id_list, oldest)
+    background_refresher.submit(
+        [s.player_id for s in player_score_list if s.age_days > max_age], TrackedPlayer.MATCH, func
+    )
+    missing = set(player_id_list) - set(s.player_id for s in player_score_list)
+    if len(missing) == 0:
+        return player_score_list, []
+    app.logger.info("load match score from API for " + str(missing))
+    loading = dict(
+        (completion_executor.submit(load_match_score_in_background, player_id, oldest, func), player_id)
+        for player_id in missing
+    )
+    done, not_done = futures.wait(loading, timeout=max(budget - (time.time() - start), 0))
+    if len(done) > 0:
+        player_score_list += get_recent_match_scores([loading[f] for f in done], oldest)
+    return player_score_list, sorted(loading[f] for f in not_done)
+
+
+def get_latest_match_score(player_id):
+    return MatchScore.query\
+        .options(joinedload(MatchScore.player))\
         .filter(MatchScore.player_id == player_id)\
+        .filter(MatchScore.score_date <= date.today())\
         .order_by(MatchScore.score_date.desc())\
         .first()
-    if score is not None:
+
+
+def load_player_match_score(player_id, func=get_dota_open_api, oldest=date.min):
+    # a flight might have landed since the first query
+    score = get_latest_match_score(player_id)
+    if score is not None and score.score_date >= oldest:
         return score
-    app.logger.info("load match score from API for " + str(player_id))
-    score = fetch_player_match_score(player_id)
-    if score is None:
+    match_json = fetch_player_match_json(player_id, func)
+    if match_json is None:
         return None
-    # save to db
-    db.session.add(score)
-    db.session.commit()
-    return score
+    save_player_match_scores([(player_id, match_json)])
+    return get_latest_match_score(player_id)
+
+
+def get_player_match_score_by_id(player_id, func=get_dota_open_api, max_age=0, grace=0):
+    """Same freshness policy as :func:`get_player_match_scores`"""
+    oldest = date.today() - timedelta(days=max_age + grace)
+    score = get_latest_match_score(player_id)
+    if score is not None and score.score_date >= oldest:
+        if score.age_days > max_age:
+            background_refresher.submit([player_id], TrackedPlayer.MATCH, func)
+        return score
+    app.logger.info("load match score from API for " + str(player_id))
+    # an outdated score still beats no score when the API is down
+    return single_flight.do(
+        'match:{}'.format(player_id),
+        lambda: load_player_match_score(player_id, func, oldest),
+        lambda: get_latest_match_score(player_id)
+    ) or score
 
 
 def populate_player_hero_scores_from_json(
@@ -156,119 +365,307 @@ def populate_player_hero_scores_from_json(
         hero_match_json,
         heroes_json,
         player_json,
-        player_id
+        player_id,
+        score_date=None
 ):
-    hs_dict = {}
-    for h in json.loads(heroes_json):
-        hs_dict[h['id']] = h
+    if heroes_json is None:
+        hs_dict = hero_catalog.heroes()
+    else:
+        hero_catalog.update(heroes_json)
+        hs_dict = dict((h['id'], h) for h in json.loads(heroes_json))
     app.logger.info("heroes dict: {}".format(hs_dict))
-    hm_dict = {}
-    max_win = -1
-    max_last_played = -1
-    for hm in json.loads(hero_match_json):
-        # NOTE: in player hero API, hero_id is string type, wired! :(
-        hm_dict[int(hm['hero_id'])] = hm
-        if max_win < hm['win']:
-            max_win = hm['win']
-        if max_last_played < hm['last_played']:
-            max_last_played = hm['last_played']
-    app.logger.info("hero match dict: {}".format(hm_dict))
-    hr_dict = {}
-    for hr in json.loads(hero_ranking_json):
-        hr_dict[hr['hero_id']] = hr
-    app.logger.info("hero rank dict: {}".format(hm_dict))
-    # TODO: player might not present when another client is accessing, need a lock here
-    player = Player.query.filter(Player.account_id == player_id).first()
-    if player is None:
-        p_dict = json.loads(player_json)
-        player = Player(
-            account_id=p_dict['profile']['account_id'],
-            steam_id=p_dict['profile']['steamid'],
-            personaname=p_dict['profile']['personaname'],
-            name=p_dict['profile']['name'],
-            avatar=p_dict['profile']['avatar']
+    hero_match_list = json.loads(hero_match_json)
+    app.logger.info("hero match list: {}".format(hero_match_list))
+    hero_ranking_list = json.loads(hero_ranking_json)
+    app.logger.info("hero rank list: {}".format(hero_ranking_list))
+    try:
+        player = get_player_from_json(player_json, player_id)
+        # bulk inserts below bypass the unit of work, the player row must exist first
+        db.session.flush()
+    except IntegrityError:
+        # inserted by a concurrent fetch of another kind, e.g. the match score flight
+        db.session.rollback()
+        player = get_player_from_json(player_json, player_id)
+    db.session.bulk_insert_mappings(
+        HeroScore,
+        get_hero_score_mappings(
+            player.account_id, list(hs_dict.keys()), hero_match_list, hero_ranking_list, score_date
         )
-        db.session.add(player)
-        db.session.commit()
-    for hero_id in hs_dict.keys():
-        hero = Hero.query.filter(Hero.hero_id == hero_id).first()
-        if hero is None:
-            hero = Hero(
-                hero_id=hero_id,
-                name=hs_dict[hero_id]['name'],
-                localized_name=hs_dict[hero_id]['localized_name'],
-                primary_attr=hs_dict[hero_id]['primary_attr'],
-                attack_type=hs_dict[hero_id]['attack_type'],
-                roles=",".join(hs_dict[hero_id]['roles']),
-                legs=hs_dict[hero_id]['legs']
-            )
-            db.session.add(hero)
-            db.session.commit()
-        hero_score = HeroScore(
-            player=player,
-            hero=hero
+    )
+    db.session.commit()
+
+
+def get_hero_score_mappings(player_id, hero_ids, hero_match_list, hero_ranking_list, score_date=None):
+    """Hero score rows of a player ready for a bulk insert"""
+    scores = score_player(hero_ids, hero_match_list, hero_ranking_list)
+    # the ranking is materialized here so top heroes are read off the index in order
+    hero_ranks = rank_heroes(scores.overall, scores.hero_ids)
+    return [
+        {
+            'player_id': player_id,
+            'hero_id': hero_id,
+            'score_date': score_date or date.today(),
+            'rank_score': rank_score,
+            'win_score': win_score,
+            'last_played_score': last_played_score,
+            'overall_score': overall_score,
+            'hero_rank': hero_rank
+        }
+        for hero_id, rank_score, win_score, last_played_score, overall_score, hero_rank in zip(
+            scores.hero_ids.tolist(),
+            scores.rank.tolist(),
+            scores.win.tolist(),
+            scores.last_played.tolist(),
+            scores.overall.tolist(),
+            hero_ranks.tolist()
         )
-        if hero_id not in hm_dict:
-            hero_score.last_played_score = 0.0
-            hero_score.win_score = 0.0
-        else:
-            last_played = hm_dict[hero_id]['last_played']
-            hero_score.last_played_score = float(last_played) / max_last_played
-            win = hm_dict[hero_id]['win']
-            hero_score.win_score = float(win) / max_win
-        if hero_id not in hr_dict:
-            hero_score.rank_score = 0.0
-        else:
-            hero_score.rank_score = hr_dict[hero_id]['percent_rank']
-        hero_score.overall_score = hero_score.get_overall_score()
-        db.session.add(hero_score)
-        db.session.commit()
+    ]
 
 
-def fetch_player_hero_scores(player_id, func=get_dota_open_api):
+def fetch_player_hero_json(player_id, func=get_dota_open_api):
     hero_ranking_json = func('api/players/{}/rankings'.format(player_id))
     if hero_ranking_json is None:
         app.logger.warning("missing hero ranking json for {}".format(player_id))
-        return
+        return None
     hero_match_json = func('api/players/{}/heroes'.format(player_id))
     if hero_match_json is None:
         app.logger.warning("missing hero match json for {}".format(player_id))
-        return
-    # TODO: lazy load heroes data and player data
-    heroes_json = func('api/heroes')
-    if heroes_json is None:
+        return None
+    # heroes are only fetched when the catalog is empty, expired or misses a played hero
+    heroes = hero_catalog.heroes(
+        fetch=lambda: func('api/heroes'),
+        hero_ids=[int(hm['hero_id']) for hm in json.loads(hero_match_json)]
+    )
+    if len(heroes) == 0:
         app.logger.warning("missing heroes json")
-        return
+        return None
+    # TODO: lazy load player data
     player_json = func('api/players/{}'.format(player_id))
     if player_json is None:
         app.logger.warning("Missing player json for {}".format(player_id))
+        return None
+    return hero_ranking_json, hero_match_json, player_json
+
+
+def fetch_player_hero_scores(player_id, func=get_dota_open_api, score_date=None):
+    hero_json = fetch_player_hero_json(player_id, func)
+    if hero_json is None:
         return
+    hero_ranking_json, hero_match_json, player_json = hero_json
     populate_player_hero_scores_from_json(
         hero_ranking_json,
         hero_match_json,
-        heroes_json,
+        None,
         player_json,
-        player_id
+        player_id,
+        score_date
     )
 
 
-def get_player_hero_score_by_id(player_id):
-    score = HeroScore.query\
+def get_top_hero_scores(player_id, k=1, role=None, primary_attr=None):
+    """The ``k`` best heroes of the latest day the player was scored, optionally of a role or attribute"""
+    latest = db.session.query(db.func.max(HeroScore.score_date)) \
         .filter(HeroScore.player_id == player_id) \
-        .order_by(HeroScore.score_date.desc()) \
-        .order_by(HeroScore.overall_score.desc())\
-        .first()
+        .filter(HeroScore.score_date <= date.today()) \
+        .as_scalar()
+    query = HeroScore.query \
+        .join(HeroScore.hero) \
+        .options(joinedload(HeroScore.player), contains_eager(HeroScore.hero)) \
+        .filter(HeroScore.player_id == player_id) \
+        .filter(HeroScore.score_date == latest)
+    if role is None and primary_attr is None:
+        query = query.filter(HeroScore.hero_rank <= k)
+    if role is not None:
+        # roles are stored comma separated
+        query = query.filter((',' + Hero.roles + ',').ilike('%,{},%'.format(role)))
+    if primary_attr is not None:
+        query = query.filter(Hero.primary_attr == primary_attr)
+    return query.order_by(HeroScore.hero_rank).limit(k).all()
+
+
+def get_latest_hero_score(player_id):
+    scores = get_top_hero_scores(player_id)
+    return scores[0] if len(scores) > 0 else None
+
+
+def load_player_hero_score(player_id, func=get_dota_open_api):
+    # a flight might have landed since the first query
+    score = get_latest_hero_score(player_id)
     if score is not None:
         return score
+    fetch_player_hero_scores(player_id, func)
+    return get_latest_hero_score(player_id)
+
+
+def get_player_hero_scores_by_id(player_id, k=1, role=None, primary_attr=None, func=get_dota_open_api):
+    scores = get_top_hero_scores(player_id, k, role, primary_attr)
+    # nothing might match the filters of a player already scored
+    if len(scores) > 0 or (
+            (role is not None or primary_attr is not None) and get_latest_hero_score(player_id) is not None
+    ):
+        return scores
     app.logger.info("load hero score from API for " + str(player_id))
-    fetch_player_hero_scores(player_id)
-    return HeroScore.query \
-        .filter(HeroScore.player_id == player_id) \
-        .order_by(HeroScore.score_date.desc()) \
-        .order_by(HeroScore.overall_score.desc()) \
-        .first()
+    single_flight.do(
+        'hero:{}'.format(player_id),
+        lambda: load_player_hero_score(player_id, func),
+        lambda: None
+    )
+    return get_top_hero_scores(player_id, k, role, primary_attr)
+
+
+def get_player_hero_score_by_id(player_id, func=get_dota_open_api):
+    scores = get_player_hero_scores_by_id(player_id, func=func)
+    return scores[0] if len(scores) > 0 else None
 
 
-def get_compare_result(s1, s2):
-    max_count = MatchScore.query.order_by(MatchScore.overall_score.desc()).first().overall_count
+def get_max_overall_count():
+    stat = ScoreStat.query.get(ScoreStat.MAX_OVERALL_COUNT)
+    if stat is not None:
+        return stat.value
+    # first use on an existing database, seed the stat with a single aggregate
+    value = db.session.query(db.func.max(MatchScore.overall_count)).scalar() or 0
+    db.session.add(ScoreStat(name=ScoreStat.MAX_OVERALL_COUNT, value=value))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # seeded by another worker in the meantime
+        db.session.rollback()
+        return ScoreStat.query.get(ScoreStat.MAX_OVERALL_COUNT).value
+    return value
+
+
+def get_compare_result(s1, s2, max_count=None):
+    if max_count is None:
+        max_count = get_max_overall_count()
+    max_count = max(max_count, 1)
     return s1.get_compare_score(max_count) - s2.get_compare_score(max_count)
+
+
+class AccessTracker(object):
+    """Records which players are viewed, see :class:`app.scheduler.Scheduler`.
+
+    A player is written at most once a day per kind and process, so a warm
+    page costs no extra statement.
+    """
+
+    def __init__(self):
+        self._day = None
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def track(self, player_id_list, kind):
+        today = date.today()
+        with self._lock:
+            if self._day != today:
+                self._day, self._seen = today, set()
+            player_id_list = set(p for p in player_id_list if (kind, p) not in self._seen)
+        if len(player_id_list) == 0:
+            return
+        column = TrackedPlayer.match_accessed_at if kind == TrackedPlayer.MATCH \
+            else TrackedPlayer.hero_accessed_at
+        now = datetime.now()
+        known = set(
+            p.player_id for p in db.session.query(TrackedPlayer.player_id)
+            .filter(TrackedPlayer.player_id.in_(player_id_list))
+        )
+        if len(known) > 0:
+            TrackedPlayer.query \
+                .filter(TrackedPlayer.player_id.in_(known)) \
+                .update({column: now}, synchronize_session=False)
+        db.session.add_all([
+            TrackedPlayer(**{'player_id': p, column.key: now}) for p in player_id_list - known
+        ])
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # tracked by another worker in the meantime, its access time is as good
+            db.session.rollback()
+        with self._lock:
+            if self._day == today:
+                self._seen.update((kind, p) for p in player_id_list)
+
+
+access_tracker = AccessTracker()
+
+
+def has_match_score(player_id, score_date):
+    return db.session.query(
+        MatchScore.query
+        .filter(MatchScore.player_id == player_id)
+        .filter(MatchScore.score_date == score_date)
+        .exists()
+    ).scalar()
+
+
+def has_hero_score(player_id, score_date):
+    return db.session.query(
+        HeroScore.query
+        .filter(HeroScore.player_id == player_id)
+        .filter(HeroScore.score_date == score_date)
+        .exists()
+    ).scalar()
+
+
+def refresh_player_scores(player_id, score_date, kinds, func=get_dota_open_api):
+    """Store the scores of a player for ``score_date`` unless already stored.
+
+    Players an interactive request is loading right now are skipped, they
+    are warm once that flight lands.
+    """
+    if TrackedPlayer.MATCH in kinds and not has_match_score(player_id, score_date):
+        key = 'match:{}'.format(player_id)
+        if single_flight.try_acquire(key):
+            try:
+                match_json = None if has_match_score(player_id, score_date) \
+                    else fetch_player_match_json(player_id, func)
+                if match_json is not None:
+                    save_player_match_scores([(player_id, match_json)], score_date)
+            finally:
+                single_flight.release(key)
+    if TrackedPlayer.HERO in kinds and not has_hero_score(player_id, score_date):
+        key = 'hero:{}'.format(player_id)
+        if single_flight.try_acquire(key):
+            try:
+                if not has_hero_score(player_id, score_date):
+                    fetch_player_hero_scores(player_id, func, score_date)
+            finally:
+                single_flight.release(key)
+
+
+class BackgroundRefresher(object):
+    """Stores today's scores of players without blocking the request serving stale ones.
+
+    A player is refreshed at most once at a time per process, the fetch lease
+    keeps other workers from loading it again.
+    """
+
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='score-refresh')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, player_id_list, kind, func=get_dota_open_api):
+        with self._lock:
+            for player_id in player_id_list:
+                if (kind, player_id) not in self._pending:
+                    self._pending[(kind, player_id)] = self._executor.submit(
+                        self._refresh, player_id, kind, func
+                    )
+
+    def wait(self, timeout=None):
+        with self._lock:
+            pending = list(self._pending.values())
+        futures.wait(pending, timeout)
+
+    def _refresh(self, player_id, kind, func):
+        try:
+            with app.app_context(), priority(BACKGROUND):
+                refresh_player_scores(player_id, date.today(), [kind], func)
+        except Exception as e:
+            app.logger.warning("background refresh of {} failed: {}".format(player_id, e))
+        finally:
+            with self._lock:
+                del self._pending[(kind, player_id)]
+
+
+background_refresher = BackgroundRefresher(app.config['REFRESH_MAX_WORKERS'])
@@ -1,8 +1,18 @@
+import hashlib
+import timeit
+from datetime import date, datetime, time
+
 from app import app
 from app.services import get_player_match_scores, accept_json,\
-    sort_score_list, get_player_match_score_by_id, get_player_hero_score_by_id,\
-    get_compare_result
-from flask import request, abort, render_template, jsonify
+    sort_score_list, get_player_match_score_by_id, get_player_hero_scores_by_id,\
+    get_compare_result, access_tracker, get_partial_player_match_scores, get_max_overall_count,\
+    get_global_match_scores, decode_cursor, SORT_COLUMNS
+from app.models import TrackedPlayer
+from app.limits import set_deadline, set_trace
+from app.metrics import registry, http_request_seconds
+from app.profiler import request_profiler
+from flask import request, abort, render_template, jsonify, Response, g
+from werkzeug.http import http_date, parse_date
 
 
 @app.errorhandler(400)
@@ -26,6 +36,91 @@ def error(e):
         ), 500
 
 
+@app.before_request
+def start_deadline():
+    g.started_at = timeit.default_timer()
+    set_deadline(app.config['REQUEST_DEADLINE_SECONDS'])
+
+
+@app.after_request
+def record_latency(response):
+    if 'started_at' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_request_seconds.observe(
+            timeit.default_timer() - g.started_at, route, request.method, str(response.status_code)
+        )
+        registry.flush()
+    return response
+
+
+@app.before_request
+def start_profile():
+    request_profiler.start(request)
+
+
+@app.after_request
+def finish_profile(response):
+    return request_profiler.finish(request, response)
+
+
+@app.teardown_request
+def clear_deadline(e):
+    set_deadline(None)
+    # a request failing before finish_profile must not leave its trace to the next one
+    request_profiler.stop()
+    set_trace(None)
+
+
+def freshness_headers(score_list, max_age):
+    if len(score_list) == 0:
+        return {}
+    age = max(s.age_days for s in score_list)
+    headers = {'X-Data-Age-Days': str(age)}
+    if age > max_age:
+        headers['Warning'] = '110 - "Response is Stale"'
+    return headers
+
+
+def validators(version, score_date=None, fresh=True):
+    """ETag, Last-Modified and Cache-Control of a response built from ``version``.
+
+    ``version`` identifies everything the body depends on, e.g. score ids and
+    dates. A score row never changes once stored, but stale or partial
+    responses do, so they carry no Last-Modified and are revalidated on use.
+    """
+    headers = {
+        'ETag': '"{}"'.format(hashlib.sha1(repr((
+            version, accept_json(request), date.today()
+        )).encode('utf-8')).hexdigest()),
+        'Cache-Control': 'public, max-age={}'.format(app.config['HTTP_CACHE_MAX_AGE'])
+        if fresh else 'no-cache',
+        'Vary': 'Accept'
+    }
+    if score_date is not None and fresh:
+        headers['Last-Modified'] = http_date(datetime.combine(score_date, time()))
+    return headers
+
+
+def not_modified(headers):
+    """The response to a conditional request the client already has the body of, else None"""
+    if request.if_none_match:
+        # takes precedence over If-Modified-Since
+        matched = request.if_none_match.contains(headers['ETag'].strip('"'))
+    elif request.if_modified_since is not None and 'Last-Modified' in headers:
+        matched = request.if_modified_since.replace(tzinfo=None) >= \
+            parse_date(headers['Last-Modified']).replace(tzinfo=None)
+    else:
+        matched = False
+    if matched:
+        return Response(status=304, headers=headers)
+    return None
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.expose(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template(
@@ -43,24 +138,102 @@ def leader_board():
         return abort(400)
     if len(player_id_list) < 1 or len(player_id_list) > 10:
         return abort(400)
-    score_list = get_player_match_scores(player_id_list)
-    if len(score_list) == 0:
+    try:
+        # with a budget the players still loading are listed as pending instead of waited for
+        budget = request.args.get("budget_ms")
+        budget = None if budget is None else int(budget) / 1000.0
+    except ValueError as e:
+        app.logger.warning(e)
+        return abort(400)
+    if budget is not None and budget < 0:
+        return abort(400)
+    max_age = app.config['LEADERBOARD_MAX_AGE_DAYS']
+    grace = app.config['LEADERBOARD_GRACE_DAYS']
+    if budget is None:
+        score_list, pending = get_player_match_scores(player_id_list, max_age=max_age, grace=grace), None
+    else:
+        score_list, pending = get_partial_player_match_scores(
+            player_id_list, min(budget, app.config['REQUEST_DEADLINE_SECONDS']), max_age=max_age, grace=grace
+        )
+    if len(score_list) == 0 and not pending:
         return abort(404)
     try:
         sort_by = request.args.get("sort").upper()
     except AttributeError as e:
         sort_by = 'O'
         app.logger.warning(e)
+    access_tracker.track([s.player_id for s in score_list], TrackedPlayer.MATCH)
+    headers = freshness_headers(score_list, max_age)
+    # players loaded later in the day join the board, no date tells when it last changed
+    headers.update(validators(
+        ('leaderboard', sort_by, pending, sorted((s.match_score_id, s.score_date) for s in score_list)),
+        fresh='Warning' not in headers and not pending
+    ))
+    response = not_modified(headers)
+    if response is not None:
+        return response
     score_list = sort_score_list(score_list, sort_by)
     if accept_json(request):
-        return jsonify([s.to_dict() for s in score_list])
+        if pending is None:
+            return jsonify([s.to_dict() for s in score_list]), headers
+        return jsonify({
+            'scores': [s.to_dict() for s in score_list],
+            'pending': pending
+        }), headers
     else:
         return render_template(
             'leader_board.html',
             title='Leader Board',
             scores=score_list,
+            pending=pending or [],
             gtag_tracking_id=app.gtag_tracking_id
-        )
+        ), headers
+
+
+@app.route('/leaderboard/global', methods=['GET'])
+def global_leader_board():
+    sort_by = (request.args.get("sort") or 'O').upper()
+    if sort_by not in SORT_COLUMNS:
+        return abort(400)
+    after = request.args.get("after")
+    try:
+        day = request.args.get("date")
+        score_date = date.today() if day is None else datetime.strptime(day, '%Y-%m-%d').date()
+        limit = int(request.args.get("limit", app.config['GLOBAL_LEADERBOARD_PAGE_SIZE']))
+        if after is not None:
+            decode_cursor(after, sort_by, score_date)
+    except ValueError as e:
+        app.logger.warning(e)
+        return abort(400)
+    if limit < 1 or limit > app.config['GLOBAL_LEADERBOARD_MAX_PAGE_SIZE']:
+        return abort(400)
+    if score_date > date.today():
+        # the scheduler stores scores ahead of their day, they are not served before it
+        return abort(404)
+    ranked, next_cursor = get_global_match_scores(score_date, sort_by, after, limit)
+    if len(ranked) == 0 and after is None:
+        return abort(404)
+    # players are added to the day until it is over, pages carry no Last-Modified
+    headers = validators(('global', sort_by, score_date, after, limit, [s.match_score_id for _, s in ranked]))
+    response = not_modified(headers)
+    if response is not None:
+        return response
+    if accept_json(request):
+        return jsonify({
+            'scores': [dict(s.to_dict(), rank=rank) for rank, s in ranked],
+            'next': next_cursor
+        }), headers
+    else:
+        return render_template(
+            'global_leader_board.html',
+            title='Global Leader Board',
+            ranked=ranked,
+            sort_by=sort_by,
+            score_date=score_date,
+            limit=limit,
+            next_cursor=next_cursor,
+            gtag_tracking_id=app.gtag_tracking_id
+        ), headers
 
 
 @app.route('/compare', methods=['GET'])
@@ -71,19 +244,32 @@ def compare_players():
     except (ValueError, AttributeError) as e:
         app.logger.warning(e)
         return abort(400)
-    s1 = get_player_match_score_by_id(p1)
+    max_age = app.config['COMPARE_MAX_AGE_DAYS']
+    grace = app.config['COMPARE_GRACE_DAYS']
+    s1 = get_player_match_score_by_id(p1, max_age=max_age, grace=grace)
     if s1 is None:
         return abort(404)
-    s2 = get_player_match_score_by_id(p2)
+    s2 = get_player_match_score_by_id(p2, max_age=max_age, grace=grace)
     if s2 is None:
         return abort(404)
-    compare_result = get_compare_result(s1, s2)
+    access_tracker.track([p1, p2], TrackedPlayer.MATCH)
+    max_count = get_max_overall_count()
+    headers = freshness_headers([s1, s2], max_age)
+    # the result follows the max overall count of all players, no date tells when that changed
+    headers.update(validators(
+        ('compare', (s1.match_score_id, s1.score_date), (s2.match_score_id, s2.score_date), max_count),
+        fresh='Warning' not in headers
+    ))
+    response = not_modified(headers)
+    if response is not None:
+        return response
+    compare_result = get_compare_result(s1, s2, max_count)
     if accept_json(request):
         return jsonify({
             'result': compare_result,
             'player1': s1.to_dict(),
             'player2': s2.to_dict()
-        })
+        }), headers
     else:
         return render_template(
             'compare_players.html',
@@ -92,25 +278,46 @@ def compare_players():
             s1=s1,
             s2=s2,
             gtag_tracking_id=app.gtag_tracking_id
-        )
+        ), headers
 
 
 @app.route('/recommend', methods=['GET'])
 def recommend_hero():
     try:
         player_id = int(request.args.get("p"))
+        # with k the top k heroes are listed, else the single best one is returned
+        k = request.args.get("k")
+        k = None if k is None else int(k)
     except (ValueError, AttributeError) as e:
         app.logger.warning(e)
         return abort(400)
-    s = get_player_hero_score_by_id(player_id)
-    if s is None:
+    if k is not None and (k < 1 or k > 20):
+        return abort(400)
+    role = request.args.get("role")
+    if role is not None and not role.isalpha():
+        return abort(400)
+    primary_attr = request.args.get("attr")
+    if primary_attr is not None and not primary_attr.isalpha():
+        return abort(400)
+    score_list = get_player_hero_scores_by_id(player_id, k or 1, role, primary_attr)
+    if len(score_list) == 0:
         return abort(404)
+    access_tracker.track([player_id], TrackedPlayer.HERO)
+    headers = validators(
+        ('recommend', k, role, primary_attr, [(s.hero_score_id, s.score_date) for s in score_list]),
+        score_list[0].score_date
+    )
+    response = not_modified(headers)
+    if response is not None:
+        return response
     if accept_json(request):
-        return jsonify(s.to_dict())
+        if k is None:
+            return jsonify(score_list[0].to_dict()), headers
+        return jsonify([s.to_dict() for s in score_list]), headers
     else:
         return render_template(
             'recommend_hero.html',
             title='Recommend Hero For {}'.format(player_id),
-            score=s,
+            scores=score_list,
             gtag_tracking_id=app.gtag_tracking_id
-        )
+        ), headers
@@ -0,0 +1,67 @@
+"""Throughput of the hero scoring engine.
+
+Usage: python -m benchmarks.scoring [--players 10000] [--heroes 120]
+"""
+import argparse
+import random
+import time
+
+from app.models import HeroScore
+from app.scoring import score_players
+
+
+def synthetic_players(n_players, hero_ids, seed=0):
+    rnd = random.Random(seed)
+    players = []
+    for _ in range(n_players):
+        played = rnd.sample(hero_ids, rnd.randint(1, len(hero_ids)))
+        players.append((
+            [{'hero_id': str(h), 'win': rnd.randint(0, 500), 'last_played': rnd.randint(1, 10 ** 9)}
+             for h in played],
+            [{'hero_id': h, 'percent_rank': rnd.random()} for h in played[:len(played) // 2]]
+        ))
+    return players
+
+
+def score_per_row(hero_ids, players):
+    """One HeroScore at a time, as populate_player_hero_scores_from_json used to do"""
+    result = []
+    for hero_match_list, hero_ranking_list in players:
+        hm_dict = dict((int(hm['hero_id']), hm) for hm in hero_match_list)
+        max_win = max(hm['win'] for hm in hero_match_list) or 1
+        max_last_played = max(hm['last_played'] for hm in hero_match_list) or 1
+        hr_dict = dict((hr['hero_id'], hr) for hr in hero_ranking_list)
+        row = []
+        for hero_id in hero_ids:
+            s = HeroScore(hero_id=hero_id, last_played_score=0.0, win_score=0.0, rank_score=0.0)
+            if hero_id in hm_dict:
+                s.last_played_score = float(hm_dict[hero_id]['last_played']) / max_last_played
+                s.win_score = float(hm_dict[hero_id]['win']) / max_win
+            if hero_id in hr_dict:
+                s.rank_score = hr_dict[hero_id]['percent_rank']
+            s.overall_score = s.get_overall_score()
+            row.append(s)
+        result.append(row)
+    return result
+
+
+def timed(label, n_players, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    print('{:<10} {:>8.3f} s {:>12.0f} players/s'.format(label, elapsed, n_players / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=10000)
+    parser.add_argument('--heroes', type=int, default=120)
+    args = parser.parse_args()
+    hero_ids = list(range(1, args.heroes + 1))
+    players = synthetic_players(args.players, hero_ids)
+    timed('per-row', args.players, score_per_row, hero_ids, players)
+    timed('batch', args.players, score_players, hero_ids, players)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""Latency of the service layer against large synthetic tables.
+
+Usage: python -m benchmarks.services [--db-uri sqlite:///db/bench.sqlite] [--players 10000] [--heroes 120]
+       [--days 1] [--repeat 50] [--reseed] [--output results.json] [--baseline old-results.json]
+
+The database is seeded once per size and reused by later runs, --reseed drops a database seeded at
+another size. Point --db-uri at an empty Postgres database to benchmark Postgres. API calls go to a
+stub, only the database and Python work is measured.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+from app import app, db
+from app.models import Player, Hero, HeroScore, MatchScore, ScoreStat, hero_catalog
+
+# rows per INSERT statement while seeding
+SEED_CHUNK = 10000
+
+
+def stub_api(n_heroes, seed=0):
+    """API stand-in answering every path with a synthetic payload, never slower than a dict lookup"""
+    rnd = random.Random(seed)
+    hero_ids = list(range(1, n_heroes + 1))
+    wl = json.dumps({'win': 120, 'lose': 100})
+
+    def func(path, params=None):
+        func.calls += 1
+        if path == 'api/heroes':
+            return json.dumps([
+                {'id': h, 'name': 'hero{}'.format(h), 'localized_name': 'Hero {}'.format(h), 'primary_attr': 'agi',
+                 'attack_type': 'Melee', 'roles': ['Carry'], 'legs': 2}
+                for h in hero_ids
+            ])
+        player_id = int(path.split('/')[2])
+        if path.endswith('/wl'):
+            return wl
+        if path.endswith('/heroes'):
+            return json.dumps([
+                {'hero_id': str(h), 'win': rnd.randint(0, 500), 'last_played': rnd.randint(1, 10 ** 9)}
+                for h in rnd.sample(hero_ids, rnd.randint(1, len(hero_ids)))
+            ])
+        if path.endswith('/rankings'):
+            return json.dumps([
+                {'hero_id': h, 'percent_rank': rnd.random()} for h in rnd.sample(hero_ids, len(hero_ids) // 4)
+            ])
+        return json.dumps({'profile': {
+            'account_id': player_id, 'steamid': str(player_id), 'personaname': 'p{}'.format(player_id),
+            'name': None, 'avatar': ''
+        }})
+    func.calls = 0
+    return func
+
+
+def insert_chunked(table, rows):
+    for i in range(0, len(rows), SEED_CHUNK):
+        db.session.execute(table.insert(), rows[i:i + SEED_CHUNK])
+
+
+def seed(n_players, n_heroes, n_days, seed=0, reseed=False):
+    """Players 1..n_players with a match score and a hero score per hero for each of the last n_days.
+
+    Tables of another size are only dropped with ``reseed``, a database with
+    tables the app does not know of is never touched.
+    """
+    expected = n_players * n_heroes * n_days
+    foreign = set(db.inspect(db.engine).get_table_names()) - set(db.metadata.tables)
+    if foreign:
+        raise SystemExit('{} has tables the benchmark did not create ({}), pick another --db-uri'.format(
+            db.engine.url, ', '.join(sorted(foreign))
+        ))
+    db.create_all()
+    if db.session.query(db.func.count(Player.account_id)).filter(Player.account_id <= n_players).scalar() \
+            == n_players and HeroScore.query.count() == expected:
+        return False
+    if not reseed and Player.query.first() is not None:
+        raise SystemExit('{} holds data of another size, pass --reseed to drop it'.format(db.engine.url))
+    db.drop_all()
+    db.create_all()
+    rng = np.random.RandomState(seed)
+    insert_chunked(Hero.__table__, [
+        {'hero_id': h, 'name': 'hero{}'.format(h), 'localized_name': 'Hero {}'.format(h),
+         'primary_attr': ['agi', 'str', 'int'][h % 3], 'attack_type': 'Melee', 'roles': 'Carry,Nuker', 'legs': 2}
+        for h in range(1, n_heroes + 1)
+    ])
+    step = max(SEED_CHUNK // n_heroes, 1)
+    for start in range(1, n_players + 1, step):
+        player_ids = list(range(start, min(start + step, n_players + 1)))
+        insert_chunked(Player.__table__, [
+            {'account_id': p, 'steam_id': str(p), 'personaname': 'p{}'.format(p), 'name': None, 'avatar': ''}
+            for p in player_ids
+        ])
+        for day in range(n_days):
+            score_date = date.today() - timedelta(days=day)
+            scores = rng.rand(len(player_ids), 5)
+            insert_chunked(MatchScore.__table__, [
+                {'player_id': p, 'score_date': score_date, 'week_score': s[0], 'month_score': s[1],
+                 'year_score': s[2], 'overall_score': s[3], 'overall_count': int(s[4] * 5000)}
+                for p, s in zip(player_ids, scores.tolist())
+            ])
+            overall = rng.rand(len(player_ids), n_heroes)
+            # rank 1 is the best hero of a player
+            ranks = np.argsort(np.argsort(-overall, axis=1), axis=1) + 1
+            insert_chunked(HeroScore.__table__, [
+                {'player_id': p, 'hero_id': h + 1, 'score_date': score_date, 'rank_score': o / 3,
+                 'win_score': o / 3, 'last_played_score': o / 3, 'overall_score': o, 'hero_rank': r}
+                for p, os, rs in zip(player_ids, overall.tolist(), ranks.tolist())
+                for h, (o, r) in enumerate(zip(os, rs))
+            ])
+        db.session.commit()
+    db.session.add(ScoreStat(name=ScoreStat.MAX_OVERALL_COUNT, value=5000))
+    db.session.commit()
+    return True
+
+
+def timed(func, repeat, setup=None):
+    """Milliseconds per call, ``setup`` runs untimed before each call and its result is passed on"""
+    samples = []
+    for i in range(repeat):
+        args = setup(i) if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - start) * 1000.0)
+        # every call starts from a cold session like a new request
+        db.session.remove()
+    samples.sort()
+    return {
+        'repeat': repeat,
+        'min_ms': samples[0],
+        'median_ms': samples[len(samples) // 2],
+        'p95_ms': samples[min(int(len(samples) * 0.95), len(samples) - 1)],
+        'mean_ms': sum(samples) / len(samples)
+    }
+
+
+def benchmarks(n_players, n_heroes, seed=0):
+    # the functions are imported late, services builds executors from app.config on import
+    from app.services import sort_score_list, get_player_match_scores, get_player_hero_score_by_id, \
+        get_compare_result, populate_player_hero_scores_from_json, get_recent_match_scores
+    rnd = random.Random(seed)
+    func = stub_api(n_heroes, seed)
+    # players beyond the seeded ones are new, they take the write path
+    new_ids = iter(range(n_players + 1, n_players + 10 ** 6))
+
+    def sample(k):
+        return rnd.sample(range(1, n_players + 1), k)
+
+    def cold_players(_):
+        player_id = next(new_ids)
+        return (func('api/players/{}/rankings'.format(player_id)), func('api/players/{}/heroes'.format(player_id)),
+                None, func('api/players/{}'.format(player_id)), player_id)
+
+    def loaded_scores(_):
+        return get_recent_match_scores(sample(min(1000, n_players)), date.today()), rnd.choice('WMYCO')
+
+    def compare_pair(_):
+        return get_recent_match_scores(sample(2), date.today())
+
+    return [
+        ('sort_score_list', lambda s, by: sort_score_list(s, by), loaded_scores),
+        ('get_player_match_scores', lambda ids: get_player_match_scores(ids, func), lambda _: (sample(10),)),
+        ('get_player_match_scores_cold', lambda ids: get_player_match_scores(ids, func),
+         lambda _: ([next(new_ids) for _ in range(10)],)),
+        ('get_player_hero_score_by_id', lambda p: get_player_hero_score_by_id(p, func), lambda _: (sample(1)[0],)),
+        ('get_compare_result', lambda s1, s2: get_compare_result(s1, s2), compare_pair),
+        ('populate_player_hero_scores_from_json', populate_player_hero_scores_from_json, cold_players)
+    ], func
+
+
+def cleanup(n_players):
+    """Drop the players the write benchmarks added, the next run starts from the same tables"""
+    for model in [HeroScore, MatchScore]:
+        model.query.filter(model.player_id > n_players).delete(synchronize_session=False)
+    Player.query.filter(Player.account_id > n_players).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db-uri', default='sqlite:///{}'.format(
+        os.path.abspath(os.path.join(os.path.dirname(__file__), '../db/bench.sqlite'))
+    ))
+    parser.add_argument('--players', type=int, default=10000)
+    parser.add_argument('--heroes', type=int, default=120)
+    parser.add_argument('--days', type=int, default=1, help='days of scores per player')
+    parser.add_argument('--repeat', type=int, default=50, help='calls per benchmark')
+    parser.add_argument('--reseed', action='store_true', help='drop and seed again tables of another size')
+    parser.add_argument('--only', help='comma separated benchmark names')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+    args = parser.parse_args()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db_uri
+    app.logger.setLevel('ERROR')
+    with app.app_context():
+        start = time.perf_counter()
+        if seed(args.players, args.heroes, args.days, reseed=args.reseed):
+            print('seeded {} players, {} hero scores in {:.1f} s'.format(
+                args.players, args.players * args.heroes * args.days, time.perf_counter() - start
+            ))
+        hero_catalog.clear()
+        suite, func = benchmarks(args.players, args.heroes)
+        only = set(args.only.split(',')) if args.only else None
+        results = {}
+        try:
+            for name, call, setup in suite:
+                if only is None or name in only:
+                    results[name] = timed(call, args.repeat, setup)
+        finally:
+            cleanup(args.players)
+        dialect = db.engine.dialect.name
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    print('{:<40} {:>10} {:>10} {:>10} {:>8}'.format('benchmark', 'median ms', 'p95 ms', 'min ms', 'change'))
+    for name, r in results.items():
+        change = ''
+        if name in baseline:
+            change = '{:+.0%}'.format(r['median_ms'] / baseline[name]['median_ms'] - 1)
+        print('{:<40} {median_ms:>10.2f} {p95_ms:>10.2f} {min_ms:>10.2f} {:>8}'.format(name, change, **r))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'python': platform.python_version(),
+                'database': dialect,
+                'players': args.players,
+                'heroes': args.heroes,
+                'days': args.days,
+                'api_calls': func.calls,
+                'results': results
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
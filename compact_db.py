@@ -0,0 +1,32 @@
+"""Roll daily scores older than --keep-days into weekly or monthly rows and delete them.
+
+Usage: python compact_db.py [--dry-run] [--keep-days 30] [--period week|month] [--batch-size 100]
+"""
+import argparse
+
+from app import app
+from app.compaction import Compactor
+from app.models import MatchScoreRollup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be compacted')
+    parser.add_argument('--keep-days', type=int, default=app.config['COMPACT_KEEP_DAYS'])
+    parser.add_argument('--period', choices=[MatchScoreRollup.WEEK, MatchScoreRollup.MONTH],
+                        default=app.config['COMPACT_PERIOD'])
+    parser.add_argument('--batch-size', type=int, default=app.config['COMPACT_BATCH_SIZE'],
+                        help='players per transaction')
+    args = parser.parse_args()
+    compactor = Compactor(args.keep_days, args.period, args.batch_size)
+    print('{} scores before {} into {} rows'.format(
+        'would compact' if args.dry_run else 'compacting', compactor.cutoff, args.period
+    ))
+    for report in compactor.compact(dry_run=args.dry_run):
+        print('{table}: {rows} rows ({bytes} bytes) of {periods} periods into {rollups} new rollup rows'.format(
+            **report
+        ))
+
+
+if __name__ == '__main__':
+    main()
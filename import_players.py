@@ -0,0 +1,44 @@
+"""Store today's match and hero scores of many players, one account id per line.
+
+Usage: python import_players.py [ids.txt] [--workers 4] [--batch-size 50] [--checkpoint db/import.checkpoint]
+       [--restart]
+
+Reads stdin when no file is given. An interrupted import resumes where it left off when run again on the same input.
+"""
+import argparse
+import os
+import sys
+
+from app import app
+from app.importer import Importer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('ids', nargs='?', default='-', help='file of account ids, - for stdin')
+    parser.add_argument('--workers', type=int, default=app.config['IMPORT_MAX_WORKERS'],
+                        help='players fetched at once')
+    parser.add_argument('--batch-size', type=int, default=app.config['IMPORT_BATCH_SIZE'],
+                        help='players per transaction')
+    parser.add_argument('--checkpoint', default=app.config['IMPORT_CHECKPOINT_FILE'])
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint of an earlier run')
+    args = parser.parse_args()
+    source = 'stdin' if args.ids == '-' else os.path.abspath(args.ids)
+    importer = Importer(args.workers, args.batch_size, args.checkpoint, source)
+    if args.restart:
+        importer.clear_checkpoint()
+
+    def progress(stats):
+        print('{done} players done, {stored} stored, {failed} failed, {rate:.2f} players/sec'.format(**stats))
+        sys.stdout.flush()
+
+    if args.ids == '-':
+        stats = importer.run(sys.stdin, progress)
+    else:
+        with open(args.ids) as f:
+            stats = importer.run(f, progress)
+    print('import finished, {done} players, {stored} stored, {failed} failed'.format(**stats))
+
+
+if __name__ == '__main__':
+    main()
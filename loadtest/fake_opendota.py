@@ -0,0 +1,159 @@
+"""A stand-in for the OpenDota API serving the fixtures of loadtest/fixtures.
+
+Usage: python -m loadtest.fake_opendota [--port 8001] [--latency-ms 50] [--jitter-ms 20]
+       [--error-rate 0.0] [--throttle-rate 0.0]
+
+Run the app against it with OPEN_DOTA_BASE_URL=http://127.0.0.1:8001 and API_RATE_LIMIT=0.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib import parse
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+ROUTES = [
+    (re.compile(r'^/api/heroes$'), 'heroes'),
+    (re.compile(r'^/api/players/(\d+)$'), 'player'),
+    (re.compile(r'^/api/players/(\d+)/wl$'), 'wl'),
+    (re.compile(r'^/api/players/(\d+)/rankings$'), 'rankings'),
+    (re.compile(r'^/api/players/(\d+)/heroes$'), 'player_heroes')
+]
+
+
+def load_fixtures(fixture_dir=FIXTURE_DIR):
+    fixtures = {}
+    for name in ['heroes', 'player', 'wl', 'rankings', 'player_heroes']:
+        with open(os.path.join(fixture_dir, name + '.json')) as f:
+            fixtures[name] = json.load(f)
+    return fixtures
+
+
+def render(fixtures, name, account_id=None, query=None):
+    """The payload of ``name``, player payloads vary by account id so every player scores differently"""
+    payload = fixtures[name]
+    if account_id is None:
+        return payload
+    rnd = random.Random(account_id)
+    if name == 'player':
+        payload = json.loads(json.dumps(payload))
+        payload['profile'].update(account_id=account_id, personaname='player{}'.format(account_id),
+                                  steamid=str(76561197960265728 + account_id))
+    elif name == 'wl':
+        # shorter periods scale the lifetime record down
+        days = int(query.get('date', ['0'])[0] or 0)
+        share = min(days / 3650.0, 1.0) if days > 0 else 1.0
+        payload = dict((k, int(v * share * rnd.uniform(0.5, 1.5))) for k, v in payload.items())
+    elif name == 'rankings':
+        payload = [dict(r, percent_rank=round(r['percent_rank'] * rnd.uniform(0.5, 1.0), 4)) for r in payload]
+    elif name == 'player_heroes':
+        payload = [dict(h, win=int(h['win'] * rnd.uniform(0.5, 1.5))) for h in payload]
+    return payload
+
+
+class FakeOpenDotaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        url = parse.urlsplit(self.path)
+        server.count(url.path)
+        delay = max(random.gauss(server.latency, server.jitter), 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        roll = random.random()
+        if roll < server.throttle_rate:
+            return self.reply(429, {'error': 'rate limit exceeded'}, {'Retry-After': '1'})
+        if roll < server.throttle_rate + server.error_rate:
+            return self.reply(500, {'error': 'injected failure'})
+        for pattern, name in ROUTES:
+            match = pattern.match(url.path)
+            if match is not None:
+                account_id = int(match.group(1)) if match.groups() else None
+                return self.reply(200, render(server.fixtures, name, account_id, parse.parse_qs(url.query)))
+        self.reply(404, {'error': 'Not Found'})
+
+    def reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeOpenDota(ThreadingMixIn, HTTPServer):
+    """Serves the fixtures after ``latency`` (+- ``jitter``) seconds.
+
+    A share of ``throttle_rate`` of the requests is answered with a 429 and
+    Retry-After, a share of ``error_rate`` with a 500. Port 0 picks a free port.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 fixtures=None):
+        super().__init__((host, port), FakeOpenDotaHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.fixtures = fixtures or load_fixtures()
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self):
+        """Serve on a background thread, e.g. in tests"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--jitter-ms', type=float, default=20.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered with a 429')
+    args = parser.parse_args()
+    server = FakeOpenDota(args.host, args.port, args.latency_ms / 1000.0, args.jitter_ms / 1000.0,
+                          args.error_rate, args.throttle_rate)
+    print('fake OpenDota API on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Load test of /leaderboard, /compare and /recommend reporting latency percentiles and requests/sec.
+
+Usage: python -m loadtest.run [--url http://127.0.0.1:5000] [--concurrency 10] [--duration 30] [--players 200]
+       [--serve] [--workers 4] [--output results.json]
+
+With --serve the app is started under gunicorn on an empty SQLite database, backed by a fake OpenDota API in
+this process.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib import request
+from urllib.error import URLError, HTTPError
+
+from loadtest.fake_opendota import FakeOpenDota
+
+# first account id of the synthetic players, any id is known to the fake API
+FIRST_PLAYER_ID = 100000
+
+
+def endpoints(player_ids, rnd):
+    """Path builders per endpoint, each call picks new players"""
+    return [
+        ('leaderboard', lambda: '/leaderboard?ids={}&sort=O'.format(','.join(
+            str(p) for p in rnd.sample(player_ids, min(10, len(player_ids)))
+        ))),
+        ('compare', lambda: '/compare?p1={}&p2={}'.format(*rnd.sample(player_ids, 2))),
+        ('recommend', lambda: '/recommend?p={}'.format(rnd.choice(player_ids)))
+    ]
+
+
+def percentile(values, q):
+    """Nearest rank percentile of sorted ``values``, None when empty"""
+    if len(values) == 0:
+        return None
+    rank = int(math.ceil(q * len(values) / 100.0))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def summarize(samples, elapsed):
+    """Per endpoint stats of (endpoint, seconds, ok) samples"""
+    report = {}
+    for name in sorted(set(name for name, _, _ in samples)):
+        latencies = sorted(seconds * 1000.0 for n, seconds, _ in samples if n == name)
+        report[name] = {
+            'requests': len(latencies),
+            'errors': sum(1 for n, _, ok in samples if n == name and not ok),
+            'rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99)
+        }
+    return report
+
+
+def run(url, concurrency, duration, player_ids, accept='text/html', timeout=60.0, seed=0):
+    """Hit the endpoints round robin from ``concurrency`` threads for ``duration`` seconds"""
+    samples = []
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def worker(i):
+        rnd = random.Random(seed + i)
+        paths = endpoints(player_ids, rnd)
+        n = i
+        while time.time() < stop_at:
+            name, path = paths[n % len(paths)]
+            n += 1
+            req = request.Request(url + path(), headers={'Accept': accept})
+            start = time.perf_counter()
+            try:
+                with request.urlopen(req, timeout=timeout) as resp:
+                    resp.read()
+                    ok = resp.getcode() == 200
+            except HTTPError as e:
+                ok = e.code == 304
+            except (URLError, OSError):
+                ok = False
+            seconds = time.perf_counter() - start
+            with lock:
+                samples.append((name, seconds, ok))
+
+    started_at = time.time()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(samples, time.time() - started_at)
+
+
+def wait_until_up(url, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            request.urlopen(url + '/', timeout=1.0).read()
+            return
+        except (URLError, OSError):
+            time.sleep(0.2)
+    raise RuntimeError('{} did not come up within {} s'.format(url, timeout))
+
+
+def serve(port, workers, fake_url, db_path):
+    """Start the app under gunicorn talking to the fake API, API calls are not rate limited.
+
+    The app gets an empty SQLite database at ``db_path``, created with create_db.py.
+    """
+    root = os.path.join(os.path.dirname(__file__), '..')
+    env = dict(os.environ, OPEN_DOTA_BASE_URL=fake_url, API_RATE_LIMIT='0',
+               DATABASE_URL='sqlite:///{}'.format(os.path.abspath(db_path)))
+    subprocess.check_call([sys.executable, 'create_db.py'], env=env, cwd=root)
+    return subprocess.Popen(
+        ['gunicorn', '--bind', '127.0.0.1:{}'.format(port), '--workers', str(workers), '--threads', '4', 'wsgi'],
+        env=env, cwd=root
+    )
+
+
+def print_report(report):
+    print('{:<12} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'requests', 'errors', 'rps', 'p50 ms', 'p95 ms', 'p99 ms'
+    ))
+    for name, stats in sorted(report.items()):
+        print('{:<12} {requests:>9} {errors:>7} {rps:>9.1f} {p50_ms:>9.1f} {p95_ms:>9.1f} {p99_ms:>9.1f}'.format(
+            name, **stats
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--players', type=int, default=200, help='distinct players requested')
+    parser.add_argument('--accept', default='text/html', help='application/json to load test the JSON API')
+    parser.add_argument('--serve', action='store_true', help='start gunicorn and a fake OpenDota API')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers with --serve')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='fake API latency with --serve')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fake API 500 share with --serve')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fake API 429 share with --serve')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+    player_ids = list(range(FIRST_PLAYER_ID, FIRST_PLAYER_ID + args.players))
+    fake, app_process, db_dir = None, None, None
+    try:
+        if args.serve:
+            fake = FakeOpenDota(latency=args.latency_ms / 1000.0, jitter=args.latency_ms / 4000.0,
+                                error_rate=args.error_rate, throttle_rate=args.throttle_rate).start()
+            # every run starts from an empty database, the scores of a real one are never touched
+            db_dir = tempfile.mkdtemp(prefix='loadtest-')
+            app_process = serve(int(args.url.rsplit(':', 1)[1]), args.workers, fake.url,
+                                os.path.join(db_dir, 'loadtest.sqlite'))
+            wait_until_up(args.url)
+        report = run(args.url, args.concurrency, args.duration, player_ids, args.accept)
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+            app_process.wait()
+        if fake is not None:
+            fake.stop()
+        if db_dir is not None:
+            shutil.rmtree(db_dir)
+    print_report(report)
+    if fake is not None:
+        print('fake API requests: {}'.format(sum(fake.requests.values())))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Bring an existing database up to date with the models, data is never dropped.
+
+Usage: python migrate_db.py
+"""
+from sqlalchemy import inspect
+
+from app import db
+from app.models import HeroScore
+
+# indexes this app names and manages, any other index of a table is left alone
+MANAGED_INDEX_PREFIX = 'ix_'
+# a day and RANK_BATCH_PLAYERS players per transaction so no single statement holds the table for long
+RANK_BATCH_PLAYERS = 1000
+
+
+def add_columns(inspector):
+    for table in db.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # added columns are nullable, backfilled below where needed
+            print('add column {} to {}'.format(column.name, table.name))
+            db.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table.name, column.name, column.type.compile(dialect=db.engine.dialect)
+            ))
+
+
+def execute_ddl(statement):
+    if db.engine.dialect.name == 'postgresql':
+        # CONCURRENTLY needs to run outside a transaction
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(statement)
+    else:
+        db.engine.execute(statement)
+
+
+def sync_indexes(inspector):
+    """Create the indexes the models declare and drop the managed ones they no longer do"""
+    concurrently = ' CONCURRENTLY' if db.engine.dialect.name == 'postgresql' else ''
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        declared = set(index.name for index in table.indexes)
+        for name in sorted(existing - declared):
+            if not name.startswith(MANAGED_INDEX_PREFIX):
+                continue
+            # every write of the table still pays for an index nothing reads
+            print('drop index {} on {}'.format(name, table.name))
+            execute_ddl('DROP INDEX{} IF EXISTS {}'.format(concurrently, name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            print('create index {} on {}'.format(index.name, table.name))
+            if db.engine.dialect.name == 'postgresql':
+                # do not block writes while building
+                index.dialect_options['postgresql']['concurrently'] = True
+                with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    index.create(bind=connection)
+            else:
+                index.create(bind=db.engine)
+
+
+def rank_batch(connection, score_date, player_ids):
+    table = HeroScore.__table__
+    in_batch = db.and_(table.c.score_date == score_date, table.c.player_id.in_(player_ids))
+    if connection.dialect.name == 'postgresql':
+        ranked = db.select([
+            table.c.hero_score_id,
+            db.func.rank().over(
+                partition_by=(table.c.player_id, table.c.score_date),
+                order_by=(table.c.overall_score.desc(), table.c.hero_id)
+            ).label('hero_rank')
+        ]).where(in_batch).alias('ranked')
+        return connection.execute(
+            table.update()
+            .where(table.c.hero_score_id == ranked.c.hero_score_id)
+            .where(table.c.hero_rank.is_(None))
+            .values(hero_rank=ranked.c.hero_rank)
+        ).rowcount
+    # no UPDATE ... FROM, count the better heroes of the same player and day instead
+    other = table.alias('other')
+    better = db.select([db.func.count()]).where(db.and_(
+        other.c.player_id == table.c.player_id,
+        other.c.score_date == table.c.score_date,
+        db.or_(
+            other.c.overall_score > table.c.overall_score,
+            db.and_(other.c.overall_score == table.c.overall_score, other.c.hero_id < table.c.hero_id)
+        )
+    )).as_scalar()
+    return connection.execute(
+        table.update().where(in_batch).where(table.c.hero_rank.is_(None)).values(hero_rank=better + 1)
+    ).rowcount
+
+
+def rank_hero_scores():
+    """Rank the hero scores written before the ranking was materialized, ties go to the lower hero id"""
+    table = HeroScore.__table__
+    ranked_count = 0
+    unranked_dates = db.select([table.c.score_date]).where(table.c.hero_rank.is_(None)).distinct()
+    for score_date in [row[0] for row in db.engine.execute(unranked_dates.order_by(table.c.score_date))]:
+        player_ids = [row[0] for row in db.engine.execute(
+            db.select([table.c.player_id]).where(table.c.hero_rank.is_(None))
+            .where(table.c.score_date == score_date).distinct().order_by(table.c.player_id)
+        )]
+        for i in range(0, len(player_ids), RANK_BATCH_PLAYERS):
+            with db.engine.begin() as connection:
+                ranked_count += rank_batch(connection, score_date, player_ids[i:i + RANK_BATCH_PLAYERS])
+        print('ranked hero scores of {}'.format(score_date))
+    return ranked_count
+
+
+def main():
+    # create missing tables, then the columns and indexes existing tables lack
+    db.create_all()
+    inspector = inspect(db.engine)
+    add_columns(inspector)
+    sync_indexes(inspector)
+    print('ranked {} hero scores'.format(rank_hero_scores()))
+
+
+if __name__ == '__main__':
+    main()
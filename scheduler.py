@@ -0,0 +1,4 @@
+from app.scheduler import scheduler
+
+# keeps the scores of recently viewed players warm, run next to wsgi.py
+scheduler.run_forever()
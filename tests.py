@@ -1,19 +1,121 @@
 import unittest
 import os
+import json
+import gzip
 import logging
-from urllib.error import URLError
-from unittest.mock import Mock
-from datetime import date
+import random
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, redirect_stdout
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib import parse, request
+from urllib.error import URLError, HTTPError
+from unittest.mock import Mock, patch
+from datetime import date, datetime, timedelta
+from itsdangerous import URLSafeTimedSerializer
+from sqlalchemy import event
 from app import app, db, default_db_path, default_db_uri
-from app.models import Player, Hero, HeroScore, MatchScore
+from app.models import Player, Hero, HeroScore, MatchScore, ScoreStat, FetchLease, TrackedPlayer, \
+    MatchScoreRollup, HeroScoreRollup, hero_catalog
 from app.services import get_match_score_from_json, fetch_player_match_score, \
-    populate_player_hero_scores_from_json, fetch_player_hero_scores
-from app.apis import get_dota_open_api
+    populate_player_hero_scores_from_json, fetch_player_hero_scores, get_player_match_scores, \
+    get_max_overall_count, get_player_match_score_by_id, background_refresher, AccessTracker, \
+    get_partial_player_match_scores, get_player_hero_scores_by_id, get_latest_match_score, \
+    get_top_hero_scores, get_recent_match_scores
+from app.apis import get_dota_open_api, get_dota_open_api_all, ConnectionPool, api_cache, \
+    api_executor
+from app.cache import ResponseCache
+from app.limits import TokenBucket, CircuitBreaker, INTERACTIVE, BACKGROUND, retry_after, set_deadline, \
+    remaining, bind, set_trace
+from app.flights import SingleFlight
+from app.metrics import Registry, api_path_label
+from app.profiler import Trace, trace_event, make_token, request_profiler
+from app.scheduler import Scheduler
+from app.compaction import Compactor
+from app.importer import Importer
+from app.scoring import score_player, score_players, rank_heroes
+from loadtest.fake_opendota import FakeOpenDota
+from loadtest.run import percentile, summarize
+import migrate_db
 
 
 app.logger.setLevel(logging.ERROR)
 
 
+def fake_api(responses, delay=0.0):
+    """Build an API stub answering by path and params, None for anything unknown"""
+    def func(path, params=None):
+        time.sleep(delay)
+        if params is not None:
+            path += '?' + parse.urlencode(params)
+        func.calls.append(path)
+        return responses.get(path)
+    func.calls = []
+    return func
+
+
+@contextmanager
+def assert_query_count(test, count):
+    """Fail ``test`` unless exactly ``count`` SQL statements run inside the block"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    test.assertEqual(len(statements), count, '\n\n'.join(statements))
+
+
+class GzipHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    requests = 0
+
+    def setup(self):
+        super().setup()
+        GzipHandler.connections += 1
+
+    def do_GET(self):
+        GzipHandler.requests += 1
+        if self.path == '/slow':
+            time.sleep(0.5)
+        body = gzip.compress(b'{"ok":true}')
+        self.send_response(200 if self.path == '/ok' else 404)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThrottledHandler(BaseHTTPRequestHandler):
+    """Answers 429 with Retry-After to the first request of every path"""
+    protocol_version = 'HTTP/1.1'
+    seen = set()
+
+    def do_GET(self):
+        throttled = self.path not in ThrottledHandler.seen
+        ThrottledHandler.seen.add(self.path)
+        body = b'slow down' if throttled else b'{"ok":true}'
+        self.send_response(429 if throttled else 200)
+        if throttled:
+            self.send_header('Retry-After', '0.2')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
 class APITest(unittest.TestCase):
 
     def test_api(self):
@@ -31,6 +133,473 @@ class APITest(unittest.TestCase):
         mock_request = Mock(**request_attrs)
         self.assertIsNone(get_dota_open_api('234', params={'a': 'b'}, r=mock_request))
 
+    def test_pooled_client(self):
+        server = HTTPServer(('127.0.0.1', 0), GzipHandler)
+        GzipHandler.connections = 0
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        pool = ConnectionPool(connect_timeout=1.0, read_timeout=1.0)
+        base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+        try:
+            self.assertEqual(get_dota_open_api('ok', base_url=base_url, r=pool), b'{"ok":true}')
+            self.assertEqual(get_dota_open_api('ok', base_url=base_url, r=pool), b'{"ok":true}')
+            self.assertIsNone(get_dota_open_api('missing', base_url=base_url, r=pool))
+            self.assertEqual(GzipHandler.connections, 1)
+            # a timeout on a reused connection is not retried on the other idle ones
+            pool.clear()
+            for _ in range(5):
+                pool._release(('http', '127.0.0.1', server.server_port), pool._new_connection(
+                    'http', '127.0.0.1', server.server_port
+                ))
+            GzipHandler.requests = 0
+            start = time.time()
+            with self.assertRaises(URLError):
+                pool.urlopen(pool.Request(base_url + '/slow'), timeout=0.2)
+            self.assertLess(time.time() - start, 0.4)
+            time.sleep(0.4)
+            self.assertEqual(GzipHandler.requests, 1)
+        finally:
+            pool.clear()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertIsNone(get_dota_open_api('ok', base_url=base_url, r=pool))
+
+    def test_retry_after(self):
+        server = HTTPServer(('127.0.0.1', 0), ThrottledHandler)
+        ThrottledHandler.seen = set()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        pool = ConnectionPool(connect_timeout=1.0, read_timeout=1.0)
+        base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+        try:
+            start = time.time()
+            self.assertEqual(get_dota_open_api('retry', base_url=base_url, r=pool), b'{"ok":true}')
+            self.assertGreaterEqual(time.time() - start, 0.2)
+        finally:
+            pool.clear()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(retry_after({'Retry-After': '3'}), 3.0)
+        self.assertEqual(retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), 0.0)
+        self.assertIsNone(retry_after({}))
+
+    def test_api_all(self):
+        func = fake_api({'a': 'A', 'b?date=7': 'B'}, delay=0.2)
+        start = time.time()
+        self.assertEqual(
+            get_dota_open_api_all([('a', None), ('b', {'date': 7}), ('c', None)], func=func),
+            ['A', 'B', None]
+        )
+        self.assertLess(time.time() - start, 0.5)
+
+
+class LimitTest(unittest.TestCase):
+
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = TokenBucket(rate=1.0, capacity=2, clock=lambda: now[0])
+        self.assertTrue(bucket.acquire(timeout=0))
+        self.assertTrue(bucket.acquire(timeout=0))
+        self.assertFalse(bucket.acquire(timeout=0))
+        now[0] = 1.0
+        self.assertTrue(bucket.acquire(timeout=0))
+        now[0] = 10.0
+        bucket.pause(5)
+        self.assertFalse(bucket.acquire(timeout=0))
+        now[0] = 15.0
+        self.assertTrue(bucket.acquire(timeout=0))
+
+    def test_priority(self):
+        bucket = TokenBucket(rate=20.0, capacity=1)
+        self.assertTrue(bucket.acquire())
+        order = []
+
+        def take(p):
+            bucket.acquire(p)
+            order.append(p)
+
+        threads = [threading.Thread(target=take, args=(BACKGROUND,))]
+        threads += [threading.Thread(target=take, args=(INTERACTIVE,)) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(order, [INTERACTIVE] * 3 + [BACKGROUND])
+
+    def test_circuit_breaker(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        # a single probe once half open, a failed probe opens the circuit again
+        now[0] = 10.0
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] = 20.0
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_open_circuit(self):
+        # an open circuit fails before a token is taken or waited for
+        mock_request = Mock()
+        with patch('app.apis.api_breaker', Mock(**{'allow.return_value': False})), \
+                patch('app.apis.api_limiter', Mock(**{'acquire.return_value': False})) as limiter:
+            self.assertIsNone(get_dota_open_api('circuit/1', r=mock_request))
+            limiter.acquire.assert_not_called()
+        mock_request.urlopen.assert_not_called()
+
+    def test_deadline(self):
+        def urlopen(req, timeout):
+            time.sleep(timeout)
+            raise URLError('timed out')
+
+        mock_request = Mock(**{'urlopen.side_effect': urlopen})
+        set_deadline(0.2)
+        try:
+            start = time.time()
+            # the second call only gets what the first one left
+            self.assertIsNone(get_dota_open_api('deadline/1', r=mock_request))
+            self.assertIsNone(get_dota_open_api('deadline/2', r=mock_request))
+            self.assertLess(time.time() - start, 0.4)
+            self.assertEqual(mock_request.urlopen.call_count, 1)
+            # carried into executor threads
+            self.assertIsNotNone(api_executor.submit(bind(remaining)).result())
+            self.assertIsNone(api_executor.submit(remaining).result())
+        finally:
+            set_deadline(None)
+        # a timeout cut short by the deadline is not held against the API
+        breaker = CircuitBreaker(failure_threshold=1)
+        with patch('app.apis.api_breaker', breaker):
+            set_deadline(0.1)
+            try:
+                self.assertIsNone(get_dota_open_api('deadline/3', r=mock_request))
+            finally:
+                set_deadline(None)
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            mock_request.urlopen.side_effect = URLError('connection refused')
+            self.assertIsNone(get_dota_open_api('deadline/4', r=mock_request))
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_shared(self):
+        state_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(state_dir, 'limit.json')
+            worker1 = TokenBucket(rate=0.001, capacity=2, state_path=path)
+            worker2 = TokenBucket(rate=0.001, capacity=2, state_path=path)
+            self.assertTrue(worker1.acquire(timeout=0))
+            self.assertTrue(worker2.acquire(timeout=0))
+            self.assertFalse(worker1.acquire(timeout=0))
+            self.assertFalse(worker2.acquire(timeout=0))
+            # a background process yields to the interactive callers of the other workers
+            path = os.path.join(state_dir, 'priority.json')
+            web = TokenBucket(rate=10.0, capacity=1, state_path=path)
+            scheduler = TokenBucket(rate=10.0, capacity=1, state_path=path)
+            self.assertTrue(web.acquire(timeout=0))
+            order = []
+            waiting = threading.Thread(target=lambda: order.append(web.acquire(INTERACTIVE, timeout=1.0) and 'web'))
+            waiting.start()
+            time.sleep(0.02)
+            self.assertTrue(scheduler.acquire(BACKGROUND, timeout=1.0))
+            order.append('scheduler')
+            waiting.join()
+            self.assertEqual(order, ['web', 'scheduler'])
+            with open(path) as f:
+                self.assertEqual(json.load(f)['waiters'], {})
+        finally:
+            shutil.rmtree(state_dir)
+
+
+class LoadTestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeOpenDota().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_fake_api(self):
+        base_url = app.config['OPEN_DOTA_BASE_URL']
+        app.config['OPEN_DOTA_BASE_URL'] = self.server.url
+        try:
+            player = json.loads(get_dota_open_api('api/players/42', r=ConnectionPool()).decode('utf-8'))
+            week = json.loads(get_dota_open_api('api/players/42/wl', params={'date': 7}).decode('utf-8'))
+            overall = json.loads(get_dota_open_api('api/players/42/wl').decode('utf-8'))
+            heroes = json.loads(get_dota_open_api('api/players/42/heroes').decode('utf-8'))
+        finally:
+            app.config['OPEN_DOTA_BASE_URL'] = base_url
+        self.assertEqual(player['profile']['account_id'], 42)
+        self.assertLess(week['win'] + week['lose'], overall['win'] + overall['lose'])
+        self.assertEqual(heroes[0]['hero_id'], '1')
+        self.assertEqual(self.server.requests['/api/players/42/wl'], 2)
+
+    def test_injection(self):
+        self.server.throttle_rate = 1.0
+        with self.assertRaises(HTTPError) as cm:
+            request.urlopen(self.server.url + '/api/heroes')
+        self.assertEqual((cm.exception.code, cm.exception.headers['Retry-After']), (429, '1'))
+        self.server.throttle_rate, self.server.error_rate = 0.0, 1.0
+        with self.assertRaises(HTTPError) as cm:
+            request.urlopen(self.server.url + '/api/heroes')
+        self.assertEqual(cm.exception.code, 500)
+        self.server.error_rate, self.server.latency = 0.0, 0.05
+        start = time.time()
+        self.assertEqual(len(json.loads(request.urlopen(self.server.url + '/api/heroes').read().decode('utf-8'))), 12)
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
+    def test_summarize(self):
+        self.assertIsNone(percentile([], 50))
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, q) for q in [50, 95, 99, 100]], [50, 95, 99, 100])
+        report = summarize([('a', 0.01, True), ('a', 0.03, False), ('b', 0.02, True)], 2.0)
+        self.assertEqual(report['a']['requests'], 2)
+        self.assertEqual(report['a']['errors'], 1)
+        self.assertEqual(report['a']['rps'], 1.0)
+        self.assertAlmostEqual(report['a']['p99_ms'], 30.0)
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def test_trace(self):
+        clock = Mock(side_effect=[10.0, 10.5, 11.0])
+        trace = Trace(clock)
+        set_trace(trace)
+        try:
+            # the trace follows the call to the executor
+            api_executor.submit(bind(trace_event), 'api', 10.25, path='api/heroes').result()
+        finally:
+            set_trace(None)
+        trace_event('api', 10.75, path='lost')
+        trace.add('sql', 10.0, statement='SELECT 1')
+        self.assertEqual([(e['kind'], e['start_ms'], e['duration_ms']) for e in trace.timeline()], [
+            ('sql', 0.0, 1000.0),
+            ('api', 250.0, 250.0)
+        ])
+        self.assertTrue(trace.timeline()[1]['thread'].startswith('open-dota-api'))
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def registry(self):
+        registry = Registry(self.state_dir, flush_seconds=60)
+        return registry, registry.counter('calls_total', 'Calls', ['path']), \
+            registry.histogram('call_seconds', 'Call time', ['path'], buckets=(0.1, 1.0))
+
+    def test_expose(self):
+        self.assertEqual(api_path_label('api/players/123/wl'), 'api/players/{id}/wl')
+        self.assertEqual(api_path_label('api/heroes'), 'api/heroes')
+        registry, calls, seconds = self.registry()
+        hits = {('hit',): 3}
+        registry.counter_func('hits_total', 'Hits', ['result'], lambda: hits)
+        calls.inc('a"b')
+        seconds.observe(0.05, 'x')
+        seconds.observe(0.5, 'x')
+        seconds.observe(5, 'x')
+        self.assertEqual(registry.expose().splitlines(), [
+            '# HELP calls_total Calls',
+            '# TYPE calls_total counter',
+            'calls_total{path="a\\"b"} 1',
+            '# HELP call_seconds Call time',
+            '# TYPE call_seconds histogram',
+            'call_seconds_bucket{path="x",le="0.1"} 1',
+            'call_seconds_bucket{path="x",le="1"} 2',
+            'call_seconds_bucket{path="x",le="+Inf"} 3',
+            'call_seconds_sum{path="x"} 5.55',
+            'call_seconds_count{path="x"} 3',
+            '# HELP hits_total Hits',
+            '# TYPE hits_total counter',
+            'hits_total{result="hit"} 3'
+        ])
+
+    def test_workers(self):
+        registry, calls, seconds = self.registry()
+        calls.inc('a')
+        seconds.observe(0.5, 'a')
+        # another worker, its counts reach the directory on its next flush
+        other, other_calls, other_seconds = self.registry()
+        other_calls.inc('a', amount=2)
+        other_calls.inc('b')
+        other_seconds.observe(0.05, 'a')
+        with open(os.path.join(self.state_dir, '1.json'), 'w') as f:
+            json.dump(other.snapshot(), f)
+        lines = registry.expose().splitlines()
+        self.assertIn('calls_total{path="a"} 3', lines)
+        self.assertIn('calls_total{path="b"} 1', lines)
+        self.assertIn('call_seconds_bucket{path="a",le="0.1"} 1', lines)
+        self.assertIn('call_seconds_count{path="a"} 2', lines)
+        # flushes within flush_seconds are skipped, a scrape always flushes
+        calls.inc('a')
+        registry.flush()
+        self.assertTrue(os.path.basename(registry.path).startswith('{}-'.format(os.getpid())))
+        with open(registry.path) as f:
+            self.assertEqual(json.load(f)['calls_total'], [[['a'], 1]])
+        self.assertIn('calls_total{path="a"} 4', registry.expose().splitlines())
+        # a new worker reusing the pid of a dead one keeps the counts of the dead one
+        reused, reused_calls, _ = self.registry()
+        reused_calls.inc('a')
+        self.assertNotEqual(reused.path, registry.path)
+        self.assertIn('calls_total{path="a"} 5', reused.expose().splitlines())
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def clock(self):
+        return self.now
+
+    def test_ttl(self):
+        cache = ResponseCache([(r'^api/heroes$', 60), (r'^api/players/\d+/wl$', 10)], clock=self.clock)
+        heroes = cache.key('base', 'api/heroes')
+        week = cache.key('base', 'api/players/1/wl', {'date': 7})
+        other = cache.key('base', 'api/players/1/matches')
+        cache.set(heroes, b'heroes')
+        cache.set(week, b'week')
+        cache.set(other, b'matches')
+        self.assertEqual(cache.get(heroes), b'heroes')
+        self.assertEqual(cache.get(cache.key('base', 'api/players/1/wl', {'date': '7'})), b'week')
+        self.assertIsNone(cache.get(cache.key('base', 'api/players/1/wl', {'date': 30})))
+        self.assertIsNone(cache.get(other))
+        self.now += 30
+        self.assertEqual(cache.get(heroes), b'heroes')
+        self.assertIsNone(cache.get(week))
+        # paths that are never cached are no misses
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+
+    def test_lru(self):
+        cache = ResponseCache([(r'.*', 60)], max_bytes=10, clock=self.clock)
+        cache.set(cache.key('base', 'a'), b'aaaa')
+        cache.set(cache.key('base', 'b'), b'bbbb')
+        self.assertEqual(cache.get(cache.key('base', 'a')), b'aaaa')
+        cache.set(cache.key('base', 'c'), b'cccc')
+        self.assertIsNone(cache.get(cache.key('base', 'b')))
+        self.assertEqual(cache.get(cache.key('base', 'a')), b'aaaa')
+        self.assertEqual(cache.get(cache.key('base', 'c')), b'cccc')
+        cache.set(cache.key('base', 'd'), b'd' * 11)
+        self.assertIsNone(cache.get(cache.key('base', 'd')))
+
+    def test_disk(self):
+        cache = ResponseCache([(r'.*', 60)], cache_dir=self.cache_dir, clock=self.clock)
+        cache.set(cache.key('base', 'a'), b'aaaa')
+        restarted = ResponseCache([(r'.*', 60)], cache_dir=self.cache_dir, clock=self.clock)
+        self.assertEqual(restarted.get(restarted.key('base', 'a')), b'aaaa')
+        self.now += 61
+        restarted = ResponseCache([(r'.*', 60)], cache_dir=self.cache_dir, clock=self.clock)
+        self.assertIsNone(restarted.get(restarted.key('base', 'a')))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_prune(self):
+        cache = ResponseCache([(r'^a', 10), (r'.*', 60)], cache_dir=self.cache_dir, max_disk_bytes=40,
+                              prune_seconds=5, clock=self.clock)
+        cache.set(cache.key('base', 'a'), b'aaaa')
+        cache.set(cache.key('base', 'b'), b'bbbb')
+        # a payload is stored as is after its expiry time, never unpickled
+        with open(cache._disk_path(cache.key('base', 'b')), 'rb') as f:
+            self.assertEqual(f.read(), b'1060.0\nbbbb')
+        with open(os.path.join(self.cache_dir, 'old.cache'), 'wb') as f:
+            f.write(b'pickled')
+        self.now += 11
+        cache.set(cache.key('base', 'c'), b'cccc')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertIsNone(ResponseCache([], cache_dir=self.cache_dir, clock=self.clock).get(cache.key('base', 'a')))
+        # over the quota the oldest files go first
+        self.now += 5
+        os.utime(cache._disk_path(cache.key('base', 'b')), (1, 1))
+        cache.set(cache.key('base', 'd'), b'd' * 20)
+        cache.prune()
+        # the disk is only read for paths that are cached
+        cache._read_disk = Mock(return_value=None)
+        self.assertIsNone(cache.get(cache.key('base', 'a')))
+        cache._read_disk.assert_called_once_with(cache.key('base', 'a'))
+        cache = ResponseCache([(r'^a', 10)], cache_dir=self.cache_dir, clock=self.clock)
+        cache._read_disk = Mock(return_value=None)
+        self.assertIsNone(cache.get(cache.key('base', 'b')))
+        cache._read_disk.assert_not_called()
+        fresh = ResponseCache([(r'.*', 60)], cache_dir=self.cache_dir, clock=self.clock)
+        self.assertIsNone(fresh.get(cache.key('base', 'b')))
+        self.assertEqual(fresh.get(cache.key('base', 'c')), b'cccc')
+        # another thread pruning, this one skips it
+        self.now += 61
+        with fresh._prune_lock:
+            fresh.prune()
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        fresh.prune()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_api_cache(self):
+        response_attrs = {'getcode.return_value': 200, 'read.return_value': b'[]'}
+        mock_request = Mock(**{'urlopen.return_value': Mock(**response_attrs)})
+        api_cache.clear()
+        self.assertEqual(get_dota_open_api('api/heroes', base_url='cached', r=mock_request), b'[]')
+        self.assertEqual(get_dota_open_api('api/heroes', base_url='cached', r=mock_request), b'[]')
+        self.assertEqual(mock_request.urlopen.call_count, 1)
+        api_cache.clear()
+
+
+class ScoringTest(unittest.TestCase):
+
+    @staticmethod
+    def score_per_row(hero_ids, hero_match_list, hero_ranking_list):
+        """The original one hero at a time scoring"""
+        hm_dict = dict((int(hm['hero_id']), hm) for hm in hero_match_list)
+        max_win = max([-1] + [hm['win'] for hm in hero_match_list])
+        max_last_played = max([-1] + [hm['last_played'] for hm in hero_match_list])
+        hr_dict = dict((hr['hero_id'], hr) for hr in hero_ranking_list)
+        result = []
+        for hero_id in hero_ids:
+            s = HeroScore(last_played_score=0.0, win_score=0.0, rank_score=0.0)
+            if hero_id in hm_dict:
+                s.last_played_score = float(hm_dict[hero_id]['last_played']) / max_last_played
+                s.win_score = float(hm_dict[hero_id]['win']) / max_win
+            if hero_id in hr_dict:
+                s.rank_score = hr_dict[hero_id]['percent_rank']
+            result.append((s.rank_score, s.win_score, s.last_played_score, s.get_overall_score()))
+        return result
+
+    def test_score_players(self):
+        rnd = random.Random(7)
+        hero_ids = rnd.sample(range(1, 150), 120)
+        players = []
+        for _ in range(20):
+            played = rnd.sample(range(1, 160), rnd.randint(1, 100))
+            players.append((
+                [{'hero_id': str(h), 'win': rnd.randint(1, 500), 'last_played': rnd.randint(1, 10 ** 9)}
+                 for h in played],
+                [{'hero_id': h, 'percent_rank': rnd.random()} for h in rnd.sample(played, len(played) // 2)]
+            ))
+        scores = score_players(hero_ids, players)
+        for i, (hero_match_list, hero_ranking_list) in enumerate(players):
+            self.assertEqual(
+                list(zip(scores.rank[i].tolist(), scores.win[i].tolist(),
+                         scores.last_played[i].tolist(), scores.overall[i].tolist())),
+                self.score_per_row(hero_ids, hero_match_list, hero_ranking_list)
+            )
+
+    def test_score_player_without_matches(self):
+        scores = score_player([1, 2], [{'hero_id': '1', 'win': 0, 'last_played': 0}], [])
+        self.assertEqual(scores.overall.tolist(), [0.0, 0.0])
+        scores = score_player([], [], [{'hero_id': 1, 'percent_rank': 0.5}])
+        self.assertEqual(scores.overall.tolist(), [])
+
 
 class ModelTest(unittest.TestCase):
 
@@ -57,6 +626,7 @@ class ModelTest(unittest.TestCase):
             last_played_score=0.1,
             win_score=0.1,
             overall_score=0.1,
+            hero_rank=1,
             score_date=date.today(),
             player_id=self.p.account_id,
             hero_id=self.h.hero_id,
@@ -116,6 +686,7 @@ class ModelTest(unittest.TestCase):
             'last_played_score': 0.1,
             'win_score': 0.1,
             'overall_score': 0.1,
+            'hero_rank': 1,
             'score_date': str(date.today()),
             'player': self.p.to_dict(),
             'hero': self.h.to_dict()
@@ -136,6 +707,7 @@ class ModelTest(unittest.TestCase):
             'overall_score': 0.1,
             'overall_count': 10,
             'score_date': str(date.today()),
+            'age_days': 0,
             'player': self.p.to_dict()
         })
         self.assertAlmostEqual(self.ms.get_compare_score(10), 0.82)
@@ -159,6 +731,7 @@ class ServiceTest(unittest.TestCase):
         with app.app_context():
             db.drop_all()
             db.create_all()
+        hero_catalog.clear()
 
     def tearDown(self):
         db.session.remove()
@@ -198,44 +771,127 @@ class ServiceTest(unittest.TestCase):
         self.assertEqual(score.player.account_id, 1)
 
     def test_fetch_player_match_score(self):
-        mock = Mock(side_effect=[
-            None
-        ])
-        self.assertIsNone(fetch_player_match_score(1, mock))
-        mock = Mock(side_effect=[
-            '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}',
-            None
-        ])
-        self.assertIsNone(fetch_player_match_score(1, mock))
-        mock = Mock(side_effect=[
-            '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}',
-            '{"win":0,"lose":0}',
-            None
-        ])
-        self.assertIsNone(fetch_player_match_score(1, mock))
-        mock = Mock(side_effect=[
-            '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}',
-            '{"win":0,"lose":0}',
-            '{"win":0,"lose":0}',
-            None
-        ])
-        self.assertIsNone(fetch_player_match_score(1, mock))
-        mock = Mock(side_effect=[
-            '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}',
-            '{"win":0,"lose":0}',
-            '{"win":0,"lose":0}',
-            '{"win":0,"lose":0}',
-            None
-        ])
-        self.assertIsNone(fetch_player_match_score(1, mock))
-        mock = Mock(side_effect=[
+        responses = {}
+        self.assertIsNone(fetch_player_match_score(1, fake_api(responses)))
+        responses['api/players/1'] = \
+            '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}'
+        self.assertIsNone(fetch_player_match_score(1, fake_api(responses)))
+        responses['api/players/1/wl?date=7'] = '{"win":0,"lose":0}'
+        self.assertIsNone(fetch_player_match_score(1, fake_api(responses)))
+        responses['api/players/1/wl?date=30'] = '{"win":0,"lose":0}'
+        self.assertIsNone(fetch_player_match_score(1, fake_api(responses)))
+        responses['api/players/1/wl?date=365'] = '{"win":0,"lose":0}'
+        self.assertIsNone(fetch_player_match_score(1, fake_api(responses)))
+        responses['api/players/1/wl'] = '{"win":0,"lose":0}'
+        self.assertIsNotNone(fetch_player_match_score(1, fake_api(responses)))
+
+    def test_get_player_match_scores(self):
+        responses = {}
+        for player_id in [1, 2]:
+            responses['api/players/{}'.format(player_id)] = \
+                '{{"profile":{{"account_id":{0},"steamid":{0},"personaname":"player{0}",' \
+                '"name":"p{0}","avatar":"p{0}.jpg"}}}}'.format(player_id)
+            for path in ['wl?date=7', 'wl?date=30', 'wl?date=365', 'wl']:
+                responses['api/players/{}/{}'.format(player_id, path)] = '{"win":1,"lose":1}'
+        start = time.time()
+        score_list = get_player_match_scores([1, 2, 3], fake_api(responses, delay=0.2))
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual(sorted(s.player_id for s in score_list), [1, 2])
+        self.assertEqual(MatchScore.query.count(), 2)
+        # served from db without touching the API
+        score_list = get_player_match_scores([1, 2], fake_api({}))
+        self.assertEqual(sorted(s.player_id for s in score_list), [1, 2])
+
+    def test_stale_while_revalidate(self):
+        responses = {}
+        for player_id in [1, 2]:
+            responses['api/players/{}'.format(player_id)] = \
+                '{{"profile":{{"account_id":{0},"steamid":{0},"personaname":"player{0}",' \
+                '"name":"p{0}","avatar":"p{0}.jpg"}}}}'.format(player_id)
+            for path in ['wl?date=7', 'wl?date=30', 'wl?date=365', 'wl']:
+                responses['api/players/{}/{}'.format(player_id, path)] = '{"win":1,"lose":1}'
+        for player_id, age in [(1, 1), (2, 3)]:
+            db.session.add(Player(account_id=player_id))
+            db.session.add(MatchScore(player_id=player_id, week_score=0, month_score=0, year_score=0,
+                                      overall_score=0, overall_count=0,
+                                      score_date=date.today() - timedelta(days=age)))
+        db.session.commit()
+        # stale within grace is served straight away, past grace blocks on the API
+        func = fake_api(responses, delay=0.2)
+        start = time.time()
+        self.assertEqual(get_player_match_score_by_id(1, func, max_age=0, grace=2).age_days, 1)
+        self.assertLess(time.time() - start, 0.1)
+        ages = dict((s.player_id, s.age_days) for s in get_player_match_scores([1, 2], func, max_age=0, grace=2))
+        # player 1 may have been refreshed in the meantime
+        self.assertIn(ages.pop(1), [0, 1])
+        self.assertEqual(ages, {2: 0})
+        # refreshed once in the background
+        background_refresher.wait()
+        self.assertEqual(get_player_match_score_by_id(1, fake_api({}), max_age=0, grace=2).age_days, 0)
+        self.assertEqual(MatchScore.query.filter(MatchScore.score_date == date.today()).count(), 2)
+        self.assertEqual(len(func.calls), 10)
+
+    def test_get_partial_player_match_scores(self):
+        responses = {}
+        for player_id in [1, 2]:
+            responses['api/players/{}'.format(player_id)] = \
+                '{{"profile":{{"account_id":{0},"steamid":{0},"personaname":"player{0}",' \
+                '"name":"p{0}","avatar":"p{0}.jpg"}}}}'.format(player_id)
+            for path in ['wl?date=7', 'wl?date=30', 'wl?date=365', 'wl']:
+                responses['api/players/{}/{}'.format(player_id, path)] = '{"win":1,"lose":1}'
+        get_player_match_scores([1], fake_api(responses))
+        start = time.time()
+        score_list, pending = get_partial_player_match_scores([1, 2, 3], 0.1, fake_api(responses, delay=0.3))
+        self.assertLess(time.time() - start, 0.2)
+        self.assertEqual([s.player_id for s in score_list], [1])
+        self.assertEqual(pending, [2, 3])
+        # the pending players keep loading, a later request completes the board
+        time.sleep(0.4)
+        score_list, pending = get_partial_player_match_scores([1, 2, 3], 0.1, fake_api(responses, delay=0.3))
+        self.assertEqual(sorted(s.player_id for s in score_list), [1, 2])
+        self.assertEqual(pending, [3])
+
+    def test_partial_loads_in_background(self):
+        responses = {}
+        for player_id in range(1, 14):
+            responses['api/players/{}'.format(player_id)] = \
+                '{{"profile":{{"account_id":{0},"steamid":{0},"personaname":"player{0}",' \
+                '"name":"p{0}","avatar":"p{0}.jpg"}}}}'.format(player_id)
+            for path in ['wl?date=7', 'wl?date=30', 'wl?date=365', 'wl']:
+                responses['api/players/{}/{}'.format(player_id, path)] = '{"win":1,"lose":1}'
+        # more slow players left loading than the player executor has workers
+        score_list, pending = get_partial_player_match_scores(list(range(1, 13)), 0, fake_api(responses, delay=0.3))
+        self.assertEqual(pending, list(range(1, 13)))
+        # a request without a budget does not queue behind them
+        start = time.time()
+        self.assertEqual([s.player_id for s in get_player_match_scores([13], fake_api(responses))], [13])
+        self.assertLess(time.time() - start, 0.25)
+        for _ in range(100):
+            if MatchScore.query.count() == 13:
+                break
+            time.sleep(0.1)
+        self.assertEqual(MatchScore.query.count(), 13)
+
+    def test_get_max_overall_count(self):
+        self.assertEqual(get_max_overall_count(), 0)
+        score = get_match_score_from_json(
             '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}',
-            '{"win":0,"lose":0}',
-            '{"win":0,"lose":0}',
-            '{"win":0,"lose":0}',
-            '{"win":0,"lose":0}'
-        ])
-        self.assertIsNotNone(fetch_player_match_score(1, mock))
+            '{"win":1,"lose":3}',
+            '{"win":1,"lose":1}',
+            '{"win":1,"lose":0}',
+            '{"win":10,"lose":1}',
+            1
+        )
+        db.session.add(score)
+        db.session.commit()
+        self.assertEqual(get_max_overall_count(), 10)
+        db.session.add(MatchScore(overall_count=5, player_id=1))
+        db.session.commit()
+        self.assertEqual(get_max_overall_count(), 10)
+        # seeded from the table when the stat is missing
+        ScoreStat.query.delete()
+        db.session.commit()
+        self.assertEqual(get_max_overall_count(), 10)
 
     def test_populate_player_hero_scores_from_json(self):
         score = HeroScore.query \
@@ -272,59 +928,413 @@ class ServiceTest(unittest.TestCase):
             .order_by(HeroScore.overall_score.desc()) \
             .first()
         self.assertEqual(score.player.account_id, 2)
+        self.assertEqual(Hero.query.count(), 2)
+        self.assertEqual(HeroScore.query.count(), 2)
+
+    def test_get_player_hero_scores_by_id(self):
+        heroes = [
+            {'id': 1, 'name': 'h1', 'localized_name': 'hero1', 'primary_attr': 'agi', 'attack_type': 'Melee',
+             'roles': ['Carry', 'Escape'], 'legs': 2},
+            {'id': 2, 'name': 'h2', 'localized_name': 'hero2', 'primary_attr': 'str', 'attack_type': 'Melee',
+             'roles': ['Support'], 'legs': 2},
+            {'id': 3, 'name': 'h3', 'localized_name': 'hero3', 'primary_attr': 'int', 'attack_type': 'Ranged',
+             'roles': ['Carry', 'Nuker'], 'legs': 2}
+        ]
+        populate_player_hero_scores_from_json(
+            '[{"hero_id": 1, "percent_rank": 0.5}, {"hero_id": 2, "percent_rank": 0.9}]',
+            '[{"hero_id":"1","last_played":9,"win":9}, {"hero_id":"3","last_played":5,"win":1}]',
+            json.dumps(heroes),
+            '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}',
+            1
+        )
+        self.assertEqual(
+            sorted((s.hero_id, s.hero_rank) for s in HeroScore.query.all()),
+            [(1, 1), (2, 2), (3, 3)]
+        )
+        func = fake_api({})
+        self.assertEqual([s.hero_id for s in get_player_hero_scores_by_id(1, 2, func=func)], [1, 2])
+        self.assertEqual([s.hero_id for s in get_player_hero_scores_by_id(1, 5, func=func)], [1, 2, 3])
+        self.assertEqual([s.hero_id for s in get_player_hero_scores_by_id(1, 5, role='carry', func=func)], [1, 3])
+        self.assertEqual([s.hero_id for s in get_player_hero_scores_by_id(1, 5, primary_attr='int', func=func)], [3])
+        # a filter matching nothing never goes to the API
+        self.assertEqual(get_player_hero_scores_by_id(1, 5, role='Jungler', func=func), [])
+        self.assertEqual(func.calls, [])
+        self.assertEqual(rank_heroes([0.5, 0.9, 0.5], [3, 1, 2]).tolist(), [3, 1, 2])
 
     def test_fetch_player_hero_scores(self):
-        mock = Mock(side_effect=[
-            None
-        ])
-        fetch_player_hero_scores(1, mock)
-        score = HeroScore.query \
-            .filter(HeroScore.player_id == 1) \
-            .first()
-        self.assertIsNone(score)
-        mock = Mock(side_effect=[
-            '[{"hero_id": 1, "score": 4398.79441087885, "percent_rank": 0.9, "card": 954500}]',
-            None
-        ])
-        fetch_player_hero_scores(1, mock)
-        score = HeroScore.query \
-            .filter(HeroScore.player_id == 1) \
-            .first()
-        self.assertIsNone(score)
-        mock = Mock(side_effect=[
-            '[{"hero_id": 1, "score": 4398.79441087885, "percent_rank": 0.9, "card": 954500}]',
-            '[{"hero_id":"1","last_played":9,"games":10,"win":9}]',
-            None
-        ])
-        fetch_player_hero_scores(1, mock)
-        score = HeroScore.query \
-            .filter(HeroScore.player_id == 1) \
-            .first()
-        self.assertIsNone(score)
-        mock = Mock(side_effect=[
-            '[{"hero_id": 1, "score": 4398.79441087885, "percent_rank": 0.9, "card": 954500}]',
-            '[{"hero_id":"1","last_played":9,"games":10,"win":9}]',
-            '[{"id":1,"name":"h1","localized_name":"hero1","primary_attr":"agi","attack_type":"fire",\
-            "roles":["Carry","Escape","Nuker"],"legs":2}]',
-            None
-        ])
-        fetch_player_hero_scores(1, mock)
-        score = HeroScore.query \
-            .filter(HeroScore.player_id == 1) \
-            .first()
-        self.assertIsNone(score)
-        mock = Mock(side_effect=[
-            '[{"hero_id": 1, "score": 4398.79441087885, "percent_rank": 0.9, "card": 954500}]',
-            '[{"hero_id":"1","last_played":9,"games":10,"win":9}]',
-            '[{"id":1,"name":"h1","localized_name":"hero1","primary_attr":"agi","attack_type":"fire",\
-            "roles":["Carry","Escape","Nuker"],"legs":2}]',
+        responses = {}
+        fetch_player_hero_scores(1, fake_api(responses))
+        self.assertIsNone(HeroScore.query.filter(HeroScore.player_id == 1).first())
+        responses['api/players/1/rankings'] = \
+            '[{"hero_id": 1, "score": 4398.79441087885, "percent_rank": 0.9, "card": 954500}]'
+        fetch_player_hero_scores(1, fake_api(responses))
+        self.assertIsNone(HeroScore.query.filter(HeroScore.player_id == 1).first())
+        responses['api/players/1/heroes'] = '[{"hero_id":"1","last_played":9,"games":10,"win":9}]'
+        fetch_player_hero_scores(1, fake_api(responses))
+        self.assertIsNone(HeroScore.query.filter(HeroScore.player_id == 1).first())
+        responses['api/heroes'] = '[{"id":1,"name":"h1","localized_name":"hero1","primary_attr":"agi",\
+            "attack_type":"fire","roles":["Carry","Escape","Nuker"],"legs":2}]'
+        fetch_player_hero_scores(1, fake_api(responses))
+        self.assertIsNone(HeroScore.query.filter(HeroScore.player_id == 1).first())
+        responses['api/players/1'] = \
             '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}'
+        func = fake_api(responses)
+        fetch_player_hero_scores(1, func)
+        self.assertIsNotNone(HeroScore.query.filter(HeroScore.player_id == 1).first())
+        # heroes come from the catalog loaded by the previous call
+        self.assertNotIn('api/heroes', func.calls)
+
+    def test_hero_catalog(self):
+        hero_json = '[{"id":%d,"name":"h%d","localized_name":"hero%d","primary_attr":"agi",' \
+                    '"attack_type":"fire","roles":["Carry"],"legs":2}]'
+        func = fake_api({'api/heroes': hero_json % (1, 1, 1)})
+        self.assertEqual(list(hero_catalog.heroes(fetch=lambda: func('api/heroes')).keys()), [1])
+        # built lazily from the db in a new process
+        hero_catalog.clear()
+        self.assertEqual(hero_catalog.get(1).localized_name, 'hero1')
+        self.assertEqual(hero_catalog.heroes(fetch=lambda: func('api/heroes'))[1].roles, 'Carry')
+        self.assertEqual(func.calls, ['api/heroes'])
+        # an unknown hero triggers a refresh
+        func = fake_api({'api/heroes': hero_json % (2, 2, 2)})
+        self.assertEqual(
+            sorted(hero_catalog.heroes(fetch=lambda: func('api/heroes'), hero_ids=[2]).keys()),
+            [1, 2]
+        )
+        self.assertEqual(Hero.query.count(), 2)
+        # an expired catalog keeps serving when the API is down
+        hero_catalog.ttl = -1
+        try:
+            heroes = hero_catalog.heroes(fetch=lambda: fake_api({})('api/heroes'))
+        finally:
+            hero_catalog.ttl = app.config['HERO_CATALOG_TTL']
+        self.assertEqual(sorted(heroes.keys()), [1, 2])
+
+
+class FlightTest(unittest.TestCase):
+
+    def setUp(self):
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            app.config['SQLALCHEMY_DATABASE_URI'] = default_db_uri.replace(
+                "local", "test"
+            )
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            os.unlink(default_db_path.replace("local", "test"))
+
+    def test_lease(self):
+        worker1 = SingleFlight(wait_seconds=0.5, poll_interval=0.01)
+        worker2 = SingleFlight(wait_seconds=0.5, poll_interval=0.01)
+        self.assertTrue(worker1.try_acquire('match:1'))
+        self.assertFalse(worker1.try_acquire('match:1'))
+        self.assertFalse(worker2.try_acquire('match:1'))
+        self.assertTrue(worker2.try_acquire('match:2'))
+        start = time.time()
+        worker2.wait('match:1')
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        worker1.release('match:1')
+        worker2.wait('match:1')
+        self.assertTrue(worker2.try_acquire('match:1'))
+        worker2.release('match:1')
+        worker2.release('match:2')
+        self.assertEqual(FetchLease.query.count(), 0)
+        # an expired lease of a crashed worker is taken over
+        crashed = SingleFlight(lease_seconds=-1)
+        self.assertTrue(crashed.try_acquire('hero:1'))
+        self.assertTrue(worker1.try_acquire('hero:1'))
+        worker1.release('hero:1')
+        # a failing lease table leaves no key in flight
+        broken = SingleFlight()
+        broken._acquire_lease = Mock(side_effect=RuntimeError('database is locked'))
+        with self.assertRaises(RuntimeError):
+            broken.try_acquire('hero:2')
+        self.assertEqual(broken._flights, {})
+
+    def test_do(self):
+        flight = SingleFlight(poll_interval=0.01)
+        fetches = []
+
+        def fetch():
+            time.sleep(0.2)
+            fetches.append(1)
+            return 'fetched'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(flight.do('match:1', fetch, lambda: 'looked up')))
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(sorted(results), ['fetched'] + ['looked up'] * 4)
+
+    def test_concurrent_match_scores(self):
+        responses = {
+            'api/players/1':
+                '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}'
+        }
+        for path in ['wl?date=7', 'wl?date=30', 'wl?date=365', 'wl']:
+            responses['api/players/1/' + path] = '{"win":1,"lose":1}'
+        func = fake_api(responses, delay=0.2)
+        results = []
+
+        def load():
+            results.append([s.player_id for s in get_player_match_scores([1], func)])
+            db.session.remove()
+
+        threads = [threading.Thread(target=load) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [[1], [1], [1]])
+        self.assertEqual(len(func.calls), 5)
+        self.assertEqual(MatchScore.query.count(), 1)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            app.config['SQLALCHEMY_DATABASE_URI'] = default_db_uri.replace(
+                "local", "test"
+            )
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+        hero_catalog.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            os.unlink(default_db_path.replace("local", "test"))
+
+    def test_access_tracker(self):
+        tracker = AccessTracker()
+        tracker.track([1, 2], TrackedPlayer.MATCH)
+        tracker.track([2], TrackedPlayer.HERO)
+        self.assertEqual(TrackedPlayer.query.count(), 2)
+        self.assertIsNone(TrackedPlayer.query.get(1).hero_accessed_at)
+        self.assertIsNotNone(TrackedPlayer.query.get(2).hero_accessed_at)
+        # written once a day per process
+        TrackedPlayer.query.delete()
+        db.session.commit()
+        tracker.track([1, 2], TrackedPlayer.MATCH)
+        self.assertEqual(TrackedPlayer.query.count(), 0)
+
+    def test_target_date(self):
+        today = date.today()
+        evening = datetime.combine(today, datetime.min.time()) + timedelta(hours=23, minutes=30)
+        scheduler = Scheduler(3600, 7, 2, 0, 0, clock=lambda: evening)
+        self.assertEqual(scheduler.target_date(), today + timedelta(days=1))
+        scheduler.clock = lambda: evening - timedelta(hours=1)
+        self.assertEqual(scheduler.target_date(), today)
+
+    def test_run_once(self):
+        responses = {
+            'api/players/1':
+                '{"profile":{"account_id":1,"steamid":1,"personaname":"player1","name":"p1","avatar":"p1.jpg"}}',
+            'api/players/1/rankings': '[{"hero_id": 1, "score": 4398.79, "percent_rank": 0.9, "card": 954500}]',
+            'api/players/1/heroes': '[{"hero_id":"1","last_played":9,"games":10,"win":9}]',
+            'api/heroes': '[{"id":1,"name":"h1","localized_name":"hero1","primary_attr":"agi",'
+                          '"attack_type":"fire","roles":["Carry"],"legs":2}]'
+        }
+        for path in ['wl?date=7', 'wl?date=30', 'wl?date=365', 'wl']:
+            responses['api/players/1/' + path] = '{"win":1,"lose":1}'
+        tomorrow = date.today() + timedelta(days=1)
+        midnight = datetime.combine(tomorrow, datetime.min.time())
+        func = fake_api(responses)
+        scheduler = Scheduler(3600, 7, 2, 0, 0, clock=lambda: midnight - timedelta(minutes=10), func=func)
+        AccessTracker().track([1], TrackedPlayer.MATCH)
+        AccessTracker().track([1], TrackedPlayer.HERO)
+        db.session.add(TrackedPlayer(player_id=2, match_accessed_at=midnight - timedelta(days=30)))
+        db.session.commit()
+        self.assertEqual(scheduler.run_once(), 1)
+        self.assertEqual(MatchScore.query.filter(MatchScore.score_date == tomorrow).count(), 1)
+        self.assertEqual(HeroScore.query.filter(HeroScore.score_date == tomorrow).count(), 1)
+        # scores stored ahead are not served before their day
+        self.assertIsNone(get_latest_match_score(1))
+        self.assertEqual(get_recent_match_scores([1], date.today()), [])
+        self.assertEqual(get_top_hero_scores(1), [])
+        # warm players are not loaded again, player 2 is no longer tracked
+        self.assertEqual(scheduler.due_players(tomorrow), [])
+        self.assertEqual(scheduler.run_once(), 0)
+        self.assertNotIn('api/players/2', func.calls)
+
+
+class ImportTest(unittest.TestCase):
+
+    def setUp(self):
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            app.config['SQLALCHEMY_DATABASE_URI'] = default_db_uri.replace(
+                "local", "test"
+            )
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+        hero_catalog.clear()
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.checkpoint_dir, 'import.checkpoint')
+        self.responses = {
+            'api/heroes': '[{"id":1,"name":"h1","localized_name":"hero1","primary_attr":"agi",'
+                          '"attack_type":"fire","roles":["Carry"],"legs":2}]'
+        }
+        # player 3 does not exist
+        for player_id in [1, 2, 4]:
+            self.responses['api/players/{}'.format(player_id)] = \
+                '{{"profile":{{"account_id":{0},"steamid":{0},"personaname":"p{0}","name":"p{0}","avatar":""}}}}' \
+                .format(player_id)
+            self.responses['api/players/{}/rankings'.format(player_id)] = '[]'
+            self.responses['api/players/{}/heroes'.format(player_id)] = \
+                '[{"hero_id":"1","last_played":9,"games":10,"win":9}]'
+            for path in ['wl?date=7', 'wl?date=30', 'wl?date=365', 'wl']:
+                self.responses['api/players/{}/{}'.format(player_id, path)] = '{"win":1,"lose":1}'
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.checkpoint_dir)
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            os.unlink(default_db_path.replace("local", "test"))
+
+    def test_run(self):
+        progress = []
+        importer = Importer(2, 2, self.checkpoint_path, 'ids.txt', func=fake_api(self.responses))
+        stats = importer.run(['1', '', '# comment', '2', 'x', '3', '4', '2'], progress.append)
+        self.assertEqual((stats['done'], stats['stored'], stats['failed']), (5, 4, 1))
+        self.assertEqual(len(progress), 3)
+        self.assertGreater(stats['rate'], 0)
+        self.assertEqual(Player.query.count(), 3)
+        # player 2 is listed twice but stored once
+        self.assertEqual(MatchScore.query.count(), 3)
+        self.assertEqual(HeroScore.query.count(), 3)
+        self.assertEqual(HeroScore.query.filter(HeroScore.player_id == 4).one().hero_rank, 1)
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_resume(self):
+        yesterday = date.today() - timedelta(days=1)
+        with open(self.checkpoint_path, 'w') as f:
+            json.dump({'source': 'ids.txt', 'done': 2, 'score_date': yesterday.isoformat()}, f)
+        func = fake_api(self.responses)
+        stats = Importer(2, 10, self.checkpoint_path, 'ids.txt', func=func).run(['1', '2', '4', '4'])
+        self.assertEqual((stats['done'], stats['stored']), (4, 2))
+        self.assertNotIn('api/players/1', func.calls)
+        self.assertEqual(MatchScore.query.one().score_date, yesterday)
+        # a checkpoint of another input is ignored
+        with open(self.checkpoint_path, 'w') as f:
+            json.dump({'source': 'other.txt', 'done': 2, 'score_date': yesterday.isoformat()}, f)
+        stats = Importer(2, 10, self.checkpoint_path, 'ids.txt', func=func).run(['1'])
+        self.assertEqual((stats['done'], stats['stored']), (1, 1))
+        self.assertEqual(MatchScore.query.filter(MatchScore.score_date == date.today()).count(), 1)
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            app.config['SQLALCHEMY_DATABASE_URI'] = default_db_uri.replace(
+                "local", "test"
+            )
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            os.unlink(default_db_path.replace("local", "test"))
+
+    def test_migrate(self):
+        # a database of an earlier version: an index since replaced, one not yet created, unranked scores
+        db.engine.execute('DROP INDEX ix_hero_score_player_date_rank')
+        db.engine.execute('CREATE INDEX ix_hero_score_player_date_overall ON hero_score (player_id, score_date, '
+                          'overall_score)')
+        db.engine.execute('CREATE INDEX hero_score_by_hand ON hero_score (hero_id)')
+        for hero_id, overall_score in [(1, 0.2), (2, 0.5), (3, 0.2)]:
+            db.session.add(HeroScore(player_id=1, hero_id=hero_id, score_date=date.today(), rank_score=0,
+                                     win_score=0, last_played_score=0, overall_score=overall_score))
+        db.session.commit()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            migrate_db.main()
+        indexes = set(i['name'] for i in db.inspect(db.engine).get_indexes('hero_score'))
+        self.assertIn('ix_hero_score_player_date_rank', indexes)
+        self.assertNotIn('ix_hero_score_player_date_overall', indexes)
+        # indexes the app does not name are not its to drop
+        self.assertIn('hero_score_by_hand', indexes)
+        db.session.expire_all()
+        self.assertEqual([s.hero_id for s in HeroScore.query.order_by(HeroScore.hero_rank)], [2, 1, 3])
+
+
+class CompactionTest(unittest.TestCase):
+
+    def setUp(self):
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            app.config['SQLALCHEMY_DATABASE_URI'] = default_db_uri.replace(
+                "local", "test"
+            )
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
+            os.unlink(default_db_path.replace("local", "test"))
+
+    def add_scores(self, player_id, days):
+        for day in days:
+            db.session.add(MatchScore(player_id=player_id, week_score=0.5, month_score=0.5, year_score=0.5,
+                                      overall_score=day.day / 100.0, overall_count=day.day, score_date=day))
+            for hero_id in [1, 2]:
+                db.session.add(HeroScore(player_id=player_id, hero_id=hero_id, overall_score=hero_id / 10.0,
+                                         hero_rank=hero_id, score_date=day))
+        db.session.commit()
+
+    def test_compact(self):
+        # a Monday, weeks of 2030-01-07 and 2030-01-14 are older than the cutoff 2030-01-21
+        today = date(2030, 1, 28)
+        db.session.add_all([Player(account_id=1), Player(account_id=2), Hero(hero_id=1), Hero(hero_id=2)])
+        self.add_scores(1, [date(2030, 1, 8), date(2030, 1, 9), date(2030, 1, 15), today])
+        self.add_scores(2, [date(2030, 1, 8), date(2030, 1, 9)])
+        compactor = Compactor(keep_days=7, batch_size=1, today=today)
+        reports = compactor.compact(dry_run=True)
+        self.assertEqual([(r['table'], r['periods'], r['rows'], r['rollups']) for r in reports], [
+            ('match_score', 2, 4, 3),
+            ('hero_score', 2, 8, 6)
         ])
-        fetch_player_hero_scores(1, mock)
-        score = HeroScore.query \
-            .filter(HeroScore.player_id == 1) \
-            .first()
-        self.assertIsNotNone(score)
+        self.assertGreater(reports[0]['bytes'], 0)
+        self.assertEqual(MatchScore.query.count(), 6)
+        self.assertEqual(MatchScoreRollup.query.count(), 0)
+        compactor.compact()
+        # the latest day of player 2 is kept although it is old
+        self.assertEqual(
+            sorted((s.player_id, str(s.score_date)) for s in MatchScore.query.all()),
+            [(1, '2030-01-28'), (2, '2030-01-09')]
+        )
+        self.assertEqual(HeroScore.query.count(), 4)
+        rollup = MatchScoreRollup.query.filter(MatchScoreRollup.player_id == 1) \
+            .order_by(MatchScoreRollup.period_start).first()
+        self.assertEqual((str(rollup.period_start), rollup.days, rollup.overall_count), ('2030-01-07', 2, 9))
+        self.assertAlmostEqual(rollup.overall_score, 0.085)
+        self.assertEqual(HeroScoreRollup.query.count(), 6)
+        # nothing left to do, a later score of player 2 lets its last old day go into the existing rollup
+        self.assertEqual([r['rows'] for r in compactor.compact(dry_run=True)], [0, 0])
+        self.add_scores(2, [today])
+        compactor.compact()
+        rollup = MatchScoreRollup.query.filter(MatchScoreRollup.player_id == 2).one()
+        self.assertEqual((rollup.days, rollup.overall_count), (2, 9))
+        self.assertAlmostEqual(rollup.overall_score, 0.085)
 
 
 class ViewTest(unittest.TestCase):
@@ -339,6 +1349,7 @@ class ViewTest(unittest.TestCase):
         with app.app_context():
             db.drop_all()
             db.create_all()
+        hero_catalog.clear()
 
     def tearDown(self):
         db.session.remove()
@@ -402,6 +1413,7 @@ class ViewTest(unittest.TestCase):
             last_played_score=0.1,
             win_score=0.1,
             overall_score=0.78,
+            hero_rank=1,
             score_date=date.today(),
             player_id=self.p1.account_id,
             hero_id=self.h1.hero_id,
@@ -437,6 +1449,8 @@ class ViewTest(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIn(b'player1', result.data)
         self.assertIn(b'player2', result.data)
+        self.assertEqual(result.headers['X-Data-Age-Days'], '0')
+        self.assertNotIn('Warning', result.headers)
         # test sort
         self.app.get('/leaderboard?ids=1,2&sort=W')
         self.assertEqual(result.status_code, 200)
@@ -454,6 +1468,15 @@ class ViewTest(unittest.TestCase):
         self.assertIn('application/json', result.headers['Content-Type'])
         self.assertIn(b'player1', result.data)
         self.assertIn(b'player2', result.data)
+        # test budget
+        result = self.app.get('/leaderboard?ids=1,2&budget_ms=d')
+        self.assertEqual(result.status_code, 400)
+        result = self.app.get('/leaderboard?ids=1,2&budget_ms=100', headers={
+            'Accept': 'application/json'
+        })
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.get_json()['pending'], [])
+        self.assertEqual(len(result.get_json()['scores']), 2)
         # clean up
         self.__clean_test_data()
 
@@ -471,7 +1494,175 @@ class ViewTest(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIn(b'player1', result.data)
         self.assertIn(b'player2', result.data)
-        self.assertIn(b'-7.2', result.data)
+        self.assertIn(b'-0.72', result.data)
+        # clean up
+        self.__clean_test_data()
+
+    def test_conditional_requests(self):
+        # setup
+        self.__setup_test_data()
+        for url in ['/leaderboard?ids=1,2', '/compare?p1=1&p2=2', '/recommend?p=1']:
+            result = self.app.get(url)
+            self.assertEqual(result.status_code, 200)
+            self.assertIn('max-age', result.headers['Cache-Control'])
+            self.assertEqual(result.headers['Vary'], 'Accept')
+            etag = result.headers['ETag']
+            result = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(result.status_code, 304)
+            self.assertEqual(result.data, b'')
+            self.assertEqual(result.headers['ETag'], etag)
+            # another representation is another version
+            result = self.app.get(url, headers={'If-None-Match': etag, 'Accept': 'application/json'})
+            self.assertEqual(result.status_code, 200)
+        etag = self.app.get('/leaderboard?ids=1,2').headers['ETag']
+        result = self.app.get('/leaderboard?ids=1,2&sort=W', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 200)
+        last_modified = self.app.get('/recommend?p=1').headers['Last-Modified']
+        result = self.app.get('/recommend?p=1', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(result.status_code, 304)
+        self.assertNotIn('Last-Modified', self.app.get('/compare?p1=1&p2=2').headers)
+        self.assertNotIn('Last-Modified', self.app.get('/leaderboard?ids=1,2').headers)
+        # clean up
+        self.__clean_test_data()
+
+    def test_query_count(self):
+        # setup
+        self.__setup_test_data()
+        # once per process and day the access is tracked and the max overall count seeded
+        for url in ['/leaderboard?ids=1,2', '/compare?p1=1&p2=2', '/recommend?p=1']:
+            self.app.get(url)
+        for accept in ['text/html', 'application/json']:
+            with assert_query_count(self, 1):
+                self.app.get('/leaderboard?ids=1,2', headers={'Accept': accept})
+            with assert_query_count(self, 3):
+                self.app.get('/compare?p1=1&p2=2', headers={'Accept': accept})
+            with assert_query_count(self, 1):
+                self.app.get('/recommend?p=1', headers={'Accept': accept})
+        # clean up
+        self.__clean_test_data()
+
+    def test_global_leader_board(self):
+        yesterday = date.today() - timedelta(days=1)
+        for player_id in range(1, 8):
+            db.session.add(Player(account_id=player_id, personaname='p{}'.format(player_id)))
+            # players 1-3 and 4-6 tie on the overall count
+            db.session.add(MatchScore(player_id=player_id, week_score=player_id / 10.0, month_score=0.5,
+                                      year_score=0.5, overall_score=1 - player_id / 10.0,
+                                      overall_count=(player_id - 1) // 3))
+        db.session.add(MatchScore(player_id=1, week_score=0.9, month_score=0.5, year_score=0.5,
+                                  overall_score=0.9, overall_count=9, score_date=yesterday))
+        db.session.commit()
+        json_headers = {'Accept': 'application/json'}
+        for sort_by, expected in [('w', [7, 6, 5, 4, 3, 2, 1]), ('C', [7, 6, 5, 4, 3, 2, 1]),
+                                  ('o', [1, 2, 3, 4, 5, 6, 7])]:
+            players, ranks, after = [], [], ''
+            for page in range(4):
+                # every page takes a single query, however deep
+                with assert_query_count(self, 1):
+                    result = self.app.get('/leaderboard/global?sort={}&limit=2{}'.format(sort_by, after),
+                                          headers=json_headers)
+                self.assertEqual(result.status_code, 200)
+                body = result.get_json()
+                players += [s['player']['account_id'] for s in body['scores']]
+                ranks += [s['rank'] for s in body['scores']]
+                if body['next'] is None:
+                    break
+                after = '&after=' + body['next']
+            self.assertEqual(page, 3)
+            self.assertEqual(ranks, [1, 2, 3, 4, 5, 6, 7])
+            if sort_by == 'C':
+                # ties are listed once each, newest score first
+                self.assertEqual(sorted(players), [1, 2, 3, 4, 5, 6, 7])
+                self.assertEqual(players[0], 7)
+            else:
+                self.assertEqual(players, expected)
+        result = self.app.get('/leaderboard/global?date={}'.format(yesterday), headers=json_headers)
+        self.assertEqual([(s['rank'], s['player']['account_id']) for s in result.get_json()['scores']], [(1, 1)])
+        self.assertIsNone(result.get_json()['next'])
+        result = self.app.get('/leaderboard/global?limit=3')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(b'next page', result.data)
+        cursor = self.app.get('/leaderboard/global?limit=3', headers=json_headers).get_json()['next']
+        for url in ['/leaderboard/global?sort=x', '/leaderboard/global?limit=0', '/leaderboard/global?limit=201',
+                    '/leaderboard/global?date=yesterday', '/leaderboard/global?after=garbage',
+                    '/leaderboard/global?sort=w&after=' + cursor]:
+            self.assertEqual(self.app.get(url).status_code, 400, url)
+        self.assertEqual(self.app.get('/leaderboard/global?date=2000-01-01').status_code, 404)
+        self.assertEqual(self.app.get('/leaderboard/global?date={}'.format(
+            date.today() + timedelta(days=1)
+        )).status_code, 404)
+
+    def test_metrics(self):
+        # setup
+        self.__setup_test_data()
+        self.app.get('/leaderboard?ids=1,2')
+        self.app.get('/nowhere')
+        result = self.app.get('/metrics')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.content_type.startswith('text/plain'))
+        text = result.get_data(as_text=True)
+        self.assertRegex(
+            text, r'http_request_duration_seconds_count\{route="/leaderboard",method="GET",status="200"\} [1-9]'
+        )
+        self.assertIn('route="unmatched",method="GET",status="404"', text)
+        self.assertRegex(text, r'db_queries_total\{kind="SELECT"\} [1-9]')
+        self.assertIn('opendota_cache_requests_total{result="hit"}', text)
+        # clean up
+        self.__clean_test_data()
+
+    def test_profile(self):
+        # setup
+        self.__setup_test_data()
+        result = self.app.get('/recommend?p=1&profile=forged')
+        self.assertIn(b'hero1', result.data)
+        # without a secret of its own profiling is off, a token signed with the session key is refused
+        self.assertIsNone(app.config['PROFILE_SECRET'])
+        self.assertRaises(RuntimeError, make_token)
+        token = URLSafeTimedSerializer(app.secret_key, salt='profile').dumps('profile')
+        self.assertIn(b'hero1', self.app.get('/recommend?p=1', headers={'X-Profile': token}).data)
+        app.config['PROFILE_SECRET'] = 'profile-secret'
+        result = self.app.get('/recommend?p=1', headers={'X-Profile': make_token()})
+        self.assertEqual(result.headers['Cache-Control'], 'no-store')
+        report = result.get_json()
+        self.assertEqual(report['status'], 200)
+        self.assertGreater(report['sql']['count'], 0)
+        self.assertEqual(len(report['timeline']), report['sql']['count'] + report['commits'])
+        self.assertIn('SELECT', report['timeline'][0]['statement'])
+        self.assertGreater(len(report['functions']), 0)
+        profile_dir, request_profiler.profile_dir = request_profiler.profile_dir, tempfile.mkdtemp()
+        try:
+            result = self.app.get('/leaderboard?ids=1,2&profile={}&profile_output=file'.format(make_token()))
+            self.assertEqual(result.status_code, 200)
+            name = result.headers['X-Profile-File']
+            self.assertTrue(name.endswith('-leaderboard-{}'.format(os.getpid())))
+            with open(os.path.join(request_profiler.profile_dir, name + '.json')) as f:
+                self.assertTrue(json.load(f)['path'].startswith('/leaderboard?ids=1,2&profile='))
+            self.assertTrue(os.path.exists(os.path.join(request_profiler.profile_dir, name + '.prof')))
+            # a full directory gets no more files, the report is returned instead
+            max_files, request_profiler.max_files = request_profiler.max_files, 1
+            result = self.app.get('/leaderboard?ids=1,2&profile={}&profile_output=file'.format(make_token()))
+            request_profiler.max_files = max_files
+            self.assertNotIn('X-Profile-File', result.headers)
+            self.assertEqual(result.get_json()['status'], 200)
+            self.assertEqual(len(os.listdir(request_profiler.profile_dir)), 2)
+        finally:
+            shutil.rmtree(request_profiler.profile_dir)
+            request_profiler.profile_dir = profile_dir
+            app.config['PROFILE_SECRET'] = None
+        # clean up
+        self.__clean_test_data()
+
+    def test_slow_query_log(self):
+        # setup
+        self.__setup_test_data()
+        threshold = app.config['SLOW_QUERY_SECONDS']
+        app.config['SLOW_QUERY_SECONDS'] = 1e-9
+        try:
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                self.app.get('/recommend?p=1')
+        finally:
+            app.config['SLOW_QUERY_SECONDS'] = threshold
+        self.assertTrue(any('slow query' in line and 'SELECT hero.hero_id' in line for line in logs.output))
         # clean up
         self.__clean_test_data()
 
@@ -486,6 +1677,16 @@ class ViewTest(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertIn(b'hero1', result.data)
         self.assertIn(b'0.78', result.data)
+        # test top k
+        result = self.app.get('/recommend?p=1&k=0')
+        self.assertEqual(result.status_code, 400)
+        result = self.app.get('/recommend?p=1&k=3&role=a', headers={
+            'Accept': 'application/json'
+        })
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([s['hero']['hero_id'] for s in result.get_json()], [1])
+        result = self.app.get('/recommend?p=1&k=3&attr=agi')
+        self.assertEqual(result.status_code, 404)
         # clean up
         self.__clean_test_data()
 